@@ -8,12 +8,13 @@ from common.wbh_bot import WBHTelegramBot
 from common.wbh_db import WBHDatabase
 from config import config
 from wublackhole.wbh_blackhole import WBHBlackHole
-from wublackhole.wbh_watcher import start_watch
+from wublackhole.wbh_worker import start_workers
 
 
 def setup_app():
     # Database
-    config.Database = WBHDatabase(config.core['db_filepath'], config.logger_core, False)
+    config.Database = WBHDatabase(config.core['db_filepath'], config.logger_core, False,
+                                  pragmas=config.core['db_pragmas'])
 
     # initialize Blackhole IDs
     bh: WBHBlackHole
@@ -41,15 +42,24 @@ def setup_app():
     config.TelegramBot = WBHTelegramBot(api=config.core['bot']['api'],
                                         logger=config.logger_bot,
                                         proxy=config.core['bot']['proxy'],
-                                        log_level=config.core['log']['bot_level'])
-
-    # Clear leftover of old temp files
+                                        log_level=config.core['log']['bot_level'],
+                                        max_concurrent_uploads=config.core['max_concurrent_uploads'],
+                                        rate_limit=config.core['bot']['rate_limit'],
+                                        transport=config.core['bot']['transport'],
+                                        local_server=config.core['bot']['local_server'],
+                                        stop_event=config.shutdown_event)
+
+    # Clear leftover of old temp files, except chunks that queues are still waiting to send
+    spilled_chunks = set()
+    for bh in config.BlackHoles:
+        spilled_chunks |= bh.queue.get_spilled_chunk_paths()
     files = os.listdir(config.core['temp_dir'])
     t_i = 0
     for file in files:
         if file.startswith("WBHTF"):
             ext = os.path.splitext(file)[1]
-            if len(ext) == 6 and ext.startswith(".p"):
+            if len(ext) == 6 and ext.startswith(".p") and \
+                    os.path.abspath(os.path.join(config.core['temp_dir'], file)) not in spilled_chunks:
                 try:
                     os.remove(os.path.join(config.core['temp_dir'], file))
                     t_i += 1
@@ -67,7 +77,10 @@ def main():
     parser = argparse.ArgumentParser(description='Send everything to WU-BlackHole using Telegram Bot')
     parser.add_argument('--config', '-c',
                         help='Specify path to configuration file. (Use config.json.example as template)')
+    parser.add_argument('--repair-db', action='store_true',
+                        help='Rebuild sizes of blackholes and folders in database, then exit. (Stop service first)')
     args = parser.parse_args()
+    repair_db = args.repair_db
     if args.config is not None:
         # Config path is specified externally
         config.config_filepath = os.path.abspath(args.config)
@@ -81,22 +94,25 @@ def main():
     config.load()
     config.logger_core.info(f'WU-Blackhole {config.version_str()}')
 
-    setup_app()
+    if repair_db:
+        WBHDatabase(config.core['db_filepath'], config.logger_core, False,
+                    pragmas=config.core['db_pragmas']).repair_aggregates()
+        return
 
-    # Before start to watch the paths
-    # Empty the Queue by sending to BlackHole
-    for bh in config.BlackHoles:
-        bh.queue.process_queue(bh.telegram_id)
+    setup_app()
 
-    # start watchers for blackholes
+    # start a watcher and an uploader for each blackhole, uploaders empty their queue first
+    threads = start_workers(config.BlackHoles)
     try:
-        while True:
-            bh: WBHBlackHole
-            for bh in config.BlackHoles:
-                start_watch(bh)
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(timeout=1)
     except KeyboardInterrupt:
         print("\n\nCtrl-C pressed, Exiting...")
-        pass
+        config.shutdown_event.set()
+        for t in threads:
+            t.join(timeout=config.core['path_check_interval'])
+    config.TelegramBot.close()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,16 @@
 import hashlib
 import logging
 import os
-from pathlib import Path
+import stat
+import struct
 import zlib
 from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
 from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.poly1305 import Poly1305
 
 
 class ChecksumType(Enum):
@@ -14,6 +18,7 @@ class ChecksumType(Enum):
     # MD5 = 10
     # SHA1 = 20
     SHA256 = 30
+    SHA256_MERKLE = 31  # Folders: hash tree over (name, type, checksum) of children
     # SHA512 = 40
 
 
@@ -51,10 +56,31 @@ def json_value_escape_string(raw_str: str):
 
 def get_path_size(full_path: str):
     """ return total size of file or directory in bytes """
-    if os.path.isdir(full_path):
-        return sum(f.stat().st_size for f in Path(full_path).glob('**/*') if f.is_file())
-    else:
-        return os.stat(full_path).st_size
+    return get_path_stat(full_path)[0]
+
+
+def get_path_stat(full_path: str) -> tuple:
+    """
+    return (total size in bytes, newest mtime in ns) of file or directory, one stat per entry. A directory's own
+    mtime counts too, so renamed or removed children change it
+    """
+    st = os.stat(full_path)
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size, st.st_mtime_ns
+    size = 0
+    mtime_ns = st.st_mtime_ns
+    with os.scandir(full_path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                s, m = get_path_stat(entry.path)
+            elif entry.is_file():
+                st = entry.stat()
+                s, m = st.st_size, st.st_mtime_ns
+            else:
+                continue
+            size += s
+            mtime_ns = max(mtime_ns, m)
+    return size, mtime_ns
 
 
 def get_checksum_sha256(chunk: bytes, running_hash=None):
@@ -108,6 +134,61 @@ def get_checksum_sha256_folder(dirpath: str, block_size: int = 16384, running_ha
     return running_hash.hexdigest()
 
 
+def get_checksum_sha256_merkle(entries) -> str:
+    """
+    return SHA256_MERKLE checksum of a folder as str, None if checksum of any entry is missing.
+    :param entries: (name, is_dir, checksum) of direct children of folder. Checksum of a file is its SHA256 and of a
+                    sub-folder is its SHA256_MERKLE, so a sub-tree can be verified by itself.
+    :return: checksum hex as str on success, None if there is an entry without checksum
+    """
+    running_hash = hashlib.sha256()
+    for name, is_dir, checksum in sorted(entries):
+        if checksum is None:
+            return None
+        running_hash.update(b'D' if is_dir else b'F')
+        running_hash.update(name.encode('utf-8', 'surrogateescape') + b'\0')
+        running_hash.update(bytes.fromhex(checksum))
+    return running_hash.hexdigest()
+
+
+def get_checksum_sha256_merkle_folder(dirpath: str, block_size: int = 16384, workers: int = 4,
+                                      logger: logging.Logger = None):
+    """
+    return SHA256_MERKLE checksum of a folder on disk as str if successful, None of error. Files are hashed in parallel
+    :param logger:
+    :param dirpath: path of the folder
+    :param block_size: block sizes to read. Default is 16k
+    :param workers: number of files to hash at the same time
+    :return: checksum hex as str on success, None of error
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    def scan(path: str, pool: ThreadPoolExecutor) -> list:
+        """ return tree of [(name, is_dir, sub-tree or future of file checksum), ...] """
+        tree = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    tree.append((entry.name, True, scan(entry.path, pool)))
+                else:
+                    logger.debug(" Hashing `{}`".format(entry.name))
+                    tree.append((entry.name, False, pool.submit(get_checksum_sha256_file, filepath=entry.path,
+                                                                block_size=block_size, logger=logger)))
+        return tree
+
+    def digest(tree: list) -> str:
+        return get_checksum_sha256_merkle((name, is_dir, digest(sub) if is_dir else sub.result())
+                                          for name, is_dir, sub in tree)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return digest(scan(dirpath, pool))
+    except Exception as e:
+        logger.error(f"  ERROR: Can not calculate checksum for `{dirpath}` :\n {str(e)}")
+        return None
+
+
 def chacha20poly1305_encrypt_data(data: bytes, secret: bytes, key: bytes = None, nonce: bytes = None):
     """
     Encrypt data using secret, key and nonce. key and nonce can be None, in that case they will be generated and
@@ -126,6 +207,33 @@ def chacha20poly1305_encrypt_data(data: bytes, secret: bytes, key: bytes = None,
     return chacha.encrypt(nonce, data, secret), key, nonce
 
 
+def chacha20poly1305_encrypt_blocks(blocks, f_w, secret: bytes, key: bytes = None, nonce: bytes = None):
+    """
+    Encrypt data of blocks (an iterable of bytes) to file object f_w a block at a time, so data is not held in
+    memory. Result is the same as chacha20poly1305_encrypt_data of whole data (RFC 8439, secret is associated data).
+    :return: tulip of (size of encrypted data, key, nonce)
+    """
+    if key is None:
+        key = ChaCha20Poly1305.generate_key()
+    if nonce is None:
+        nonce = os.urandom(12)
+    # Block counter 0 gives one-time key of Poly1305, data is encrypted from counter 1
+    otk = Cipher(algorithms.ChaCha20(key, struct.pack('<I', 0) + nonce), mode=None).encryptor().update(bytes(32))
+    encryptor = Cipher(algorithms.ChaCha20(key, struct.pack('<I', 1) + nonce), mode=None).encryptor()
+    mac = Poly1305(otk)
+    mac.update(secret + bytes(-len(secret) % 16))
+    size = 0
+    for block in blocks:
+        encrypted = encryptor.update(block)
+        mac.update(encrypted)
+        f_w.write(encrypted)
+        size += len(encrypted)
+    mac.update(bytes(-size % 16) + struct.pack('<QQ', len(secret), size))
+    tag = mac.finalize()
+    f_w.write(tag)
+    return size + len(tag), key, nonce
+
+
 def chacha20poly1305_encrypt_file(raw_filepath: str, encrypted_filepath: str, secret: bytes, key: bytes = None,
                                   nonce: bytes = None):
     with open(raw_filepath, 'rb') as f_r:
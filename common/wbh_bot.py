@@ -1,188 +1,680 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
+import concurrent.futures
+import hashlib
+import io
 import logging
 import os
-from datetime import datetime
+import shutil
+import threading
 import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
 
 import telegram  # pip install python-telegram-bot --upgrade
 from telegram.ext import Updater
+from telegram.utils.helpers import is_local_file
 
-from common.helper import ChecksumType, EncryptionType, chacha20poly1305_encrypt_data, get_checksum_sha256
+from common.helper import ChecksumType, EncryptionType, chacha20poly1305_encrypt_blocks, chacha20poly1305_encrypt_data
+from common.helper import get_checksum_sha256
 # from config import config
 from common.helper import sizeof_fmt
+from common.wbh_pipeline import WBHPipeline
+from common.wbh_scheduler import WBHRequestScheduler
+from common.wbh_transport import WBHAsyncBotApi
 from common.wbh_db import WBHDbChunks
 from wublackhole.wbh_blackhole import WBHBlackHole
 from wublackhole.wbh_item import QueueState, WBHChunk, WBHItem
 
 
+class WBHChunkJob:
+    """ A chunk on its way through send_file pipeline """
+    def __init__(self, index: int, data: bytes, size: int = None):
+        """ data is None in local mode, chunk is then read from disk by each stage and sent from path """
+        self.index = index
+        self.data = data
+        self.size = len(data) if data is not None else size
+        self.path: str = None
+        self.is_registered = False  # Sent on an earlier call, only needed for file checksum
+        self.checksum: str = None
+        self.encryption_data: str = None
+        self.chunk: WBHChunk = None
+
+
+class WBHPoolBot:
+    """ One bot token of WBHTelegramBot. Telegram limits are per bot, so each one has its own limits and slots """
+    def __init__(self, api, logger: logging.Logger, proxy=None, max_concurrent_uploads=4, rate_limit: dict = None,
+                 stop_event: threading.Event = None, transport: dict = None, base_url: str = None,
+                 base_file_url: str = None):
+        """ base_url and base_file_url are of a local Bot API server, None for Telegram's own """
+        transport = transport or {}
+        request_kwargs = dict(proxy or {})
+        for key, request_key in (('pool_size', 'con_pool_size'), ('connect_timeout', 'connect_timeout'),
+                                 ('read_timeout', 'read_timeout')):
+            if transport.get(key) is not None:
+                request_kwargs[request_key] = transport[key]
+        self.updater = Updater(token=api, base_url=base_url, base_file_url=base_file_url,
+                               request_kwargs=request_kwargs, use_context=True)
+        # Async transport, Bot API calls go through updater.bot if it is None
+        self.transport: WBHAsyncBotApi = None
+        if transport.get('backend') == 'async':
+            try:
+                self.transport = WBHAsyncBotApi(bot=self.updater.bot, logger=logger,
+                                                proxy_url=request_kwargs.get('proxy_url'),
+                                                **{key: transport[key] for key in
+                                                   ('pool_size', 'connect_timeout', 'read_timeout')
+                                                   if transport.get(key) is not None})
+            except (ImportError, ValueError) as e:
+                logger.warning(f"Can not use async transport, falling back to sync: {str(e)}")
+        # Bot id is the first part of its token
+        self.id = int(api.split(':')[0])
+        # Limit number of uploads in flight, shared by all blackholes
+        self.upload_slots = threading.BoundedSemaphore(max_concurrent_uploads)
+        # Paces every Bot API call, shared by all blackholes
+        self.scheduler = WBHRequestScheduler(logger=logger, limits=rate_limit, stop_event=stop_event)
+        self.in_flight = 0  # Calls that picked this bot and are not done yet
+        self.failures = 0  # Failed calls in a row
+        self.unhealthy_until = 0.0  # monotonic time, bot is not picked before it
+
+
+    @property
+    def api(self):
+        """ return object to call Bot API methods on, the async transport or telegram.Bot of updater """
+        return self.transport if self.transport is not None else self.updater.bot
+
+
+    def download(self, file: telegram.File, path_to_save: str) -> str:
+        if is_local_file(file.file_path):
+            # Local Bot API server keeps files on this machine, copy them instead of fetching them over HTTP
+            shutil.copyfile(file.file_path, path_to_save)
+            return path_to_save
+        if self.transport is not None:
+            return self.transport.download(file, path_to_save)
+        return file.download(path_to_save)
+
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
 class WBHTelegramBot:
-    def __init__(self, api, logger: logging.Logger, proxy=None, log_level=logging.INFO):
+    # Secs a bot is left out after a failed call, doubled on each failure in a row
+    unhealthy_secs = 5
+    unhealthy_max_secs = 300
+    # Max chunk size, bots can only download 20MB from Telegram's Bot API server and 2000MB from a local one
+    max_chunk_size = 20 * 1024 * 1024
+    local_max_chunk_size = 2000 * 1024 * 1024
+    # Bytes read at a time in local mode, chunks are not read in memory as a whole
+    local_block_size = 1024 * 1024
+
+
+    def __init__(self, api, logger: logging.Logger, proxy=None, log_level=logging.INFO, max_concurrent_uploads=4,
+                 rate_limit: dict = None, stop_event: threading.Event = None, transport: dict = None,
+                 local_server: dict = None):
+        """
+        api is a bot token, a list of them or a string of them separated by comma. transport is `backend` (sync or
+        async), `pool_size`, `connect_timeout` and `read_timeout` of Bot API connections. local_server is `enabled`,
+        `base_url`, `base_file_url` and `chunk_size` of a Bot API server running with --local on this machine
+        """
         self.logger = logger
         logging.getLogger('telegram.bot').setLevel(log_level)
         logging.getLogger('telegram.ext.dispatcher').setLevel(log_level)
         logging.getLogger('telegram.vendor.ptb_urllib3.urllib3.connectionpool').setLevel(logging.ERROR)
         logging.getLogger('telegram.vendor.ptb_urllib3.urllib3.util.retry').setLevel(logging.ERROR)
 
-        self.updater = Updater(token=api, request_kwargs=proxy, use_context=True)
+        apis = api.replace(',', ' ').split() if isinstance(api, str) else list(api)
+        if not apis:
+            raise telegram.error.InvalidToken()
+        # Local mode: files go up by their path and come down by copying them, both on this machine
+        self.local_server = local_server if local_server and local_server.get('enabled') else None
+        base_urls = {}
+        if self.local_server:
+            base_urls = {'base_url': self.local_server.get('base_url'),
+                         'base_file_url': self.local_server.get('base_file_url')}
+        # Bots must all be members of blackholes' chats
+        self.bots = [WBHPoolBot(api=a, logger=logger, proxy=proxy, max_concurrent_uploads=max_concurrent_uploads,
+                                rate_limit=rate_limit, stop_event=stop_event, transport=transport, **base_urls)
+                     for a in apis]
+        # Chunks are uploaded by coroutines if every bot has an async transport
+        self.is_async = all(bot.transport is not None for bot in self.bots)
+        self.lock = threading.Lock()
+        self._next_bot = 0
+        # First bot, chunks sent by older versions belong to it
+        self.updater = self.bots[0].updater
+        # (bot id, file_id of another bot) -> file_id of same file for bot
+        self.file_ids = {}
+
+
+    def pick_bot(self, bot_id=None) -> WBHPoolBot:
+        """ return bot of bot_id if it is healthy, otherwise a healthy bot with fewest calls in flight """
+        with self.lock:
+            now = time.monotonic()
+            healthy = [bot for bot in self.bots if bot.unhealthy_until <= now]
+            if not healthy:
+                return min(self.bots, key=lambda b: b.unhealthy_until)
+            for bot in healthy:
+                if bot.id == bot_id:
+                    return bot
+            # Start from next bot on each pick, so bots with same load take turns
+            self._next_bot = (self._next_bot + 1) % len(healthy)
+            return min(healthy[self._next_bot:] + healthy[:self._next_bot], key=lambda b: b.in_flight)
+
+
+    @staticmethod
+    def is_bot_failure(e: Exception) -> bool:
+        """ return True if e tells bot can not be used for now: network errors, flood control or revoked token """
+        if isinstance(e, IOError) and isinstance(e.__cause__, telegram.error.TelegramError):
+            # Scheduler gave up after retrying
+            e = e.__cause__
+        if isinstance(e, telegram.error.BadRequest):
+            return False
+        return isinstance(e, (telegram.error.NetworkError, telegram.error.RetryAfter, telegram.error.Unauthorized))
+
+
+    def _take_bot(self, bot_id=None) -> WBHPoolBot:
+        """ return a bot (see pick_bot), counted in flight until _release_bot """
+        bot = self.pick_bot(bot_id)
+        with self.lock:
+            bot.in_flight += 1
+        return bot
+
+
+    def _release_bot(self, bot: WBHPoolBot, error: Exception = None):
+        """ Count call of bot as done, error leaves bot out for a while if it is fault of the bot """
+        with self.lock:
+            bot.in_flight -= 1
+            if error is None:
+                bot.failures = 0
+                return
+            if not self.is_bot_failure(error):
+                # Fault of the call (e.g. bad caption or file_id) or shutdown, not of the bot
+                return
+            bot.failures += 1
+            secs = min(self.unhealthy_max_secs, self.unhealthy_secs * 2 ** (bot.failures - 1))
+            bot.unhealthy_until = time.monotonic() + secs
+        if len(self.bots) > 1:
+            self.logger.warning("Bot `{}` is left out for {} secs: {}".format(bot.id, secs, str(error)))
+
+
+    @contextmanager
+    def use_bot(self, bot_id=None):
+        """ Yield a bot (see pick_bot) and keep track of its load and health """
+        bot = self._take_bot(bot_id)
+        error = None
+        try:
+            yield bot
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._release_bot(bot, error)
+
+
+    def get_chunk_size(self, chunk_size: int) -> int:
+        """ return size of chunks to send: chunk_size, or chunk_size of local_server in local mode, up to limit """
+        if self.local_server:
+            chunk_size = self.local_server.get('chunk_size') or chunk_size
+            limit = self.local_max_chunk_size
+        else:
+            limit = self.max_chunk_size
+        if chunk_size > limit:
+            self.logger.warning("Chunk size {} is more than limit of Bot API server, using {}"
+                                .format(sizeof_fmt(chunk_size), sizeof_fmt(limit)))
+            chunk_size = limit
+        return chunk_size
+
+
+    @staticmethod
+    def chunk_filename(item_wbhi: WBHItem, index: int) -> str:
+        """
+        return name of chunk at index of item. It is the same on every attempt, as it is made of item's id in
+        database (or its queue id, for items that are not in database)
+        """
+        item_key = item_wbhi.db_id if item_wbhi.db_id else "Q{:032x}".format(item_wbhi.qid)
+        return "WBHTF{}.p{:04d}".format(item_key, index)
+
+
+    @staticmethod
+    def chunk_caption(chunk: WBHChunk) -> str:
+        """ return caption that describes chunk on its own, known before it is sent """
+        cap_text = f"Filename: `{chunk.filename}`\n"
+        if chunk.parent_db_id:
+            cap_text += f"Item: `{chunk.parent_db_id}`\n"
+        cap_text += "Part: `{}`\n".format(chunk.index)
+        cap_text += "Size: `{}`\n".format(chunk.size)
+        cap_text += "Encryption: `{}`\n".format(chunk.encryption.name)
+        return cap_text
 
 
     def send_chunk(self, file_open, chunk: WBHChunk, telegram_id):
-        return self._send_chunk(file_open=file_open,
-                                filename=chunk.filename,
-                                org_filepath=chunk.org_fullpath,
-                                org_filename=chunk.org_filename,
-                                org_size=chunk.org_size,
-                                telegram_id=telegram_id)
-
-
-    def _send_chunk(self, file_open, filename, org_filepath, org_filename,
-                    telegram_id, org_size=None, reply_to_message_id=None, disable_notification=True):
-        cap_text = ""
-        # if org_filename is not None:
-        #     cap_text += f"Original Name: `{org_filename}`\n"
-        # if org_filepath is not None:
-        #     cap_text += f"Original Path: `{org_filepath}`\n"
-        # if org_size is not None:
-        #     cap_text += "Original Size: `{}` (`{}`)\n".format(org_size, sizeof_fmt(org_size))
-        cap_text += f"Filename: `{filename}`\n"
+        """ file_open is a file object, or a path in local mode """
+        res, bot_id = self._send_chunk(file_open=file_open,
+                                       filename=chunk.filename,
+                                       caption=self.chunk_caption(chunk),
+                                       telegram_id=telegram_id)
+        if res is not None:
+            chunk.bot_id = bot_id
+        return res
+
+
+    def submit_chunk(self, file_open, chunk: WBHChunk, telegram_id) -> concurrent.futures.Future:
+        """
+        Same as send_chunk, as a coroutine on async transport of a bot, so the caller does not wait for the upload.
+        Blocks while bot has no free upload slot. return a concurrent.futures.Future of result of send_chunk
+        """
+        document = self._chunk_document(file_open)
+        caption = self.chunk_caption(chunk)
+        bot = self._take_bot()
+        # Upload slot is given back by the coroutine once it is done
+        bot.upload_slots.acquire()
+
+        async def send_document():
+            if document is file_open:
+                # Each try sends whole file again
+                file_open.seek(0)
+            return await bot.transport.send_document_async(chat_id=telegram_id,
+                                                           document=document,
+                                                           filename=chunk.filename,
+                                                           caption=caption,
+                                                           disable_notification=True,
+                                                           parse_mode=telegram.ParseMode.MARKDOWN)
+
+        async def send():
+            error = None
+            try:
+                res = await bot.scheduler.call_async(telegram_id, send_document)
+                chunk.bot_id = bot.id
+                return res
+            except Exception as e:
+                error = e
+                self.logger.error("Error  submit_chunk : %s" % str(e))
+                return None
+            finally:
+                bot.upload_slots.release()
+                self._release_bot(bot, error)
+
+        coro = send()
+        try:
+            return bot.transport.submit(coro)
+        except Exception as e:
+            # e.g. loop is closed on shutdown, coroutine never runs to give back the slot
+            coro.close()
+            bot.upload_slots.release()
+            self._release_bot(bot, e)
+            raise
+
+
+    @staticmethod
+    def _chunk_document(file_open):
+        """ return document to send for file_open of a chunk """
+        if isinstance(file_open, str):
+            # Local Bot API server reads file from its path
+            return Path(file_open).absolute().as_uri()
+        return file_open
+
+
+    def _send_chunk(self, file_open, filename, caption, telegram_id, reply_to_message_id=None,
+                    disable_notification=True):
+        """
+        Send chunk in a single call by one of the bots, msg_id and file_id of result are only kept in database.
+        return result and id of bot that sent it
+        """
+        document = self._chunk_document(file_open)
+
+        def send_document(bot: WBHPoolBot):
+            if document is file_open:
+                # Each try sends whole file again
+                file_open.seek(0)
+            return bot.api.send_document(chat_id=telegram_id,
+                                         document=document,
+                                         filename=filename,
+                                         caption=caption,
+                                         reply_to_message_id=reply_to_message_id,
+                                         disable_notification=disable_notification,
+                                         parse_mode=telegram.ParseMode.MARKDOWN)
 
         res = None
+        bot_id = None
         try:
-            res = self.updater.bot.send_document(chat_id=telegram_id,
-                                                 document=file_open,
-                                                 filename=filename,
-                                                 caption=cap_text,
-                                                 reply_to_message_id=reply_to_message_id,
-                                                 disable_notification=disable_notification,
-                                                 parse_mode=telegram.ParseMode.MARKDOWN)
-
-            cap_text += f"*MSGID_{res.message_id}*\n"
-            cap_text += f"*FILEID_{res.document.file_id}*\n"
-            self.updater.bot.editMessageCaption(chat_id=telegram_id,
-                                                message_id=res.message_id,
-                                                caption=cap_text,
-                                                timeout=40,
-                                                parse_mode=telegram.ParseMode.MARKDOWN)
+            with self.use_bot() as bot, bot.upload_slots:
+                res = bot.scheduler.call(telegram_id, send_document, bot)
+                bot_id = bot.id
         except Exception as e:
             self.logger.error("Error  _send_chunk : %s" % str(e))
-        return res
+        return res, bot_id
 
 
-    def send_chunk_file(self, chunk: WBHChunk, blackhole: WBHBlackHole):
-        """ Read chunk file from disk and send it to blackhole"""
-        # Open chunk file to read
-        with open(chunk.org_fullpath, 'rb') as chunk_file_r:
-            # Read whole chunk file
-            res = self.send_chunk(file_open=chunk_file_r, chunk=chunk, telegram_id=blackhole.telegram_id)
-        if res is not None:
-            # == sent to bot without any problem ==
-            chunk.msg_id = res.message_id
-            chunk.file_id = res.document.file_id
-            chunk.state = QueueState.DONE
-            self.logger.debug(f"  `{chunk.filename}` file sent to BlackHole")
+    def _on_chunk_sent(self, chunk: WBHChunk, res) -> bool:
+        """ Update chunk with result of send_chunk. return True if it is sent """
+        if res is None:
+            # == There was a problem ==
+            self.logger.error(
+                "  ERROR: failed to send chunk#{} `{}` to BlackHole. res".format(chunk.index, chunk.filename))
+            return False
+        # == sent to bot without any problem ==
+        chunk.msg_id = res.message_id
+        chunk.file_id = res.document.file_id
+        chunk.state = QueueState.DONE
+        self.logger.debug(f"  `{chunk.filename}` file sent to BlackHole")
+        return True
+
+
+    def send_chunk_file(self, chunk: WBHChunk, blackhole: WBHBlackHole, item_wbhi: WBHItem):
+        """ Read chunk file of item from disk (spilled by an earlier failed upload) and send it to blackhole """
+        if self.local_server:
+            res = self.send_chunk(file_open=chunk.org_fullpath, chunk=chunk, telegram_id=blackhole.telegram_id)
+        else:
+            # Open chunk file to read
+            with open(chunk.org_fullpath, 'rb') as chunk_file_r:
+                # Read whole chunk file
+                res = self.send_chunk(file_open=chunk_file_r, chunk=chunk, telegram_id=blackhole.telegram_id)
+        if self._on_chunk_sent(chunk, res):
             # Save queue
+            blackhole.queue.update_chunk(item_wbhi, chunk)
             blackhole.queue.save()
             # Remove chunk file
             os.remove(chunk.org_fullpath)
             self.logger.debug(f"  `{chunk.filename}` file removed.")
-        else:
-            # == There was a problem ==
-            self.logger.error(
-                "  ERROR: failed to send chunk#{} `{}` to BlackHole. res".format(chunk.index, chunk.filename))
+
+
+    def _chunk_data_open(self, data: bytes, path: str = None):
+        """ return file_open of a chunk in memory, or its path in local mode (a file with the same data) """
+        return path if self.local_server and path else io.BytesIO(data)
+
+
+    def send_chunk_data(self, chunk: WBHChunk, data: bytes, blackhole: WBHBlackHole, path: str = None) -> bool:
+        """
+        Send chunk from memory to blackhole, or from path in local mode (a file with the same data). return True if
+        it is sent
+        """
+        res = self.send_chunk(file_open=self._chunk_data_open(data, path), chunk=chunk,
+                              telegram_id=blackhole.telegram_id)
+        return self._on_chunk_sent(chunk, res)
 
 
     def send_file(self, item_wbhi: WBHItem, blackhole: WBHBlackHole, chunk_size: int, temp_dir: str,
                   encryption_type: EncryptionType = EncryptionType.NONE, encryption_secret: str = None,
-                  delay_between_chunks=0) -> bool:
-        """ return True if all chunks sent successfully """
-        is_all_successful = True
+                  stop_event: threading.Event = None, parallel_chunks: int = 1, queued: bool = True) -> bool:
+        """
+        return True if all chunks sent successfully. Stops before next chunk if stop_event is set.
+        queued is False for an item that is not in queue of blackhole (e.g. database backup), its chunks are then only
+        registered in item_wbhi.chunks.
+        Chunks go through a pipeline of read -> hash -> encrypt -> upload stages, so reading and crypto of next
+        chunks overlap upload of current ones. Up to parallel_chunks chunks are uploaded at the same time, by as
+        many threads, or with async transports by coroutines that a single thread submits and registers.
+        Chunks are uploaded from memory and registered in item_wbhi.chunks at their index once sent (state DONE).
+        Only a chunk that failed to upload is written to temp_dir and registered with state UPLOADING, to be sent
+        again later. Indexes that are not registered (e.g. process stopped mid-upload) are read again on next call.
+        SHA-256 of whole file is computed from the same reads and set on item_wbhi once every byte is hashed, so
+        registered chunks are still read (but not sent) on resume.
+        """
         if item_wbhi.chunks is None:
             # New list if there is no chunk yet
             item_wbhi.chunks = []
         # Prepare original filename
         org_fullpath = os.path.join(*item_wbhi.parents, item_wbhi.filename)
-        chunk_i = len(item_wbhi.chunks)
+        registered_indexes = {chunk.index for chunk in item_wbhi.chunks}
+        file_hash = hashlib.sha256()
+        hashed_size = [0]
         self.logger.debug("Sending file `{}` in chunks of {}"
                           .format(org_fullpath, sizeof_fmt(chunk_size)))
+
+        def read_chunks(org_file):
+            """ Read whole file in chunks, in order """
+            chunk_i = 0
+            while True:
+                if self.local_server:
+                    # Chunks can be up to 2000MB, next stages read them from disk
+                    size = min(chunk_size, org_size - chunk_i * chunk_size)
+                    if size <= 0:
+                        break
+                    job = WBHChunkJob(index=chunk_i, data=None, size=size)
+                else:
+                    chunk_bytes = org_file.read(chunk_size)
+                    if not chunk_bytes:
+                        break
+                    self.logger.debug("  Read {}".format(sizeof_fmt(len(chunk_bytes))))
+                    job = WBHChunkJob(index=chunk_i, data=chunk_bytes)
+                job.is_registered = chunk_i in registered_indexes
+                yield job
+                chunk_i += 1
+
+        def read_blocks(job: WBHChunkJob):
+            """ Read chunk of job from original file, in blocks of local_block_size """
+            with open(item_wbhi.full_path, 'rb') as chunk_file_r:
+                chunk_file_r.seek(job.index * chunk_size)
+                remaining = job.size
+                while remaining > 0:
+                    block = chunk_file_r.read(min(self.local_block_size, remaining))
+                    if not block:
+                        raise IOError(f"`{item_wbhi.full_path}` got smaller while it was sent")
+                    remaining -= len(block)
+                    yield block
+
+        def temp_path(job: WBHChunkJob) -> str:
+            return os.path.join(temp_dir, self.chunk_filename(item_wbhi, job.index))
+
+        def hash_chunk_blocks(job: WBHChunkJob):
+            """ Same as hash_chunk in local mode. A chunk that is sent as it is, is copied to temp_dir meanwhile """
+            chunk_hash = hashlib.sha256()
+            if not job.is_registered and encryption_type == EncryptionType.NONE:
+                # A chunk that is the whole file as it is, can be read by a local Bot API server from the queue
+                job.path = item_wbhi.full_path if job.size == org_size else temp_path(job)
+            is_copied = job.path is not None and job.path != item_wbhi.full_path
+            with open(job.path, 'wb') if is_copied else nullcontext() as chunk_file_w:
+                for block in read_blocks(job):
+                    get_checksum_sha256(chunk=block, running_hash=file_hash)
+                    get_checksum_sha256(chunk=block, running_hash=chunk_hash)
+                    if is_copied:
+                        chunk_file_w.write(block)
+            hashed_size[0] += job.size
+            if not job.is_registered:
+                job.checksum = chunk_hash.hexdigest()
+
+        def hash_chunk(job: WBHChunkJob):
+            if job.data is None:
+                return hash_chunk_blocks(job)
+            # Update checksum of whole file, jobs arrive in order
+            get_checksum_sha256(chunk=job.data, running_hash=file_hash)
+            hashed_size[0] += len(job.data)
+            if job.is_registered:
+                job.data = None
+                return
+            # get checksum before encryption
+            job.checksum = get_checksum_sha256(job.data)
+
+        def encrypt_chunk(job: WBHChunkJob):
+            # Check Encryption
+            if not job.is_registered and encryption_type == EncryptionType.ChaCha20Poly1305:
+                # Encrypt chunk data
+                self.logger.debug("Encrypting chunk using ChaCha20Poly1305 ...")
+                if job.data is None:
+                    # Local mode: encrypted from disk to temp_dir a block at a time
+                    job.path = temp_path(job)
+                    with open(job.path, 'wb') as chunk_file_w:
+                        job.size, key, nonce = chacha20poly1305_encrypt_blocks(
+                            blocks=read_blocks(job), f_w=chunk_file_w, secret=encryption_secret.encode())
+                else:
+                    job.data, key, nonce = chacha20poly1305_encrypt_data(data=job.data,
+                                                                         secret=encryption_secret.encode())
+                    job.size = len(job.data)
+                job.encryption_data = '{}O{}'.format(key.hex(), nonce.hex())
+
+        def new_chunk(job: WBHChunkJob):
+            chunk_filename = self.chunk_filename(item_wbhi, job.index)
+            job.chunk = WBHChunk(size=job.size,
+                                 filename=chunk_filename,
+                                 index=job.index,
+                                 org_filename=os.path.split(item_wbhi.full_path)[1],
+                                 org_fullpath=None,
+                                 org_size=org_size,
+                                 msg_id=None,
+                                 state=QueueState.UPLOADING,
+                                 checksum=job.checksum,
+                                 checksum_type=ChecksumType.SHA256,
+                                 encryption=encryption_type,
+                                 encryption_data=job.encryption_data,
+                                 parent_qid=item_wbhi.parent_qid,
+                                 parent_db_id=item_wbhi.db_id)
+            self.logger.debug(f"  Sending `{chunk_filename}` to BlackHole")
+
+        def register_chunk(job: WBHChunkJob, is_sent: bool):
+            spill_path = temp_path(job)
+            if not is_sent:
+                # Spill chunk to disk, so it can be sent again even after a restart
+                job.chunk.org_fullpath = spill_path
+                if job.path is None:
+                    with open(spill_path, 'wb') as chunk_file_w:
+                        chunk_file_w.write(job.data)
+                elif job.path != spill_path:
+                    shutil.copyfile(job.path, spill_path)
+                self.logger.debug("  Wrote {} to `{}` file".format(sizeof_fmt(job.size), job.chunk.filename))
+            elif job.path == spill_path:
+                # Sent from its copy in temp_dir
+                os.remove(spill_path)
+            job.data = None
+            # Register chunk at its index
+            if queued:
+                blackhole.queue.add_chunk(item_wbhi, job.chunk)
+                # Save queue
+                blackhole.queue.save()
+            else:
+                with blackhole.queue.lock:
+                    item_wbhi.add_chunk(job.chunk)
+            if not is_sent:
+                raise IOError(f"chunk#{job.index} is kept as `{job.chunk.org_fullpath}` to be sent later")
+
+        def upload_chunk(job: WBHChunkJob):
+            if job.is_registered:
+                return
+            new_chunk(job)
+            is_sent = self.send_chunk_data(chunk=job.chunk, data=job.data, blackhole=blackhole, path=job.path)
+            register_chunk(job, is_sent)
+
+        # (job, future) of uploads submitted to async transports and not registered yet, only used by one thread at
+        # a time: the single upload worker, then the caller once pipeline is done
+        in_flight = []
+
+        def register_uploads(max_in_flight: int):
+            """ Register uploads that are done, waiting for some while more than max_in_flight are in flight """
+            errors = []
+            while in_flight:
+                done, _ = concurrent.futures.wait([future for _, future in in_flight],
+                                                  timeout=None if len(in_flight) > max_in_flight else 0,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done:
+                    break
+                for job, future in [(job, future) for job, future in in_flight if future in done]:
+                    in_flight.remove((job, future))
+                    try:
+                        register_chunk(job, self._on_chunk_sent(job.chunk, future.result()))
+                    except Exception as e:
+                        errors.append(str(e))
+            if errors:
+                raise IOError(', '.join(errors))
+
+        def submit_chunk(job: WBHChunkJob):
+            if job.is_registered:
+                return
+            new_chunk(job)
+            file_open = self._chunk_data_open(job.data, job.path)
+            in_flight.append((job, self.submit_chunk(file_open=file_open, chunk=job.chunk,
+                                                     telegram_id=blackhole.telegram_id)))
+            # Next job is read while up to parallel_chunks uploads are in flight
+            register_uploads(max_in_flight=parallel_chunks - 1)
+
+        pipeline = WBHPipeline(name=f"send-{item_wbhi.filename}", logger=self.logger)
+        pipeline.add_stage('hash', hash_chunk)
+        pipeline.add_stage('encrypt', encrypt_chunk)
+        if self.is_async:
+            # A single thread keeps parallel_chunks uploads in flight on event loops of transports
+            pipeline.add_stage('upload', submit_chunk)
+        else:
+            pipeline.add_stage('upload', upload_chunk, workers=parallel_chunks)
+        # Each blackhole has a single uploader, so its last pipeline is not overwritten by another thread
+        blackhole.pipeline = pipeline
+        is_all_successful = False
         try:
             # Open Original File
             with open(item_wbhi.full_path, 'rb') as org_file:
-                # Seek to the start position of last existing chunk if exist.
-                org_file.seek(chunk_i * chunk_size)
-                while True:
-                    # Read a chunk
-                    chunk_bytes = org_file.read(chunk_size)
-                    if chunk_bytes:
-                        # get checksum before encryption
-                        checksum = get_checksum_sha256(chunk_bytes)
-                        # Check Encryption
-                        encryption_data = None
-                        if encryption_type == EncryptionType.ChaCha20Poly1305:
-                            # Encrypt chunk data
-                            self.logger.debug("Encrypting chunk using ChaCha20Poly1305 ...")
-                            chunk_bytes, key, nonce = chacha20poly1305_encrypt_data(data=chunk_bytes,
-                                                                                    secret=encryption_secret.encode())
-                            encryption_data = '{}O{}'.format(key.hex(), nonce.hex())
-
-                        chunk_filename = "WBHTF{}.p{:04d}".format(datetime.today().strftime('%Y%m%d%H%M%S%f'), chunk_i)
-                        chunk = WBHChunk(size=len(chunk_bytes),
-                                         filename=chunk_filename,
-                                         index=chunk_i,
-                                         org_filename=os.path.split(item_wbhi.full_path)[1],
-                                         org_fullpath=os.path.join(temp_dir, chunk_filename),
-                                         org_size=os.fstat(org_file.fileno()).st_size,
-                                         msg_id=None,
-                                         state=QueueState.UPLOADING,
-                                         checksum=checksum,
-                                         checksum_type=ChecksumType.SHA256,
-                                         encryption=encryption_type,
-                                         encryption_data=encryption_data,
-                                         parent_qid=item_wbhi.parent_qid,
-                                         parent_db_id=item_wbhi.db_id)
-                        self.logger.debug("  Read {}".format(sizeof_fmt(chunk.size)))
-                        try:
-                            # Open chunk file to write
-                            with open(chunk.org_fullpath, 'wb') as chunk_file_w:
-                                # write to chunk file
-                                chunk_file_w.write(chunk_bytes)
-                                self.logger.debug("  Wrote {} to `{}` file"
-                                                  .format(sizeof_fmt(len(chunk_bytes)), chunk.filename))
-                            self.logger.debug(f"  Sending `{chunk.filename}` file to BlackHole")
-                            # Send chunk file to blackhole
-                            self.send_chunk_file(chunk=chunk, blackhole=blackhole)
-                            # Add to chunks list
-                            item_wbhi.chunks.append(chunk)
-                            if delay_between_chunks > 0:
-                                self.logger.debug(f"Rest for {delay_between_chunks} secs...")
-                                time.sleep(delay_between_chunks)
-                        except Exception as e:
-                            is_all_successful = False
-                            self.logger.error(
-                                f"  ERROR: Could not send chunk#{chunk_i} `{chunk_filename}` to BlackHole: {str(e)}")
-                    else:
-                        break
-                    chunk_i += 1
+                org_size = os.fstat(org_file.fileno()).st_size
+                is_all_successful = pipeline.run(source=read_chunks(org_file), stop_event=stop_event)
+            if in_flight:
+                try:
+                    register_uploads(max_in_flight=0)
+                except IOError as e:
+                    is_all_successful = False
+                    self.logger.error(f"  ERROR: Pipeline `{pipeline.name}` stage `upload` failed: {str(e)}")
+            if hashed_size[0] == org_size:
+                item_wbhi.checksum = file_hash.hexdigest()
+                item_wbhi.checksum_type = ChecksumType.SHA256
         except Exception as e:
-            is_all_successful = False
             self.logger.error(f"  ERROR: Could not send `{item_wbhi.full_path}` to BlackHole: {str(e)}")
+        self.logger.debug(f"  Pipeline of `{item_wbhi.filename}`: {pipeline.stats_str()}")
+        self.logger.debug(f"  Bot API: {self.stats_str()}")
         return is_all_successful
 
 
+    def close(self):
+        """ Close connections of async transports """
+        for bot in self.bots:
+            bot.close()
+
+
+    def stats(self) -> list:
+        """ return list of per-bot stats (health and Bot API calls) """
+        now = time.monotonic()
+        return [dict(bot.scheduler.stats(), bot_id=bot.id, in_flight=bot.in_flight, failures=bot.failures,
+                     healthy=bot.unhealthy_until <= now)
+                for bot in self.bots]
+
+
+    def stats_str(self) -> str:
+        return ', '.join("bot {}{}: {}".format(bot.id, '' if bot.unhealthy_until <= time.monotonic() else
+                                               ' (left out)', bot.scheduler.stats_str())
+                         for bot in self.bots)
+
+
     def send_msg(self, chat_id, text, parse_mode=telegram.ParseMode.MARKDOWN):
-        return self.updater.bot.send_message(chat_id=chat_id,
-                                             text=text,
-                                             parse_mode=parse_mode)
+        with self.use_bot() as bot:
+            return bot.scheduler.call(chat_id, bot.api.send_message, chat_id=chat_id, text=text,
+                                      parse_mode=parse_mode)
 
 
-    def get_file_by_id(self, file_id, path_to_save: str):
-        file = self.updater.bot.get_file(file_id)
-        return file.download(path_to_save)
+    def _own_file_id(self, bot: WBHPoolBot, file_id, owner_bot_id, chat_id, msg_id):
+        """ return file_id for bot, file_ids of another bot are looked up by forwarding their message """
+        if owner_bot_id in (None, bot.id) or chat_id is None or msg_id is None:
+            return file_id
+        if (bot.id, file_id) not in self.file_ids:
+            msg = bot.scheduler.call(chat_id, bot.api.forward_message, chat_id=chat_id,
+                                     from_chat_id=chat_id, message_id=msg_id, disable_notification=True)
+            try:
+                bot.scheduler.call(chat_id, bot.api.delete_message, chat_id=chat_id,
+                                   message_id=msg.message_id)
+            except Exception as e:
+                self.logger.warning("Can not delete forwarded message `{}`: {}".format(msg.message_id, str(e)))
+            self.file_ids[(bot.id, file_id)] = msg.document.file_id
+        return self.file_ids[(bot.id, file_id)]
+
+
+    def get_file_by_id(self, file_id, path_to_save: str, bot_id=None, chat_id=None, msg_id=None):
+        """
+        Download file by bot_id that sent it, or by another bot if it is not healthy (needs chat_id and msg_id of
+        message of file). file_ids without bot_id belong to first bot
+        """
+        owner_bot_id = bot_id if bot_id is not None else self.bots[0].id
+        with self.use_bot(owner_bot_id) as bot:
+            own_file_id = self._own_file_id(bot, file_id, owner_bot_id, chat_id, msg_id)
+            file = bot.scheduler.call(None, bot.api.get_file, own_file_id)
+            return bot.download(file, path_to_save)
 
 
-    def get_chunk(self, chunk: WBHDbChunks, path_to_save: str):
+    def get_chunk(self, chunk: WBHDbChunks, path_to_save: str, chat_id=None):
+        """ chat_id is telegram_id of chunk's blackhole, to find chunk by another bot """
         try:
-            return self.get_file_by_id(chunk.file_id, path_to_save)
+            return self.get_file_by_id(chunk.file_id, path_to_save, bot_id=chunk.bot_id, chat_id=chat_id,
+                                       msg_id=chunk.msg_id)
         except Exception as e:
             self.logger.error("  ERROR: Could not download chunk#{} by name of `{}` from BlackHole: {}"
                               .format(chunk.index, chunk.filename, str(e)))
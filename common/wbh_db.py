@@ -1,12 +1,20 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
+import base64
+import binascii
 import datetime
 import logging
+import sqlite3
+from contextlib import contextmanager
 
-from sqlalchemy import BigInteger, Boolean, Column, DateTime, ForeignKey, Integer, String, create_engine
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, ForeignKey, Integer, LargeBinary, String, TypeDecorator, \
+    create_engine, event, func, select, text as text_sql
 from sqlalchemy.dialects.sqlite import SMALLINT
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import lazyload, noload, relationship, sessionmaker
+from sqlalchemy.orm import noload, raiseload, relationship, selectinload, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.pool import QueuePool
 
 from common.helper import sizeof_fmt
 from wublackhole.wbh_item import WBHChunk, WBHItem
@@ -15,6 +23,98 @@ from wublackhole.wbh_item import WBHChunk, WBHItem
 Base = declarative_base()
 
 
+def hex_to_blob(value):
+    """ return bytes of a hex string, value itself if it is not a hex string """
+    if isinstance(value, str):
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            pass
+    return value
+
+
+def encryption_data_to_blob(value):
+    """ return `KEYHEXONONCEHEX` as length of key, key and nonce in bytes, value itself if it is not in that form """
+    if isinstance(value, str):
+        try:
+            key_hex, nonce_hex = value.split('O')
+            key = bytes.fromhex(key_hex)
+            if len(key) < 256:
+                return bytes([len(key)]) + key + bytes.fromhex(nonce_hex)
+        except ValueError:
+            pass
+    return value
+
+
+def file_id_to_blob(value):
+    """ return bytes of a telegram file_id (unpadded urlsafe base64), value itself if it can not be restored exactly """
+    if isinstance(value, str):
+        try:
+            blob = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+            if base64.urlsafe_b64encode(blob).decode('ascii').rstrip('=') == value:
+                return blob
+        except (binascii.Error, ValueError):
+            pass
+    return value
+
+
+class RawBlob(LargeBinary):
+    """ BLOB that passes values to and from sqlite3 as they are, so text values that are kept as text still load """
+
+
+    def bind_processor(self, dialect):
+        return None
+
+
+    def result_processor(self, dialect, coltype):
+        return None
+
+
+class HexBlob(TypeDecorator):
+    """ Hex string in python, bytes in database. e.g. checksums """
+    impl = RawBlob
+    cache_ok = True
+
+
+    def process_bind_param(self, value, dialect):
+        return hex_to_blob(value)
+
+
+    def process_result_value(self, value, dialect):
+        return value.hex() if isinstance(value, bytes) else value
+
+
+class EncryptionDataBlob(TypeDecorator):
+    """ `KEYHEXONONCEHEX` in python, length of key, key and nonce in database """
+    impl = RawBlob
+    cache_ok = True
+
+
+    def process_bind_param(self, value, dialect):
+        return encryption_data_to_blob(value)
+
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes) and value:
+            key_len = value[0]
+            return '{}O{}'.format(value[1:key_len + 1].hex(), value[key_len + 1:].hex())
+        return value
+
+
+class FileIdBlob(TypeDecorator):
+    """ Telegram file_id in python, decoded bytes in database. file_ids that can not be decoded exactly stay text """
+    impl = RawBlob
+    cache_ok = True
+
+
+    def process_bind_param(self, value, dialect):
+        return file_id_to_blob(value)
+
+
+    def process_result_value(self, value, dialect):
+        return base64.urlsafe_b64encode(value).decode('ascii').rstrip('=') if isinstance(value, bytes) else value
+
+
 class WBHDbItems(Base):
     __tablename__ = 'items'
 
@@ -24,7 +124,7 @@ class WBHDbItems(Base):
     size = Column(BigInteger)
     items_count = Column(BigInteger)
     chunks_count = Column(BigInteger)
-    checksum = Column(String)
+    checksum = Column(HexBlob)
     checksum_type = Column(SMALLINT)
     root_path = Column(String)
     full_path = Column(String)
@@ -51,14 +151,15 @@ class WBHDbChunks(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
     msg_id = Column(BigInteger)
-    file_id = Column(String)
+    file_id = Column(FileIdBlob)
     filename = Column(String)
     size = Column(BigInteger)
     index = Column(BigInteger)
-    checksum = Column(String)
+    checksum = Column(HexBlob)
     checksum_type = Column(SMALLINT)
     encryption = Column(SMALLINT)
-    encryption_data = Column(String)
+    encryption_data = Column(EncryptionDataBlob)
+    bot_id = Column(BigInteger)
     uploaded_at = Column(DateTime, default=datetime.datetime.utcnow)
     # blackhole - One To Many
     blackhole_id = Column(BigInteger, ForeignKey('blackholes.id'))
@@ -89,82 +190,377 @@ class WBHDbBlackHoles(Base):
 
 
 class WBHDatabase:
-    def __init__(self, db_path, logger: logging.Logger, echo=False):
+    """
+    Each method runs in its own unit of work (see session_scope) on a pooled engine, so sessions and connections are
+    handed back as soon as the method returns. Returned objects are detached from their session: only columns and
+    relationships that are loaded by the method are available on them.
+    """
+    # Rows per insert statement of bulk methods
+    bulk_batch_size = 10000
+    # Applied on every new connection, overridden by pragmas given to constructor
+    default_pragmas = {
+        'journal_mode': 'wal',  # Readers and writer do not block each other
+        'synchronous': 'normal',  # In WAL mode commits are not fsynced, database still stays consistent on a crash
+        'mmap_size': 268435456,  # bytes
+        'cache_size': -65536,  # Negative is KiB, not pages
+        'temp_store': 'memory',
+        'busy_timeout': 5000,  # ms to wait for a lock held by another connection
+    }
+    # Schema upgrades, applied in order to databases created by older versions. `user_version` of database holds
+    # number of applied upgrades. Each one is a list of SQL statements or functions called with the connection.
+    # Statements must be safe to run again, as an interrupted upgrade is run again.
+    migrations = [
+        # 1: Indexes for lookups of explorer and downloads
+        ['CREATE INDEX IF NOT EXISTS items_parent_id ON items (parent_id, blackhole_id)',
+         'CREATE INDEX IF NOT EXISTS items_filename ON items (blackhole_id, filename)',
+         'CREATE INDEX IF NOT EXISTS chunks_items_id ON chunks (items_id, blackhole_id, "index")'],
+        # 2: Checksums, encryption data and file_ids as bytes instead of text
+        [lambda conn: WBHDatabase._compact_values(conn)],
+        # 3: Full-text index of names and paths for search_items
+        [lambda conn: WBHDatabase._create_search_index(conn)],
+        # 4: Bot that sent each chunk, file_ids are per bot
+        [lambda conn: WBHDatabase._add_column(conn, 'chunks', 'bot_id', 'BIGINT')],
+    ]
+    # Path of an item inside its blackhole, as it is indexed for search
+    search_path_sql = "CASE WHEN {0}.root_path IS NOT NULL AND substr({0}.full_path, 1, length({0}.root_path)) = " \
+                      "{0}.root_path THEN ltrim(substr({0}.full_path, length({0}.root_path) + 1), '/\\') " \
+                      "ELSE {0}.full_path END"
+
+
+    def __init__(self, db_path, logger: logging.Logger, echo=False, pool_size=4, pragmas: dict = None):
         self.logger = logger
         self._db_path = db_path
+        self.pragmas = dict(self.default_pragmas, **(pragmas or {}))
+
+        # initialize a database, connections are kept open and reused by threads one at a time
+        self.engine = create_engine('sqlite:///' + self._db_path, echo=echo,
+                                    poolclass=QueuePool, pool_size=pool_size, max_overflow=pool_size,
+                                    connect_args={'check_same_thread': False})
+        event.listen(self.engine, 'connect', self._on_connect)
+        # Objects keep their loaded values after commit, to be used once session is closed
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        Base.metadata.create_all(self.engine)
+        self.migrate()
+        # Without FTS5 (or its trigram tokenizer) in sqlite, search_items falls back to LIKE. Upgrade 3 could not
+        # create index then, so it is tried again on each start until sqlite has them
+        with self.engine.begin() as conn:
+            self.search_index = conn.exec_driver_sql(
+                "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'items_search'").scalar() > 0
+            if not self.search_index:
+                self.search_index = self._create_search_index(conn)
+        if not self.search_index:
+            self.logger.warning("SQLite has no FTS5 trigram tokenizer, search of items is not indexed")
+
+
+    def migrate(self):
+        """ Upgrade schema of database to latest version, in place """
+        upgraded = False
+        with self.engine.begin() as conn:
+            version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+            if version > len(self.migrations):
+                self.logger.warning("Database `{}` is of a newer version ({}) than this one ({})"
+                                    .format(self._db_path, version, len(self.migrations)))
+            for version, statements in enumerate(self.migrations[version:], start=version + 1):
+                self.logger.info("Upgrading database `{}` to version {}...".format(self._db_path, version))
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.exec_driver_sql(statement)
+                conn.exec_driver_sql('PRAGMA user_version = {}'.format(version))
+                upgraded = True
+        if upgraded:
+            # Give space freed by upgrades back to file system, VACUUM can not run inside a transaction
+            with self.engine.connect() as conn:
+                conn.execution_options(isolation_level='AUTOCOMMIT').exec_driver_sql('VACUUM')
+
+
+    @staticmethod
+    def _compact_values(conn):
+        """ Convert text values of columns stored as bytes, as written by older versions """
+        columns = {'items': {'checksum': hex_to_blob},
+                   'chunks': {'checksum': hex_to_blob,
+                              'encryption_data': encryption_data_to_blob,
+                              'file_id': file_id_to_blob}}
+        for table, converters in columns.items():
+            names = list(converters)
+            select_sql = 'SELECT id, {} FROM {} WHERE id > ? AND ({}) ORDER BY id LIMIT {}'.format(
+                ', '.join(names), table, ' OR '.join("typeof({}) = 'text'".format(n) for n in names),
+                WBHDatabase.bulk_batch_size)
+            update_sql = 'UPDATE {} SET {} WHERE id = ?'.format(table, ', '.join('{} = ?'.format(n) for n in names))
+            last_id = 0
+            while True:
+                rows = conn.exec_driver_sql(select_sql, (last_id,)).fetchall()
+                if not rows:
+                    break
+                conn.exec_driver_sql(update_sql, [tuple(converters[n](v) for n, v in zip(names, row[1:])) + (row[0],)
+                                                  for row in rows])
+                last_id = rows[-1][0]
+
+
+    @staticmethod
+    def _add_column(conn, table: str, column: str, column_type: str):
+        """ Add column to table, if it is not there (e.g. created by create_all) """
+        columns = [row[1] for row in conn.exec_driver_sql('PRAGMA table_info({})'.format(table))]
+        if column not in columns:
+            conn.exec_driver_sql('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, column_type))
+
+
+    @staticmethod
+    def _create_search_index(conn) -> bool:
+        """
+        Create a trigram index over name and path of items, kept up to date by triggers. return False if sqlite has
+        no FTS5 or its trigram tokenizer
+        """
+        try:
+            # Contentless, names are not stored twice
+            conn.exec_driver_sql("CREATE VIRTUAL TABLE IF NOT EXISTS items_search "
+                                 "USING fts5(filename, path, content='', tokenize='trigram')")
+        except OperationalError:
+            return False
+        new_path = WBHDatabase.search_path_sql.format('new')
+        old_path = WBHDatabase.search_path_sql.format('old')
+        insert_sql = "INSERT INTO items_search (rowid, filename, path) VALUES (new.id, new.filename, {});".format(
+            new_path)
+        delete_sql = "INSERT INTO items_search (items_search, rowid, filename, path) " \
+                     "VALUES ('delete', old.id, old.filename, {});".format(old_path)
+        conn.exec_driver_sql("CREATE TRIGGER IF NOT EXISTS items_search_insert AFTER INSERT ON items "
+                             "BEGIN {} END".format(insert_sql))
+        conn.exec_driver_sql("CREATE TRIGGER IF NOT EXISTS items_search_delete AFTER DELETE ON items "
+                             "BEGIN {} END".format(delete_sql))
+        conn.exec_driver_sql("CREATE TRIGGER IF NOT EXISTS items_search_update "
+                             "AFTER UPDATE OF filename, full_path, root_path ON items "
+                             "BEGIN {} {} END".format(delete_sql, insert_sql))
+        # Index items that already exist
+        conn.exec_driver_sql("INSERT INTO items_search (items_search) VALUES ('delete-all')")
+        conn.exec_driver_sql("INSERT INTO items_search (rowid, filename, path) SELECT id, filename, {} FROM items"
+                             .format(WBHDatabase.search_path_sql.format('items')))
+        return True
+
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+
+
+    @contextmanager
+    def session_scope(self):
+        """ Yield a session that is committed on success, rolled back on error and always closed """
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
-        # Check existance of db variable
-        if 'engine' not in locals():
-            # initialize a database
-            self.engine = create_engine('sqlite:///' + self._db_path, echo=echo)
-            self.conn = self.engine.connect()
-            self.Session = sessionmaker(bind=self.engine)
-            Base.metadata.create_all(self.engine)
+
+    def close(self):
+        """ Close every pooled connection, e.g. to release database file. Database can still be used afterwards """
+        self.engine.dispose()
 
 
     def get_db_filepath(self):
         return self._db_path
 
 
+    def backup_to(self, filepath: str) -> bool:
+        """
+        Write a consistent copy of database to a single file, including changes that are still in WAL file.
+        Database can be written meanwhile. return True if successful
+        """
+        try:
+            self.logger.debug("Backup database to `{}`".format(filepath))
+            raw_connection = self.engine.raw_connection()
+            try:
+                # Move committed changes from WAL into database file, to keep WAL file short
+                raw_connection.dbapi_connection.execute('PRAGMA wal_checkpoint(PASSIVE)')
+                backup_connection = sqlite3.connect(filepath)
+                try:
+                    raw_connection.dbapi_connection.backup(backup_connection)
+                    # Copy does not need a WAL file next to it
+                    backup_connection.execute('PRAGMA journal_mode = delete')
+                finally:
+                    backup_connection.close()
+            finally:
+                raw_connection.close()
+            return True
+        except Exception as e:
+            self.logger.error("  ERROR: Can not backup database to `{}`:\n {}".format(filepath, str(e)))
+        return False
+
+
     def add_blackhole(self, name: str, size: int, telegram_id: str):
         bh_new = WBHDbBlackHoles(name=name,
-                                      size=size,
-                                      telegram_id=telegram_id)
-        session = self.Session()
-        session.add(bh_new)
-        session.commit()
+                                 size=size,
+                                 telegram_id=telegram_id)
+        with self.session_scope() as session:
+            session.add(bh_new)
         return bh_new
 
 
     def get_blackholes(self):
-        session = self.Session()
-        return session.query(WBHDbBlackHoles) \
-            .options(noload(WBHDbBlackHoles.items)) \
-            .all()
+        with self.session_scope() as session:
+            return session.query(WBHDbBlackHoles) \
+                .options(noload(WBHDbBlackHoles.items)) \
+                .all()
 
 
     def get_blackhole_by_name(self, name: str):
-        session = self.Session()
-        return session.query(WBHDbBlackHoles) \
-            .options(noload(WBHDbBlackHoles.items)) \
-            .filter_by(name=name) \
-            .first()
+        with self.session_scope() as session:
+            return session.query(WBHDbBlackHoles) \
+                .options(noload(WBHDbBlackHoles.items)) \
+                .filter_by(name=name) \
+                .first()
 
 
     def get_blackhole_by_id(self, _id):
-        session = self.Session()
-        return session.query(WBHDbBlackHoles).options(noload(WBHDbBlackHoles.items)).filter_by(id=_id).first()
+        with self.session_scope() as session:
+            return session.query(WBHDbBlackHoles).options(noload(WBHDbBlackHoles.items)).filter_by(id=_id).first()
 
 
     def recalculate_blackhole_size(self, bh_id):
+        """ Set size of blackhole to sum of its top level items, folders already hold size of their content """
         try:
-            session = self.Session()
-            bh: WBHDbBlackHoles = session.query(WBHDbBlackHoles) \
-                .options(lazyload(WBHDbBlackHoles.items)) \
-                .filter_by(id=bh_id) \
-                .first()
-            bh.size = 0
-            itm: WBHDbItems
-            for itm in bh.items:
-                bh.size += itm.size
-            session.commit()
+            with self.session_scope() as session:
+                bh: WBHDbBlackHoles = session.query(WBHDbBlackHoles) \
+                    .options(noload(WBHDbBlackHoles.items)) \
+                    .filter_by(id=bh_id) \
+                    .first()
+                bh.size = session.query(func.coalesce(func.sum(WBHDbItems.size), 0)) \
+                    .filter_by(blackhole_id=bh_id, parent_id=None) \
+                    .scalar()
             self.logger.debug("Blackhole `{}` size recalculated: {}".format(bh.name, sizeof_fmt(bh.size)))
         except Exception as e:
             self.logger.error(
                 "  ERROR: could not recalculate blackhole by id of {}:\n {}".format(bh_id, str(e)))
 
 
-    def add_item_folder(self, item: WBHItem, blackhole_id, parent_item):
+    def recalculate_folders(self, bh_id):
+        """ Set size and items_count of every folder of blackhole from its content in database """
         try:
-            if item.is_dir:
-                res = self.add_item(item, blackhole_id, None)
-                for child in item.children:
-                    self.add_item_folder(child, blackhole_id, res.id)
-            else:
-                self.add_item(item, blackhole_id, parent_item)
+            with self.session_scope() as session:
+                rows = session.query(WBHDbItems.id, WBHDbItems.parent_id, WBHDbItems.is_dir, WBHDbItems.size) \
+                    .filter_by(blackhole_id=bh_id) \
+                    .all()
+                children = {}
+                for row in rows:
+                    children.setdefault(row.parent_id, []).append(row)
+                folders = []
+
+                def aggregate(folder_id):
+                    """ return (size, files count) of folder, Recursively """
+                    size = 0
+                    count = 0
+                    for child in children.get(folder_id, []):
+                        if child.is_dir:
+                            child_size, child_count = aggregate(child.id)
+                        else:
+                            child_size, child_count = child.size or 0, 1
+                        size += child_size
+                        count += child_count
+                    folders.append({'id': folder_id, 'size': size, 'items_count': count})
+                    return size, count
+
+                for row in rows:
+                    if row.is_dir and row.parent_id is None:
+                        aggregate(row.id)
+                session.bulk_update_mappings(WBHDbItems, folders)
+            self.logger.debug("{} folders of blackhole by id of {} recalculated".format(len(folders), bh_id))
         except Exception as e:
             self.logger.error(
-                "  ERROR: Can not add folder `{}` to database:\n {}".format(item.full_path, str(e)))
+                "  ERROR: could not recalculate folders of blackhole by id of {}:\n {}".format(bh_id, str(e)))
+
+
+    def repair_aggregates(self):
+        """ Rebuild size of every blackhole and size/items_count of every folder from items in database """
+        bh: WBHDbBlackHoles
+        for bh in self.get_blackholes():
+            self.logger.info("Repairing sizes of blackhole `{}`...".format(bh.name))
+            self.recalculate_folders(bh_id=bh.id)
+            self.recalculate_blackhole_size(bh_id=bh.id)
+
+
+    @staticmethod
+    def _item_values(item_wbhi: WBHItem, blackhole_id, parent_id) -> dict:
+        """ return column values of item in database """
+        values = {'filename': item_wbhi.filename,
+                  'is_dir': item_wbhi.is_dir,
+                  'size': item_wbhi.size,
+                  'checksum': item_wbhi.checksum,
+                  'checksum_type': item_wbhi.checksum_type.value,
+                  'root_path': item_wbhi.root_path,
+                  'full_path': item_wbhi.full_path,
+                  'blackhole_id': blackhole_id,
+                  'parent_id': parent_id,
+                  'created_at': datetime.datetime.fromtimestamp(item_wbhi.created_at),
+                  'modified_at': datetime.datetime.fromtimestamp(item_wbhi.modified_at),
+                  'items_count': None,
+                  'chunks_count': None}
+        if item_wbhi.is_dir:
+            # item_counts for directories
+            values['items_count'] = item_wbhi.total_children
+        else:
+            # chunks_count for files
+            if item_wbhi.chunks:
+                values['chunks_count'] = len(item_wbhi.chunks)
+        return values
+
+
+    @staticmethod
+    def _add_blackhole_size(session, blackhole_id, size: int):
+        """ Add size of a top level item to blackhole size. Being a write, it also starts the transaction """
+        session.query(WBHDbBlackHoles) \
+            .filter_by(id=blackhole_id) \
+            .update({WBHDbBlackHoles.size: func.max(func.coalesce(WBHDbBlackHoles.size, 0), 0) + max(size, 0)},
+                    synchronize_session=False)
+
+
+    def add_items_bulk(self, items, blackhole_id, parent_id) -> int:
+        """
+        Add items to database in one transaction, with batched inserts. items can be any iterable (e.g. a generator
+        over a queue subtree), it is read once and only ids of folders are kept. Each item's parent is found by its
+        parent_qid among earlier folders (parents first), otherwise it is parent_id. Items get consecutive ids in
+        their order. return id of first item if successful, None on error (nothing is added then)
+        """
+        count = 0
+        try:
+            self.logger.debug("Adding items to Database")
+            # qid -> id of folders, to find parent of next items
+            dir_ids = {}
+            top_level_size = 0
+            with self.session_scope() as session:
+                # Take write lock first, so ids allocated below can not be taken by another writer
+                self._add_blackhole_size(session, blackhole_id, 0)
+                first_id = session.query(func.coalesce(func.max(WBHDbItems.id), 0)).scalar() + 1
+                rows = []
+                item_wbhi: WBHItem
+                for item_wbhi in items:
+                    is_top_level = item_wbhi.parent_qid not in dir_ids
+                    values = self._item_values(item_wbhi, blackhole_id, dir_ids.get(item_wbhi.parent_qid, parent_id))
+                    values['id'] = first_id + count
+                    if item_wbhi.is_dir:
+                        dir_ids[item_wbhi.qid] = values['id']
+                    if is_top_level and parent_id is None:
+                        # Folders already hold size of their content, so only top level items add to blackhole size
+                        top_level_size += item_wbhi.size
+                    count += 1
+                    rows.append(values)
+                    if len(rows) >= self.bulk_batch_size:
+                        session.execute(WBHDbItems.__table__.insert(), rows)
+                        rows = []
+                if rows:
+                    session.execute(WBHDbItems.__table__.insert(), rows)
+                self._add_blackhole_size(session, blackhole_id, top_level_size)
+            self.logger.debug("{} items added to Database.".format(count))
+            return first_id
+        except Exception as e:
+            self.logger.error("  ERROR: Can not add {} items to database:\n {}".format(count, str(e)))
+        return None
 
 
     def add_item(self, item_wbhi: WBHItem, blackhole_id, parent_id):
@@ -172,31 +568,14 @@ class WBHDatabase:
         new_item = None
         try:
             self.logger.debug("Adding item `{}` to Database".format(item_wbhi.filename))
-            session = self.Session()
-            new_item = WBHDbItems(filename=item_wbhi.filename,
-                                       is_dir=item_wbhi.is_dir,
-                                       size=item_wbhi.size,
-                                       checksum=item_wbhi.checksum,
-                                       checksum_type=item_wbhi.checksum_type.value,
-                                       root_path=item_wbhi.root_path,
-                                       full_path=item_wbhi.full_path,
-                                       blackhole_id=blackhole_id,
-                                       parent_id=parent_id,
-                                       created_at=datetime.datetime.fromtimestamp(item_wbhi.created_at),
-                                       modified_at=datetime.datetime.fromtimestamp(item_wbhi.modified_at))
-            if item_wbhi.is_dir:
-                # item_counts for directories
-                new_item.items_count = item_wbhi.total_children
-            else:
-                # chunks_count for files
-                if item_wbhi.chunks:
-                    new_item.chunks_count = len(item_wbhi.chunks)
+            new_item = WBHDbItems(**self._item_values(item_wbhi, blackhole_id, parent_id))
             # Add/Commit item to database
-            session.add(new_item)
-            session.commit()
+            with self.session_scope() as session:
+                session.add(new_item)
+                if parent_id is None:
+                    # Folders already hold size of their content, so only top level items add to blackhole size
+                    self._add_blackhole_size(session, blackhole_id, item_wbhi.size)
             self.logger.debug("Item `{}` added to Database.".format(item_wbhi.filename))
-            # TODO: Replace it with adding this item size to blackhole size it.
-            self.recalculate_blackhole_size(bh_id=blackhole_id)
         except Exception as e:
             self.logger.error(
                 "  ERROR: Can not add item `{}` to database:\n {}".format(item_wbhi.full_path, str(e)))
@@ -204,50 +583,144 @@ class WBHDatabase:
 
 
     def get_items_by_parent_id(self, blackhole_id, items_parent=None):
-        session = self.Session()
-        return session.query(WBHDbItems) \
-            .options(noload(WBHDbItems.items)) \
-            .options(noload(WBHDbItems.chunks)) \
-            .filter_by(blackhole_id=blackhole_id, parent_id=items_parent) \
-            .all()
+        with self.session_scope() as session:
+            return session.query(WBHDbItems) \
+                .options(noload(WBHDbItems.items)) \
+                .options(noload(WBHDbItems.chunks)) \
+                .filter_by(blackhole_id=blackhole_id, parent_id=items_parent) \
+                .all()
 
     def get_items_by_filename(self, blackhole_id, filename):
-        session = self.Session()
-        return session.query(WBHDbItems) \
-            .options(noload(WBHDbItems.items)) \
-            .options(noload(WBHDbItems.chunks)) \
-            .filter_by(blackhole_id=blackhole_id, filename=filename) \
-            .all()
+        with self.session_scope() as session:
+            return session.query(WBHDbItems) \
+                .options(noload(WBHDbItems.items)) \
+                .options(noload(WBHDbItems.chunks)) \
+                .filter_by(blackhole_id=blackhole_id, filename=filename) \
+                .all()
+
+
+    def search_items(self, text: str, blackhole_id=None, in_path=False, limit=100, offset=0):
+        """
+        Search items whose name (or path inside blackhole, if in_path) contains every word of text, case-insensitive.
+        Searches all blackholes if blackhole_id is None. return a page of items ordered by id, None on error
+        """
+        try:
+            self.logger.debug("Search items for `{}` in database".format(text))
+            words = text.split()
+            if not words:
+                return []
+            # Trigram index only finds words of 3 or more characters, shorter ones are matched by LIKE
+            long_words = [w for w in words if len(w) >= 3] if self.search_index else []
+            short_words = [w for w in words if w not in long_words]
+            params = {'limit': limit, 'offset': offset}
+            where = []
+            if long_words:
+                sql = "SELECT items.id FROM items_search JOIN items ON items.id = items_search.rowid"
+                where.append("items_search MATCH :match")
+                params['match'] = '{{{}}} : ({})'.format('path' if in_path else 'filename',
+                                                         ' '.join('"{}"'.format(w.replace('"', '""'))
+                                                                  for w in long_words))
+                order_by = "items_search.rowid"
+            else:
+                sql = "SELECT items.id FROM items"
+                order_by = "items.id"
+            # Path inside blackhole, same as path column of search index, so root_path is not matched
+            like_column = self.search_path_sql.format('items') if in_path else 'items.filename'
+            for i, word in enumerate(short_words):
+                where.append("{} LIKE :like{} ESCAPE '\\'".format(like_column, i))
+                params['like{}'.format(i)] = '%{}%'.format(
+                    word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+            if blackhole_id is not None:
+                where.append("items.blackhole_id = :blackhole_id")
+                params['blackhole_id'] = blackhole_id
+            sql += " WHERE {} ORDER BY {} LIMIT :limit OFFSET :offset".format(' AND '.join(where), order_by)
+            with self.session_scope() as session:
+                ids = [row[0] for row in session.execute(text_sql(sql), params)]
+                return session.query(WBHDbItems) \
+                    .options(noload(WBHDbItems.items)) \
+                    .options(noload(WBHDbItems.chunks)) \
+                    .filter(WBHDbItems.id.in_(ids)) \
+                    .order_by(WBHDbItems.id) \
+                    .all()
+        except Exception as e:
+            self.logger.error("  ERROR: Can not search items for `{}` on database:\n {}".format(text, str(e)))
 
 
     def get_item_by_id(self, blackhole_id, item_id) -> WBHDbItems:
+        """
+        return item with its chunks and its children (with their chunks) loaded, None on error. Children of children
+        are not loaded, see get_item_tree
+        """
         try:
             self.logger.debug("Get item by id `{}` from database".format(item_id))
-            session = self.Session()
             # get item from database
-            return session.query(WBHDbItems) \
-                .filter_by(blackhole_id=blackhole_id, id=item_id) \
-                .options(lazyload(WBHDbItems.chunks)) \
-                .options(lazyload(WBHDbItems.items)) \
-                .first()
+            with self.session_scope() as session:
+                return session.query(WBHDbItems) \
+                    .filter_by(blackhole_id=blackhole_id, id=item_id) \
+                    .options(selectinload(WBHDbItems.chunks)) \
+                    .options(selectinload(WBHDbItems.items).selectinload(WBHDbItems.chunks)) \
+                    .options(selectinload(WBHDbItems.items).raiseload(WBHDbItems.items)) \
+                    .first()
         except Exception as e:
             self.logger.error("  ERROR: Can not get item by id `{}` from database:\n {}"
                               .format(item_id, str(e)))
 
 
+    def get_item_tree(self, blackhole_id, item_id) -> WBHDbItems:
+        """
+        return item with its whole content loaded: items of every folder (Recursively) and chunks of every file, in
+        order of their index. Whole subtree is read with two queries. None on error
+        """
+        try:
+            self.logger.debug("Get tree of item by id `{}` from database".format(item_id))
+            # ids of item and everything under it
+            subtree = select(WBHDbItems.id) \
+                .where(WBHDbItems.blackhole_id == blackhole_id, WBHDbItems.id == item_id) \
+                .cte('subtree', recursive=True)
+            subtree = subtree.union_all(select(WBHDbItems.id).where(WBHDbItems.parent_id == subtree.c.id))
+            with self.session_scope() as session:
+                items = session.query(WBHDbItems) \
+                    .filter(WBHDbItems.id.in_(select(subtree.c.id))) \
+                    .order_by(WBHDbItems.id) \
+                    .all()
+                chunks = session.query(WBHDbChunks) \
+                    .filter(WBHDbChunks.items_id.in_(select(subtree.c.id))) \
+                    .order_by(WBHDbChunks.items_id, WBHDbChunks.index) \
+                    .all()
+            # Link items and chunks together, as if relationships were loaded
+            children = {}
+            itm: WBHDbItems
+            for itm in items:
+                children.setdefault(itm.parent_id, []).append(itm)
+            items_chunks = {}
+            chunk: WBHDbChunks
+            for chunk in chunks:
+                items_chunks.setdefault(chunk.items_id, []).append(chunk)
+            root_item = None
+            for itm in items:
+                if itm.is_dir:
+                    set_committed_value(itm, 'items', children.get(itm.id, []))
+                else:
+                    set_committed_value(itm, 'chunks', items_chunks.get(itm.id, []))
+                if itm.id == item_id:
+                    root_item = itm
+            return root_item
+        except Exception as e:
+            self.logger.error("  ERROR: Can not get tree of item by id `{}` from database:\n {}"
+                              .format(item_id, str(e)))
+
+
     def update_item_chunk_count(self, item_wbhi: WBHItem, chunk_count):
         try:
             self.logger.debug("Update chunk_count for item `{}` in database".format(item_wbhi.filename))
-            session = self.Session()
-
             # Add/Commit item to database
-            item_db = session.query(WBHDbItems) \
-                .options(noload(WBHDbItems.items)) \
-                .options(noload(WBHDbItems.chunks)) \
-                .filter_by(id=item_wbhi.db_id) \
-                .first()
-            item_db.chunks_count = chunk_count
-            session.commit()
+            with self.session_scope() as session:
+                item_db = session.query(WBHDbItems) \
+                    .options(noload(WBHDbItems.items)) \
+                    .options(noload(WBHDbItems.chunks)) \
+                    .filter_by(id=item_wbhi.db_id) \
+                    .first()
+                item_db.chunks_count = chunk_count
             self.logger.debug(
                 "chunk_count for Item `{}` updated in Database to {}.".format(item_wbhi.filename, chunk_count))
         except Exception as e:
@@ -255,26 +728,52 @@ class WBHDatabase:
                               .format(item_wbhi.full_path, str(e)))
 
 
+    def update_item_checksum(self, item_wbhi: WBHItem):
+        """ Set checksum of an item that was added to database before its checksum was known """
+        try:
+            self.logger.debug("Update checksum for item `{}` in database".format(item_wbhi.filename))
+            # Add/Commit item to database
+            with self.session_scope() as session:
+                item_db = session.query(WBHDbItems) \
+                    .options(noload(WBHDbItems.items)) \
+                    .options(noload(WBHDbItems.chunks)) \
+                    .filter_by(id=item_wbhi.db_id) \
+                    .first()
+                item_db.checksum = item_wbhi.checksum
+                item_db.checksum_type = item_wbhi.checksum_type.value
+            self.logger.debug(
+                "checksum for Item `{}` updated in Database to {}.".format(item_wbhi.filename, item_wbhi.checksum))
+        except Exception as e:
+            self.logger.error("  ERROR: Can not update checksum for item `{}` on database:\n {}"
+                              .format(item_wbhi.full_path, str(e)))
+
+
+    @staticmethod
+    def _chunk_values(chunk: WBHChunk, blackhole_id, parent_id) -> dict:
+        """ return column values of chunk in database """
+        return {'msg_id': chunk.msg_id,
+                'file_id': chunk.file_id,
+                'filename': chunk.filename,
+                'size': chunk.size,
+                'index': chunk.index,
+                'checksum': chunk.checksum,
+                'checksum_type': chunk.checksum_type.value,
+                'encryption': chunk.encryption.value,
+                'encryption_data': chunk.encryption_data,
+                'bot_id': chunk.bot_id,
+                'blackhole_id': blackhole_id,
+                'items_id': parent_id}
+
+
     def add_chunk(self, chunk: WBHChunk, blackhole_id, parent_id):
         """ return id of chunk in database if successful, None on error"""
         new_chunk = None
         try:
             self.logger.debug("Adding chunk#{} of `{}` to Database".format(chunk.index, chunk.org_filename))
-            session = self.Session()
-            new_chunk = WBHDbChunks(msg_id=chunk.msg_id,
-                                         file_id=chunk.file_id,
-                                         filename=chunk.filename,
-                                         size=chunk.size,
-                                         index=chunk.index,
-                                         checksum=chunk.checksum,
-                                         checksum_type=chunk.checksum_type.value,
-                                         encryption=chunk.encryption.value,
-                                         encryption_data=chunk.encryption_data,
-                                         blackhole_id=blackhole_id,
-                                         items_id=parent_id)
+            new_chunk = WBHDbChunks(**self._chunk_values(chunk, blackhole_id, parent_id))
             # Add/Commit chunk to database
-            session.add(new_chunk)
-            session.commit()
+            with self.session_scope() as session:
+                session.add(new_chunk)
             self.logger.debug("chunk#{} of `{}` added to Database.".format(chunk.index, chunk.org_filename))
         except Exception as e:
             self.logger.error(
@@ -282,23 +781,42 @@ class WBHDatabase:
         return new_chunk.id if new_chunk else None
 
 
+    def add_chunks_bulk(self, chunks: list, blackhole_id, parent_id, chunks_count: int) -> bool:
+        """
+        Add chunks of an item to database and set chunks_count of item, in one transaction with batched inserts.
+        Generated ids are set on db_id of chunks. return True if successful, False on error (nothing is added then)
+        """
+        try:
+            self.logger.debug("Adding {} chunks of item id {} to Database".format(len(chunks), parent_id))
+            with self.session_scope() as session:
+                # Take write lock first, so ids allocated below can not be taken by another writer
+                session.query(WBHDbItems) \
+                    .filter_by(id=parent_id) \
+                    .update({WBHDbItems.chunks_count: chunks_count}, synchronize_session=False)
+                first_id = session.query(func.coalesce(func.max(WBHDbChunks.id), 0)).scalar() + 1
+                for i in range(0, len(chunks), self.bulk_batch_size):
+                    session.execute(WBHDbChunks.__table__.insert(),
+                                    [dict(self._chunk_values(chunk, blackhole_id, parent_id), id=first_id + i + j)
+                                     for j, chunk in enumerate(chunks[i:i + self.bulk_batch_size])])
+            chunk: WBHChunk
+            for i, chunk in enumerate(chunks):
+                chunk.db_id = first_id + i
+            self.logger.debug("{} chunks of item id {} added to Database.".format(len(chunks), parent_id))
+            return True
+        except Exception as e:
+            self.logger.error("  ERROR: Can not add {} chunks of item id {} to database:\n {}"
+                              .format(len(chunks), parent_id, str(e)))
+        return False
+
+
     def get_chunks_by_item_id(self, blackhole_id, item_id):
         try:
             self.logger.debug("Get chunks for item id `{}` from database".format(item_id))
-            session = self.Session()
             # get chunks from database
-            return session.query(WBHDbChunks) \
-                .filter_by(blackhole_id=blackhole_id, items_id=item_id) \
-                .all()
+            with self.session_scope() as session:
+                return session.query(WBHDbChunks) \
+                    .filter_by(blackhole_id=blackhole_id, items_id=item_id) \
+                    .all()
         except Exception as e:
             self.logger.error("  ERROR: Can not get chunks for item id `{}` on database:\n {}"
                               .format(item_id, str(e)))
-
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        pass
-        # Check existance of db variable
-        # if 'db' not in locals():
-        #     # Close database
-        #     self.db.close()
-        self.Session.close_all()
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import threading
+import time
+
+
+class WBHPipelineStage:
+    def __init__(self, name: str, func, workers: int = 1, queue_size: int = 1):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.0  # Time spent in func
+        self.idle_time = 0.0  # Time spent waiting for input
+        self.blocked_time = 0.0  # Time spent waiting for a free slot on next stage
+        self.max_queue_depth = 0
+        self._running_workers = 0
+
+
+    def stats(self) -> dict:
+        return {'name': self.name,
+                'workers': self.workers,
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'processed': self.processed,
+                'failed': self.failed,
+                'busy_time': self.busy_time,
+                'idle_time': self.idle_time,
+                'blocked_time': self.blocked_time}
+
+
+class WBHPipeline:
+    """
+    Producer/consumer pipeline: jobs from a source are passed through stages, each stage runs its own worker
+    thread(s) and is connected to the next one with a bounded queue. A job that raises in a stage is dropped.
+    """
+    _END = object()
+
+
+    def __init__(self, name: str, logger: logging.Logger = None):
+        self.name = name
+        self.logger = logger if logger else logging.getLogger()
+        self.stages: list = []
+        self.source_stage: WBHPipelineStage = None
+
+
+    def add_stage(self, name: str, func, workers: int = 1, queue_size: int = 1):
+        """ func(job) is called for each job. Order of jobs is kept only by stages with a single worker """
+        self.stages.append(WBHPipelineStage(name=name, func=func, workers=workers, queue_size=queue_size))
+
+
+    def _put(self, stage: WBHPipelineStage, index: int, job):
+        """ Put job on input queue of stage after given index, return time blocked """
+        if index + 1 >= len(self.stages):
+            return 0.0
+        next_stage: WBHPipelineStage = self.stages[index + 1]
+        start_t = time.perf_counter()
+        next_stage.queue.put(job)
+        blocked_t = time.perf_counter() - start_t
+        depth = next_stage.queue.qsize()
+        with next_stage.lock:
+            next_stage.max_queue_depth = max(next_stage.max_queue_depth, depth)
+        return blocked_t
+
+
+    def _worker(self, index: int):
+        stage: WBHPipelineStage = self.stages[index]
+        while True:
+            start_t = time.perf_counter()
+            job = stage.queue.get()
+            idle_t = time.perf_counter() - start_t
+            if job is WBHPipeline._END:
+                with stage.lock:
+                    stage.idle_time += idle_t
+                    stage._running_workers -= 1
+                    is_last_worker = stage._running_workers == 0
+                if is_last_worker and index + 1 < len(self.stages):
+                    # Let workers of next stage finish too
+                    for _ in range(self.stages[index + 1].workers):
+                        self.stages[index + 1].queue.put(WBHPipeline._END)
+                return
+            start_t = time.perf_counter()
+            try:
+                stage.func(job)
+                is_failed = False
+            except Exception as e:
+                is_failed = True
+                self.logger.error(f"  ERROR: Pipeline `{self.name}` stage `{stage.name}` failed: {str(e)}")
+            busy_t = time.perf_counter() - start_t
+            blocked_t = 0.0 if is_failed else self._put(stage, index, job)
+            with stage.lock:
+                stage.idle_time += idle_t
+                stage.busy_time += busy_t
+                stage.blocked_time += blocked_t
+                if is_failed:
+                    stage.failed += 1
+                else:
+                    stage.processed += 1
+
+
+    def run(self, source, source_name: str = 'read', stop_event: threading.Event = None) -> bool:
+        """
+        Iterate source on the caller thread and feed jobs to the stages, until source is exhausted or stop_event is
+        set. Blocks until every job left all stages. return True if no job failed and source was not stopped.
+        """
+        self.source_stage = WBHPipelineStage(name=source_name, func=None, queue_size=0)
+        threads = []
+        for i, stage in enumerate(self.stages):
+            stage._running_workers = stage.workers
+            for w in range(stage.workers):
+                thread = threading.Thread(target=self._worker, args=(i,), name=f"{self.name}-{stage.name}-{w}",
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        is_stopped = False
+        is_source_failed = False
+        iterator = iter(source)
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                is_stopped = True
+                break
+            start_t = time.perf_counter()
+            try:
+                job = next(iterator)
+            except StopIteration:
+                break
+            except Exception as e:
+                is_source_failed = True
+                self.logger.error(f"  ERROR: Pipeline `{self.name}` stage `{source_name}` failed: {str(e)}")
+                break
+            self.source_stage.busy_time += time.perf_counter() - start_t
+            self.source_stage.processed += 1
+            self.source_stage.blocked_time += self._put(self.source_stage, -1, job)
+
+        # Signal end of jobs and wait for stages to drain
+        if self.stages:
+            for _ in range(self.stages[0].workers):
+                self.stages[0].queue.put(WBHPipeline._END)
+        for thread in threads:
+            thread.join()
+        return not is_stopped and not is_source_failed and all(stage.failed == 0 for stage in self.stages)
+
+
+    def stats(self) -> list:
+        """ return list of per-stage stats (queue depth, jobs count and time spent), source stage first """
+        stages = [self.source_stage] if self.source_stage else []
+        return [stage.stats() for stage in stages + self.stages]
+
+
+    def stats_str(self) -> str:
+        return ', '.join("{}: {} jobs busy {:.2f}s idle {:.2f}s blocked {:.2f}s max-queue {}"
+                         .format(st['name'], st['processed'], st['busy_time'], st['idle_time'], st['blocked_time'],
+                                 st['max_queue_depth'])
+                         for st in self.stats())
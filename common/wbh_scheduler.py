@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import logging
+import random
+import threading
+import time
+
+import telegram
+
+
+class WBHTokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate  # tokens per second
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+
+    def reserve(self, now: float) -> float:
+        """ Take a token, return secs to wait before it can be used. Tokens go negative for waiting callers """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class WBHRequestScheduler:
+    """
+    Paces Bot API calls of all threads and coroutines with a global token bucket and one per chat. A call that hits flood control
+    (RetryAfter) blocks its chat for the given time and is tried again, transient network errors are tried again
+    after an exponential backoff with jitter. Other errors are raised to caller right away.
+    """
+    default_limits = {
+        'global_per_second': 30,
+        'global_burst': 30,
+        # Uploads of parallel_chunks (or async transport) to a blackhole all go to its chat, a flood control of
+        # Telegram above this is still honoured
+        'chat_per_minute': 60,
+        'chat_burst': 20,
+        'max_retries': 5,
+        'backoff_base': 1,  # secs, doubled on each retry
+        'backoff_max': 60,  # secs
+    }
+    # Window of send rate metric, in secs
+    rate_window = 60
+    # Secs between checks of stop_event, while a coroutine waits
+    stop_check_secs = 0.5
+
+
+    def __init__(self, logger: logging.Logger, limits: dict = None, stop_event: threading.Event = None):
+        self.logger = logger
+        self.limits = dict(self.default_limits, **(limits or {}))
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.lock = threading.Lock()
+        self.global_bucket = WBHTokenBucket(rate=self.limits['global_per_second'],
+                                            capacity=self.limits['global_burst'])
+        self.chat_buckets = {}
+        # Chat id (None for all chats) -> monotonic time that flood control ends
+        self.blocked_until = {}
+        # Metrics
+        self.calls = 0
+        self.retries = 0
+        self.failed = 0
+        self.throttled = 0  # RetryAfter errors
+        self.throttled_time = 0.0  # Secs asked to wait by RetryAfter errors
+        self.paced_time = 0.0  # Secs waited for a token
+        self._done_times = collections.deque()
+
+
+    def _reserve(self, chat_id) -> float:
+        """ Take a token of chat and a global one, return secs to wait before calling """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.global_bucket.reserve(now)
+            if chat_id is not None:
+                if chat_id not in self.chat_buckets:
+                    self.chat_buckets[chat_id] = WBHTokenBucket(rate=self.limits['chat_per_minute'] / 60,
+                                                                capacity=self.limits['chat_burst'])
+                wait = max(wait, self.chat_buckets[chat_id].reserve(now))
+            for blocked_chat_id in (None, chat_id):
+                wait = max(wait, self.blocked_until.get(blocked_chat_id, now) - now)
+            self.paced_time += wait
+            return wait
+
+
+    def _block(self, chat_id, secs: float):
+        with self.lock:
+            self.throttled += 1
+            self.throttled_time += secs
+            self.blocked_until[chat_id] = max(self.blocked_until.get(chat_id, 0), time.monotonic() + secs)
+
+
+    def _on_done(self):
+        with self.lock:
+            self._done_times.append(time.monotonic())
+            self._forget_done_times(self._done_times[-1])
+
+
+    def _retry_delay(self, chat, e: telegram.error.TelegramError, attempt: int) -> float:
+        """
+        return secs to wait before trying a failed call again, attempt is the number of tries so far. Raise e if it
+        can not be tried again
+        """
+        if isinstance(e, telegram.error.RetryAfter):
+            self.logger.warning("Flood control of chat `{}`, waiting {} secs...".format(chat, e.retry_after))
+            self._block(chat, e.retry_after)
+            delay = 0
+        elif isinstance(e, telegram.error.NetworkError) and not isinstance(e, telegram.error.BadRequest):
+            # Full jitter, so threads that failed together do not try again together
+            delay = random.uniform(0, min(self.limits['backoff_max'],
+                                          self.limits['backoff_base'] * 2 ** (attempt - 1)))
+            self.logger.warning("Network error on chat `{}`, trying again in {:.1f} secs: {}"
+                                .format(chat, delay, str(e)))
+        else:
+            raise e
+        if attempt > self.limits['max_retries']:
+            with self.lock:
+                self.failed += 1
+            raise IOError("Bot API call failed after {} tries: {}".format(attempt, str(e))) from e
+        with self.lock:
+            self.retries += 1
+        return delay
+
+
+    def call(self, chat, func, *args, **kwargs):
+        """
+        return result of func(*args, **kwargs), called when chat has a free slot. chat is the chat_id that func
+        sends to, None for calls that are not sent to a chat
+        """
+        attempt = 0
+        while True:
+            wait = self._reserve(chat)
+            if wait > 0 and self.stop_event.wait(wait):
+                raise InterruptedError("stopped while waiting to call Bot API")
+            with self.lock:
+                self.calls += 1
+            try:
+                result = func(*args, **kwargs)
+            except telegram.error.TelegramError as e:
+                attempt += 1
+                delay = self._retry_delay(chat, e, attempt)
+            else:
+                self._on_done()
+                return result
+            if delay > 0 and self.stop_event.wait(delay):
+                raise InterruptedError("stopped while waiting to call Bot API again")
+
+
+    async def _wait_async(self, secs: float) -> bool:
+        """ Sleep secs without blocking event loop. return True if stop_event is set meanwhile """
+        end = time.monotonic() + secs
+        while not self.stop_event.is_set():
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(remaining, self.stop_check_secs))
+        return True
+
+
+    async def call_async(self, chat, func, *args, **kwargs):
+        """ Same as call, for a coroutine function: func(*args, **kwargs) is awaited on each try """
+        attempt = 0
+        while True:
+            wait = self._reserve(chat)
+            if wait > 0 and await self._wait_async(wait):
+                raise InterruptedError("stopped while waiting to call Bot API")
+            with self.lock:
+                self.calls += 1
+            try:
+                result = await func(*args, **kwargs)
+            except telegram.error.TelegramError as e:
+                attempt += 1
+                delay = self._retry_delay(chat, e, attempt)
+            else:
+                self._on_done()
+                return result
+            if delay > 0 and await self._wait_async(delay):
+                raise InterruptedError("stopped while waiting to call Bot API again")
+
+
+    def _forget_done_times(self, now: float):
+        while self._done_times and self._done_times[0] < now - self.rate_window:
+            self._done_times.popleft()
+
+
+    def send_rate(self) -> float:
+        """ return successful calls per second, over the last rate_window secs """
+        with self.lock:
+            self._forget_done_times(time.monotonic())
+            return len(self._done_times) / self.rate_window
+
+
+    def stats(self) -> dict:
+        send_rate = self.send_rate()
+        with self.lock:
+            return {'calls': self.calls,
+                    'retries': self.retries,
+                    'failed': self.failed,
+                    'throttled': self.throttled,
+                    'throttled_time': self.throttled_time,
+                    'paced_time': self.paced_time,
+                    'send_rate': send_rate}
+
+
+    def stats_str(self) -> str:
+        return "{calls} calls, {send_rate:.2f}/s, {retries} retries, {failed} failed, throttled {throttled} " \
+               "times for {throttled_time:.1f}s, paced {paced_time:.1f}s".format(**self.stats())
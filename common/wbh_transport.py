@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+import os
+import shutil
+import threading
+
+import telegram
+from telegram.utils.helpers import is_local_file
+
+try:
+    import aiohttp  # pip install aiohttp, only needed by async transport
+except ImportError:
+    aiohttp = None
+
+
+class WBHAsyncBotApi:
+    """
+    Bot API calls over one asyncio loop and one aiohttp session with a pool of keep-alive connections. The loop runs
+    in its own thread, so any thread can use it: blocking methods have the same names and arguments as telegram.Bot
+    ones (so they can be paced by WBHRequestScheduler), and `*_async` coroutines can be handed to submit() to have
+    hundreds of calls in flight without a thread for each. Errors are raised as telegram.error types.
+    """
+    # Bytes read at a time, when a file is streamed to disk
+    download_chunk_size = 65536
+
+
+    def __init__(self, bot: telegram.Bot, logger: logging.Logger, pool_size: int = 100, connect_timeout: float = 5.0,
+                 read_timeout: float = 20.0, proxy_url: str = None):
+        """ bot is only used for its token, urls and to build results """
+        if aiohttp is None:
+            raise ImportError("async transport needs aiohttp (pip install aiohttp)")
+        if proxy_url and not proxy_url.startswith(('http://', 'https://')):
+            raise ValueError(f"async transport only supports http proxies, not `{proxy_url}`")
+        self.bot = bot
+        self.logger = logger
+        self.proxy_url = proxy_url or None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='wbh-bot-api', daemon=True)
+        self.thread.start()
+        self.session = self.run(self._open_session(pool_size, connect_timeout, read_timeout))
+
+
+    @staticmethod
+    async def _open_session(pool_size, connect_timeout, read_timeout):
+        # Session must be made in loop it is used from
+        connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+    def submit(self, coro):
+        """ Run coro on loop of transport. return a concurrent.futures.Future of its result """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+    def run(self, coro):
+        """ Run coro on loop of transport and wait for it. return its result """
+        return self.submit(coro).result()
+
+
+    @staticmethod
+    def _raise_for_response(status: int, data):
+        """ Raise telegram.error of a failed response, same as telegram.utils.request.Request does """
+        if isinstance(data, dict):
+            parameters = data.get('parameters') or {}
+            if parameters.get('retry_after') is not None:
+                raise telegram.error.RetryAfter(parameters['retry_after'])
+            if parameters.get('migrate_to_chat_id') is not None:
+                raise telegram.error.ChatMigrated(parameters['migrate_to_chat_id'])
+            message = data.get('description') or 'Unknown HTTPError'
+        else:
+            message = 'Unknown HTTPError'
+        if status in (401, 403):
+            raise telegram.error.Unauthorized(message)
+        if status == 400:
+            raise telegram.error.BadRequest(message)
+        if status == 404:
+            raise telegram.error.InvalidToken()
+        if status == 409:
+            raise telegram.error.Conflict(message)
+        if status == 413:
+            raise telegram.error.NetworkError('File too large. Check telegram api limits '
+                                              'https://core.telegram.org/bots/api#senddocument')
+        raise telegram.error.NetworkError(f'{message} ({status})')
+
+
+    async def _post(self, method: str, data: dict, files: dict = None):
+        """ return `result` of Bot API method. Values of files are (filename, file object), streamed from file """
+        data = {key: value for key, value in data.items() if value is not None}
+        if files:
+            body = aiohttp.FormData()
+            for key, value in data.items():
+                body.add_field(key, json.dumps(value) if isinstance(value, (bool, dict, list)) else str(value))
+            for key, (filename, file_open) in files.items():
+                body.add_field(key, file_open, filename=filename, content_type='application/octet-stream')
+            kwargs = {'data': body}
+        else:
+            kwargs = {'json': data}
+        try:
+            async with self.session.post(f'{self.bot.base_url}/{method}', proxy=self.proxy_url, **kwargs) as resp:
+                try:
+                    res = await resp.json(content_type=None)
+                except ValueError:
+                    res = None
+                if not 200 <= resp.status <= 299 or not isinstance(res, dict) or not res.get('ok'):
+                    self._raise_for_response(resp.status, res)
+                return res['result']
+        except asyncio.TimeoutError as e:
+            raise telegram.error.TimedOut() from e
+        except aiohttp.ClientError as e:
+            raise telegram.error.NetworkError(f'aiohttp {type(e).__name__} {e}') from e
+
+
+    async def send_document_async(self, chat_id, document, filename: str = None, caption: str = None,
+                                  disable_notification: bool = False, reply_to_message_id=None,
+                                  parse_mode: str = None) -> telegram.Message:
+        """
+        document is a file object, it is streamed from its current position. A str is sent as it is (file_id, url
+        or file:// uri of a local Bot API server)
+        """
+        data = {'chat_id': chat_id,
+                'caption': caption,
+                'parse_mode': parse_mode,
+                'disable_notification': disable_notification,
+                'reply_to_message_id': reply_to_message_id}
+        if isinstance(document, str):
+            result = await self._post('sendDocument', dict(data, document=document))
+        else:
+            filename = filename or os.path.basename(getattr(document, 'name', '') or 'document')
+            result = await self._post('sendDocument', data, files={'document': (filename, document)})
+        return telegram.Message.de_json(result, self.bot)
+
+
+    async def send_message_async(self, chat_id, text: str, parse_mode: str = None,
+                                 disable_notification: bool = False) -> telegram.Message:
+        result = await self._post('sendMessage', {'chat_id': chat_id,
+                                                  'text': text,
+                                                  'parse_mode': parse_mode,
+                                                  'disable_notification': disable_notification})
+        return telegram.Message.de_json(result, self.bot)
+
+
+    async def forward_message_async(self, chat_id, from_chat_id, message_id,
+                                    disable_notification: bool = False) -> telegram.Message:
+        result = await self._post('forwardMessage', {'chat_id': chat_id,
+                                                     'from_chat_id': from_chat_id,
+                                                     'message_id': message_id,
+                                                     'disable_notification': disable_notification})
+        return telegram.Message.de_json(result, self.bot)
+
+
+    async def delete_message_async(self, chat_id, message_id) -> bool:
+        return await self._post('deleteMessage', {'chat_id': chat_id, 'message_id': message_id})
+
+
+    async def get_file_async(self, file_id) -> telegram.File:
+        result = await self._post('getFile', {'file_id': file_id})
+        if result.get('file_path') and not is_local_file(result['file_path']):
+            result['file_path'] = f"{self.bot.base_file_url}/{result['file_path']}"
+        return telegram.File.de_json(result, self.bot)
+
+
+    async def download_async(self, file: telegram.File, path_to_save: str) -> str:
+        """
+        Stream file to path_to_save. return path_to_save. Disk is written by threads of executor of loop, so other
+        calls in flight are not blocked meanwhile
+        """
+        loop = asyncio.get_running_loop()
+        if is_local_file(file.file_path):
+            # Local Bot API server keeps files on this machine
+            await loop.run_in_executor(None, shutil.copyfile, file.file_path, path_to_save)
+            return path_to_save
+        try:
+            async with self.session.get(file.file_path, proxy=self.proxy_url) as resp:
+                if not 200 <= resp.status <= 299:
+                    self._raise_for_response(resp.status, None)
+                f = await loop.run_in_executor(None, open, path_to_save, 'wb')
+                try:
+                    async for data in resp.content.iter_chunked(self.download_chunk_size):
+                        await loop.run_in_executor(None, f.write, data)
+                finally:
+                    await loop.run_in_executor(None, f.close)
+        except asyncio.TimeoutError as e:
+            raise telegram.error.TimedOut() from e
+        except aiohttp.ClientError as e:
+            raise telegram.error.NetworkError(f'aiohttp {type(e).__name__} {e}') from e
+        return path_to_save
+
+
+    def send_document(self, *args, **kwargs) -> telegram.Message:
+        return self.run(self.send_document_async(*args, **kwargs))
+
+
+    def send_message(self, *args, **kwargs) -> telegram.Message:
+        return self.run(self.send_message_async(*args, **kwargs))
+
+
+    def forward_message(self, *args, **kwargs) -> telegram.Message:
+        return self.run(self.forward_message_async(*args, **kwargs))
+
+
+    def delete_message(self, *args, **kwargs) -> bool:
+        return self.run(self.delete_message_async(*args, **kwargs))
+
+
+    def get_file(self, *args, **kwargs) -> telegram.File:
+        return self.run(self.get_file_async(*args, **kwargs))
+
+
+    def download(self, file: telegram.File, path_to_save: str) -> str:
+        return self.run(self.download_async(file, path_to_save))
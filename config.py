@@ -2,6 +2,7 @@ import json
 import logging
 import os
 import tempfile
+import threading
 from enum import Enum
 
 import wublackhole
@@ -17,11 +18,22 @@ class Config:
         self.core: dict = {
             "temp_dir": os.path.join(tempfile.gettempdir(), "WBH-temp"),
             "db_filepath": "config/wbh.db",
+            "db_pragmas": {},
             "backup_pass": os.urandom(16).hex(),
             "blackhole_queue_dirname": ".WBH_QUEUE",
             "bot": {
                 "api": "",
                 "proxy": None,
+                "rate_limit": {},
+                "transport": {
+                    "backend": "sync"
+                },
+                "local_server": {
+                    "enabled": False,
+                    "base_url": "http://localhost:8081/bot",
+                    "base_file_url": "http://localhost:8081/file/bot",
+                    "chunk_size": 536870912
+                },
                 "chat_ids": {
                     "admins": [
                         {
@@ -35,6 +47,17 @@ class Config:
             },
             "chunk_size": 18874368,
             "path_check_interval": 3,
+            "max_concurrent_uploads": 4,
+            "queue": {
+                "backend": "journal",
+                "fsync_interval": 1,
+                "compact_min_size": 1048576
+            },
+            "watcher": {
+                "backend": "auto",
+                "stable_duration": 3,
+                "stat_cache": False
+            },
             "log": {
                 "filepath": "config/blackhole.log",
                 "core_level": 10,
@@ -51,6 +74,8 @@ class Config:
         self.TelegramBot = None
         self.config_filepath = None
         self.need_backup: bool = False
+        # Shared between watcher/uploader workers of all blackholes
+        self.shutdown_event = threading.Event()
 
         # self.config_filepath = config_filepath
         self.init_config()
@@ -107,6 +132,26 @@ class Config:
                 self.version = data_j['version']
                 self.core = data_j['core']
 
+                # Older config compatibility
+                if "watcher" not in self.core:
+                    self.core["watcher"] = {"backend": "auto"}
+                if "max_concurrent_uploads" not in self.core:
+                    self.core["max_concurrent_uploads"] = 4
+                if "db_pragmas" not in self.core:
+                    self.core["db_pragmas"] = {}
+                if "rate_limit" not in self.core["bot"]:
+                    self.core["bot"]["rate_limit"] = {}
+                if "transport" not in self.core["bot"]:
+                    self.core["bot"]["transport"] = {"backend": "sync"}
+                if "local_server" not in self.core["bot"]:
+                    self.core["bot"]["local_server"] = {"enabled": False}
+                if "queue" not in self.core:
+                    self.core["queue"] = {"backend": "journal", "fsync_interval": 1, "compact_min_size": 1048576}
+                if "stable_duration" not in self.core["watcher"]:
+                    self.core["watcher"]["stable_duration"] = self.core["path_check_interval"]
+                if "stat_cache" not in self.core["watcher"]:
+                    self.core["watcher"]["stat_cache"] = False
+
                 # Check BlackHoles
                 self.BlackHoles = list()
                 for blackhole in data_j['blackholes']:
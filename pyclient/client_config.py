@@ -35,6 +35,11 @@ class ClientConfig:
             "bot": {
                 "api": "",
                 "proxy": None,
+                "local_server": {
+                    "enabled": False,
+                    "base_url": "http://localhost:8081/bot",
+                    "base_file_url": "http://localhost:8081/file/bot"
+                },
                 "chat_ids": {
                     "admins": [
                         {
@@ -114,6 +119,8 @@ class ClientConfig:
                 # Older config compatibility
                 if "max_download_retry" not in self.client:
                     self.client["max_download_retry"] = 3
+                if "local_server" not in self.client["bot"]:
+                    self.client["bot"]["local_server"] = {"enabled": False}
 
                 self.init_config()
         except Exception as e:
@@ -135,10 +142,10 @@ class ClientConfig:
             self.Database = None
 
 
-    def init_bot(self, api, proxy=None):
+    def init_bot(self, api, proxy=None, local_server: dict = None):
         if api:
             self.TelegramBot = WBHTelegramBot(api=api, logger=self.logger_bot, proxy=proxy,
-                                              log_level=self.client['log']['bot_level'])
+                                              log_level=self.client['log']['bot_level'], local_server=local_server)
         else:
             self.TelegramBot = None
 
@@ -1,4 +1,5 @@
 # This Python file uses the following encoding: utf-8
+import hashlib
 import os
 
 import cryptography
@@ -9,7 +10,7 @@ from PySide2.QtUiTools import QUiLoader
 from PySide2.QtWidgets import QDialog, QMessageBox
 
 from common.helper import ChecksumType, EncryptionType, chacha20poly1305_decrypt_data, get_checksum_sha256, \
-    get_checksum_sha256_file, get_checksum_sha256_folder, sizeof_fmt
+    get_checksum_sha256_folder, get_checksum_sha256_merkle, sizeof_fmt
 from common.wbh_db import WBHDatabase, WBHDbItems, WBHDbChunks, WBHDbBlackHoles
 from pyclient.client_config import client
 from pyclient.input_password import InputPasswordDialog
@@ -90,6 +91,9 @@ class ExplorerTableModel(QAbstractTableModel):
 
 
 class ClientMainWindow(QObject):
+    # Items shown for a search
+    search_page_size = 1000
+
     def __init__(self, *args, **kwargs):
         super(ClientMainWindow, self).__init__(*args, **kwargs)
         # Load the .ui file
@@ -126,6 +130,14 @@ class ClientMainWindow(QObject):
         self.dl_progress_folder.setVisible(False)
         self.filter_le = self.window.findChild(QtWidgets.QLineEdit, 'filter_le')
         self.filter_le.textChanged.connect(self.on_filter_le_text_changed)
+        self.filter_le.returnPressed.connect(self.on_filter_le_return_pressed)
+        self.search_in_path_cb = self.window.findChild(QtWidgets.QCheckBox, 'search_in_path_cb')
+        # Next page of search results, shown only while there are more results
+        self.statusbar = self.window.findChild(QtWidgets.QStatusBar, 'statusbar')
+        self.search_more_pb = QtWidgets.QPushButton(text="Load more results", parent=self.statusbar)
+        self.search_more_pb.clicked.connect(self.on_search_more_pb_clicked)
+        self.search_more_pb.setVisible(False)
+        self.statusbar.addPermanentWidget(self.search_more_pb)
 
         # Load settings tab values from config
         self.reload_settings_tab()
@@ -134,7 +146,8 @@ class ClientMainWindow(QObject):
         self.check_database_avalibility()
 
     def reload_settings_tab(self):
-        self.api_le.setText(client.client['bot']['api'])
+        api = client.client['bot']['api']
+        self.api_le.setText(api if isinstance(api, str) else ', '.join(api))
         self.db_path_le.setText(client.client['db_filepath'])
         self.keep_db_sp.setValue(client.client['keep_db_backup'])
         self.max_dl_retry_sb.setValue(client.client['max_download_retry'])
@@ -159,6 +172,8 @@ class ClientMainWindow(QObject):
 
     def explorer_load_blackholes(self):
         self.explorer_table.setProperty('blackhole_id', None)
+        self.explorer_table.setProperty('search', False)
+        self.explorer_clear_search()
         self.explorer_data = []
 
         # # clear address bar
@@ -178,35 +193,30 @@ class ClientMainWindow(QObject):
                 self.explorer_table.resizeColumnToContents(ih)
             self.addressbar_add(name="ROOT", db_id=-2, blackhole_id=None)
 
+    @staticmethod
+    def explorer_item_row(itm: WBHDbItems) -> list:
+        """ return row of item for explorer table """
+        return [
+            '__DIR' if itm.is_dir else os.path.splitext(itm.filename)[1],
+            itm.filename,
+            sizeof_fmt(itm.size),
+            itm.id,
+            itm.uploaded_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "{} items".format(itm.items_count) if itm.is_dir else "{} parts".format(itm.chunks_count),
+            itm.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+            itm.modified_at.strftime("%Y-%m-%d %H:%M:%S")
+        ]
+
     def explorer_load_folder(self, blackhole_id, item_id):
         self.explorer_table.setProperty('blackhole_id', blackhole_id)
+        self.explorer_table.setProperty('search', False)
+        self.explorer_clear_search()
         self.explorer_data = []
         if client.Database:
             items = client.Database.get_items_by_parent_id(blackhole_id=blackhole_id, items_parent=item_id)
             itm: WBHDbItems
             for itm in items:
-                if itm.is_dir:
-                    self.explorer_data.append([
-                        '__DIR',
-                        itm.filename,
-                        sizeof_fmt(itm.size),
-                        itm.id,
-                        itm.uploaded_at.strftime("%Y-%m-%d %H:%M:%S"),
-                        "{} items".format(itm.items_count),
-                        itm.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-                        itm.modified_at.strftime("%Y-%m-%d %H:%M:%S")
-                    ])
-                else:
-                    self.explorer_data.append([
-                        os.path.splitext(itm.filename)[1],
-                        itm.filename,
-                        sizeof_fmt(itm.size),
-                        itm.id,
-                        itm.uploaded_at.strftime("%Y-%m-%d %H:%M:%S"),
-                        "{} parts".format(itm.chunks_count),
-                        itm.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-                        itm.modified_at.strftime("%Y-%m-%d %H:%M:%S")
-                    ])
+                self.explorer_data.append(self.explorer_item_row(itm))
             self.explorer_model = ExplorerTableModel(data=self.explorer_data, header=[
                 ' ',
                 'Name',
@@ -225,6 +235,78 @@ class ClientMainWindow(QObject):
             for ih in range(len(self.explorer_model.header)):
                 self.explorer_table.resizeColumnToContents(ih)
 
+    def explorer_clear_search(self):
+        self.search_more_pb.setVisible(False)
+        self.statusbar.clearMessage()
+
+    def explorer_load_search(self, text: str, blackhole_id, offset: int = 0, in_path: bool = False):
+        """
+        Load items of blackhole (or all blackholes if None) that their name (or path inside blackhole, if in_path)
+        contains words of text. A page of search_page_size items is loaded from offset, pages after the first one are
+        added to loaded ones
+        """
+        if client.Database:
+            # One more item than a page, to know if there is a next page
+            items = client.Database.search_items(text, blackhole_id=blackhole_id, in_path=in_path,
+                                                 limit=self.search_page_size + 1, offset=offset)
+            if items is None:
+                return
+            has_more = len(items) > self.search_page_size
+            items = items[:self.search_page_size]
+            self.explorer_table.setProperty('blackhole_id', blackhole_id)
+            self.explorer_table.setProperty('search', True)
+            self.explorer_table.setProperty('search_text', text)
+            self.explorer_table.setProperty('search_in_path', in_path)
+            self.explorer_table.setProperty('search_offset', offset + len(items))
+            blackholes = {bh.id: bh.name for bh in client.Database.get_blackholes()}
+            if offset == 0:
+                self.explorer_data = []
+            itm: WBHDbItems
+            for itm in items:
+                # Results can be from any blackhole, so each row keeps its blackhole
+                self.explorer_data.append(self.explorer_item_row(itm) + [
+                    itm.full_path[len(itm.root_path):].lstrip('/\\')
+                    if itm.root_path and itm.full_path.startswith(itm.root_path) else itm.full_path,
+                    blackholes.get(itm.blackhole_id),
+                    itm.blackhole_id
+                ])
+            self.explorer_model = ExplorerTableModel(data=self.explorer_data, header=[
+                ' ',
+                'Name',
+                'Size',
+                'ID',
+                'Uploaded',
+                'Contain',
+                'Created',
+                'Modified',
+                'Path',
+                'Blackhole',
+                'Blackhole ID'
+            ])
+            self.explorer_proxy_model = ExplorerTableProxyModel(self)
+            self.explorer_proxy_model.setSourceModel(self.explorer_model)
+            self.explorer_table.setModel(self.explorer_proxy_model)
+            selection = self.explorer_table.selectionModel()
+            selection.currentChanged.connect(self.on_explorer_table_current_changed)
+            for ih in range(len(self.explorer_model.header)):
+                self.explorer_table.resizeColumnToContents(ih)
+            self.statusbar.showMessage("{} results for `{}`{}{}".format(len(self.explorer_data), text,
+                                                                       " in path" if in_path else "",
+                                                                       ", there are more" if has_more else ""))
+            self.search_more_pb.setVisible(has_more)
+
+    def on_search_more_pb_clicked(self):
+        self.explorer_load_search(self.explorer_table.property('search_text'),
+                                  self.explorer_table.property('blackhole_id'),
+                                  offset=self.explorer_table.property('search_offset'),
+                                  in_path=bool(self.explorer_table.property('search_in_path')))
+
+    def explorer_row_blackhole_id(self, index: QModelIndex):
+        """ return blackhole id of row of index """
+        if self.explorer_table.property('search'):
+            return index.siblingAtColumn(10).data()
+        return self.explorer_table.property('blackhole_id')
+
     def addressbar_clear(self):
         for button in self.button_group.buttons():
             self.button_group.removeButton(button)
@@ -250,8 +332,17 @@ class ClientMainWindow(QObject):
 
     def on_explorer_table_doublecliked(self, clickedIndex: QModelIndex):
         if clickedIndex.siblingAtColumn(0).data(100) == "__BH" or clickedIndex.siblingAtColumn(0).data(100) == "__DIR":
-            blackhole_id = self.explorer_table.property('blackhole_id')
-            if blackhole_id is None:
+            blackhole_id = self.explorer_row_blackhole_id(clickedIndex)
+            if self.explorer_table.property('search'):
+                # Loading a folder of search results, address bar starts over from its blackhole
+                item_id = clickedIndex.siblingAtColumn(3).data()  # get item id
+                self.addressbar_clear()
+                self.addressbar_add(name="ROOT", db_id=-2, blackhole_id=None)
+                self.addressbar_add(name=clickedIndex.siblingAtColumn(9).data(), db_id=-1, blackhole_id=blackhole_id)
+                self.addressbar_add(name=clickedIndex.siblingAtColumn(1).data(), db_id=item_id,
+                                    blackhole_id=blackhole_id)
+                self.explorer_load_folder(blackhole_id=blackhole_id, item_id=item_id)
+            elif blackhole_id is None:
                 # Loading root of blackhole
                 # blackhole_id = self.explorer_data[clickedIndex.row()][3]  # get blackhole id
                 blackhole_id = clickedIndex.siblingAtColumn(3).data()  # get blackhole id
@@ -294,6 +385,14 @@ class ClientMainWindow(QObject):
         self.explorer_proxy_model.setFilterByColumn(QRegExp(text, Qt.CaseInsensitive, QRegExp.RegExp), 1)
         pass
 
+    def on_filter_le_return_pressed(self):
+        # Search all items of current blackhole, or of all blackholes in ROOT
+        text = self.filter_le.text()
+        if text.strip():
+            self.filter_le.clear()
+            self.explorer_load_search(text, self.explorer_table.property('blackhole_id'),
+                                      in_path=self.search_in_path_cb.isChecked())
+
     def on_download_pb_cliked(self):
         # Disable UI
         self.tab_widget.setDisabled(True)
@@ -309,7 +408,7 @@ class ClientMainWindow(QObject):
             QCoreApplication.processEvents()  # to avoid QFileDialog stay open because of GUI delay
             if len(dirpath) > 3:
                 self.download_folder(item_id=selected_row[3].data(),
-                                     blackhole_id=self.explorer_table.property('blackhole_id'),
+                                     blackhole_id=self.explorer_row_blackhole_id(selected_row[0]),
                                      save_to=dirpath)
         else:
             # File
@@ -318,7 +417,7 @@ class ClientMainWindow(QObject):
             QCoreApplication.processEvents()  # to avoid QFileDialog stay open because of GUI delay
             if len(filepath[0]) > 3:
                 self.download_file(item_id=selected_row[3].data(),
-                                   blackhole_id=self.explorer_table.property('blackhole_id'),
+                                   blackhole_id=self.explorer_row_blackhole_id(selected_row[0]),
                                    save_to=filepath[0])
         # Re-enable UI
         self.tab_widget.setDisabled(False)
@@ -344,8 +443,7 @@ class ClientMainWindow(QObject):
                 msg_box.warning(self.window, 'Invalid Database Code', "Database code is too short to be valid.")
             else:
                 # Close database file to avoid file lock on windows
-                client.Database.Session.close_all()
-                client.Database.conn.close()
+                client.Database.close()
                 # Show dialog
                 rb_window = RestoreBackupDialog(self.db_code_te.toPlainText())
                 self.db_code_te.setPlainText("")
@@ -370,7 +468,8 @@ class ClientMainWindow(QObject):
         # Setup Database
         client.init_database()
         # Setup Bot
-        client.init_bot(client.client['bot']['api'], client.client['bot']['proxy'])
+        client.init_bot(client.client['bot']['api'], client.client['bot']['proxy'],
+                        client.client['bot']['local_server'])
         # Load settings tab values from config
         self.reload_settings_tab()
 
@@ -400,9 +499,9 @@ class ClientMainWindow(QObject):
                         ask_rewrite: bool = True, use_msg_box: bool = True):
         no_error = True
         try:
-            # Get item from Database if did not presented
+            # Get item with its whole content from Database if did not presented
             if db_item is None:
-                db_item = client.Database.get_item_by_id(blackhole_id=blackhole_id, item_id=item_id)
+                db_item = client.Database.get_item_tree(blackhole_id=blackhole_id, item_id=item_id)
                 self.dl_progress_folder.setProperty('wrote_size', 0)
                 self.dl_progress_folder.setProperty('total_size', db_item.size)
             # update progressbar to set initial text
@@ -434,22 +533,25 @@ class ClientMainWindow(QObject):
                 self.dl_progress_folder_update(self.dl_progress_folder.property('wrote_size'),
                                                self.dl_progress_folder.property('total_size'))
 
-            if db_item.id == item_id:  # original download request
-                # Match file checksum
-                if db_item.checksum_type == ChecksumType.SHA256.value:
-                    db_item_checksum = get_checksum_sha256_folder(dirpath=new_dirpath)
-                    if db_item_checksum == db_item.checksum:
-                        client.logger_client.debug("{} checksum for `{}` matched."
-                                                   .format(ChecksumType(db_item.checksum_type).name,
-                                                           db_item.filename))
-                        # Folder Downloaded Correctly
-                        if use_msg_box:
-                            msg_box = QMessageBox()
-                            msg_box.information(self.window, 'Download',
-                                                "Folder successfully downloaded:\n`{}`".format(new_dirpath))
-                        return no_error
-                    else:
-                        raise Exception("Mismatch checksum for `{}`".format(db_item.filename))
+            # Match folder checksum
+            db_item_checksum = None
+            if db_item.checksum_type == ChecksumType.SHA256_MERKLE.value:
+                # Files are verified while downloading, match tree of their checksums without reading them again
+                db_item_checksum = get_checksum_sha256_merkle(
+                    (itm.filename, itm.is_dir, itm.checksum) for itm in db_item.items)
+            elif db_item.checksum_type == ChecksumType.SHA256.value and db_item.id == item_id:
+                # Folders uploaded by older versions: hash whole content again
+                db_item_checksum = get_checksum_sha256_folder(dirpath=new_dirpath)
+            if db_item_checksum is not None:
+                if db_item_checksum != db_item.checksum:
+                    raise Exception("Mismatch checksum for `{}`".format(db_item.filename))
+                client.logger_client.debug("{} checksum for `{}` matched."
+                                           .format(ChecksumType(db_item.checksum_type).name, db_item.filename))
+                if db_item.id == item_id and use_msg_box:  # original download request
+                    # Folder Downloaded Correctly
+                    msg_box = QMessageBox()
+                    msg_box.information(self.window, 'Download',
+                                        "Folder successfully downloaded:\n`{}`".format(new_dirpath))
             return no_error
         except Exception as e:
             client.logger_client.error("Can not download folder by id `{}`\n\n{}".format(item_id, str(e)))
@@ -474,8 +576,12 @@ class ClientMainWindow(QObject):
             # Get item from Database if did not presented
             if db_item is None:
                 db_item = client.Database.get_item_by_id(blackhole_id=blackhole_id, item_id=item_id)
+            # Chat of blackhole, for bots to find chunks sent by other bots
+            chat_id = client.Database.get_blackhole_by_id(blackhole_id).telegram_id
             # update progressbar to set initial text
             self.dl_progress_update(0, db_item.size)
+            # Checksum of whole file is updated by each chunk while downloading
+            file_hash = hashlib.sha256()
             # Open file to write
             with open(save_to, 'wb') as item_f:
                 chunk: WBHDbChunks
@@ -484,7 +590,7 @@ class ClientMainWindow(QObject):
                     chunk_filepath = os.path.join(client.tempdir, chunk.filename)
                     download_retry = 0
                     while True:
-                        if client.TelegramBot.get_chunk(chunk, chunk_filepath):
+                        if client.TelegramBot.get_chunk(chunk, chunk_filepath, chat_id=chat_id):
                             with open(chunk_filepath, 'rb') as chunk_f:
                                 chunk_data = chunk_f.read()
                                 client.logger_client.debug(
@@ -522,6 +628,7 @@ class ClientMainWindow(QObject):
                                     else:
                                         raise Exception("ERROR: {} checksum for chunk#{} mismatched.".format(
                                             ChecksumType(chunk.checksum_type).name, chunk.index))
+                                get_checksum_sha256(chunk=chunk_data, running_hash=file_hash)
                                 # Write to file
                                 item_f.write(chunk_data)
                                 client.logger_client.debug("Wrote {} to file `{}`"
@@ -549,7 +656,7 @@ class ClientMainWindow(QObject):
                 if is_error == 0:
                     # Match file checksum
                     if db_item.checksum_type == ChecksumType.SHA256.value:
-                        db_item_checksum = get_checksum_sha256_file(filepath=save_to)
+                        db_item_checksum = file_hash.hexdigest()
                         if db_item_checksum == db_item.checksum:
                             client.logger_client.debug("{} checksum for `{}` matched."
                                                        .format(ChecksumType(db_item.checksum_type).name,
@@ -562,6 +669,9 @@ class ClientMainWindow(QObject):
                             return True
                         else:
                             raise Exception("Mismatch checksum for `{}`".format(db_item.filename))
+                    # There is no checksum to match (e.g. item is still being uploaded)
+                    client.logger_client.debug("There is no checksum for `{}`".format(db_item.filename))
+                    return True
         except cryptography.exceptions.InvalidTag:
             client.logger_client.error("Incorrect password.")
             client.password = None
@@ -89,6 +89,9 @@ class RestoreBackupDialog(QObject):
                     checksum_type: ChecksumType = ChecksumType[db_c_parts[2]]
                     checksum = db_c_parts[3]
                     file_id = db_c_parts[4]
+                    # Bot that sent chunk and where its message is, missing in backups of older versions
+                    extra_parts = [None if p in ('', 'None') else p for p in db_c_parts[5:8]]
+                    bot_id, msg_id, chat_id = extra_parts + [None] * (3 - len(extra_parts))
                     self.log_info("Done", color="green")
 
                     self.log_info("Chunk {} encrypted with {}".format(db_c_i, encryption_type.name))
@@ -100,7 +103,10 @@ class RestoreBackupDialog(QObject):
                         # Download chunk file
                         self.log_info("Downloading chunk {} ...".format(db_c_i))
                         db_c_file = client.TelegramBot.get_file_by_id(file_id=file_id,
-                                                                      path_to_save=db_c_filepath)
+                                                                      path_to_save=db_c_filepath,
+                                                                      bot_id=int(bot_id) if bot_id else None,
+                                                                      chat_id=chat_id,
+                                                                      msg_id=int(msg_id) if msg_id else None)
                         if db_c_file:  # if file downloaded
                             self.log_info("Done", color="green")
                             with open(db_c_filepath, 'rb') as db_c_f:
@@ -144,20 +150,21 @@ class RestoreBackupDialog(QObject):
             # check if there was any error
             if not is_error:
                 self.log_info("New database downloaded completely.")
-                # Backup last db
+                # Backup last db, with its WAL files (if any) that may hold its latest changes
                 for bi in reversed(range(1, client.client['keep_db_backup'] + 1)):
-                    backup_to = "{}.backup-{}".format(client.client['db_filepath'], bi)
-                    # Remove oldest backup if exist
-                    if bi == client.client['keep_db_backup']:
-                        if os.path.exists(backup_to):
-                            os.remove(backup_to)
-                    if bi > 1:  # On newest backup
-                        backup_from = "{}.backup-{}".format(client.client['db_filepath'], bi - 1)
-                    else:
-                        backup_from = client.client['db_filepath']
-                    # move backup if exit
-                    if os.path.exists(backup_from):
-                        shutil.move(backup_from, backup_to)
+                    for suffix in ('', '-wal', '-shm'):
+                        backup_to = "{}.backup-{}{}".format(client.client['db_filepath'], bi, suffix)
+                        # Remove oldest backup if exist
+                        if bi == client.client['keep_db_backup']:
+                            if os.path.exists(backup_to):
+                                os.remove(backup_to)
+                        if bi > 1:  # On newest backup
+                            backup_from = "{}.backup-{}{}".format(client.client['db_filepath'], bi - 1, suffix)
+                        else:
+                            backup_from = client.client['db_filepath'] + suffix
+                        # move backup if exit
+                        if os.path.exists(backup_from):
+                            shutil.move(backup_from, backup_to)
                 # Replace downloaded db with current client db
                 shutil.move(new_db_filepath, client.client['db_filepath'])
                 time.sleep(1)
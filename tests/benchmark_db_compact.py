@@ -0,0 +1,79 @@
+import base64
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from common.helper import ChecksumType, EncryptionType
+from common.wbh_db import WBHDatabase
+
+
+# Config
+test_files = 10000
+test_chunks_per_file = 100  # 1M chunks
+test_dirpath = tempfile.mkdtemp(prefix='wbh-benchmark-')
+test_db_filepath = os.path.join(test_dirpath, 'benchmark.sqlite')
+test_backup_filepath = os.path.join(test_dirpath, 'backup.sqlite')
+logger = logging.getLogger('benchmark')
+
+
+class WBHDatabaseV1(WBHDatabase):
+    """ Open database without upgrading it to bytes columns """
+    migrations = WBHDatabase.migrations[:1]
+
+
+def create_catalog():
+    """ Create a catalog of encrypted chunks with text values, as written by older versions """
+    db = WBHDatabaseV1(test_db_filepath, logger)
+    bh_id = db.add_blackhole('benchmark', 0, '0').id
+    db.close()
+    conn = sqlite3.connect(test_db_filepath)
+    chunk_id = 0
+    for f in range(1, test_files + 1):
+        chunks = []
+        for c in range(test_chunks_per_file):
+            chunk_id += 1
+            chunks.append((chunk_id, chunk_id, base64.urlsafe_b64encode(os.urandom(53)).decode('ascii').rstrip('='),
+                           "WBHTF.p{:04d}".format(c), 18874368, c, os.urandom(32).hex(), ChecksumType.SHA256.value,
+                           EncryptionType.ChaCha20Poly1305.value,
+                           '{}O{}'.format(os.urandom(32).hex(), os.urandom(12).hex()), bh_id, f))
+        conn.executemany('INSERT INTO chunks (id, msg_id, file_id, filename, size, "index", checksum, checksum_type, '
+                         'encryption, encryption_data, blackhole_id, items_id) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', chunks)
+    conn.commit()
+    conn.close()
+    return chunk_id
+
+
+def benchmark_backup(db: WBHDatabase, title: str):
+    start_t = time.perf_counter()
+    db.backup_to(test_backup_filepath)
+    elapsed_t = time.perf_counter() - start_t
+    print("{}  database: {:>7.1f} MB    backup: {:>7.1f} MB in {:06f} secs..."
+          .format(title, os.path.getsize(test_db_filepath) / 1024 / 1024,
+                  os.path.getsize(test_backup_filepath) / 1024 / 1024, elapsed_t))
+    os.remove(test_backup_filepath)
+
+
+start_t = time.perf_counter()
+chunks_count = create_catalog()
+elapsed_t = time.perf_counter() - start_t
+print("Create a catalog of {} chunks in {:06f} secs...".format(chunks_count, elapsed_t))
+
+# ======== Old: text columns ========
+db = WBHDatabaseV1(test_db_filepath, logger)
+benchmark_backup(db, "Text ")
+db.close()
+
+# ======== Upgrade in place ========
+start_t = time.perf_counter()
+db = WBHDatabase(test_db_filepath, logger)
+elapsed_t = time.perf_counter() - start_t
+print("Upgrade database to version {} in {:06f} secs...".format(len(db.migrations), elapsed_t))
+benchmark_backup(db, "Bytes")
+db.close()
+
+# Remove test database
+shutil.rmtree(test_dirpath, ignore_errors=True)
@@ -0,0 +1,94 @@
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from common.wbh_db import WBHDatabase
+
+
+# Config
+test_dirs = 1000
+test_files_per_dir = 50
+test_chunks_per_file = 100  # 5M chunks
+test_lookups = 20
+test_dirpath = tempfile.mkdtemp(prefix='wbh-benchmark-')
+test_db_filepath = os.path.join(test_dirpath, 'benchmark.sqlite')
+logger = logging.getLogger('benchmark')
+
+
+class WBHDatabaseV0(WBHDatabase):
+    """ Open database without upgrading it """
+    migrations = []
+
+
+def create_catalog():
+    """ Create a catalog of folders, files and chunks with plain inserts """
+    db = WBHDatabase(test_db_filepath, logger)
+    bh_id = db.add_blackhole('benchmark', 0, '0').id
+    db.close()
+    conn = sqlite3.connect(test_db_filepath)
+    item_id = 0
+    chunk_id = 0
+    for d in range(test_dirs):
+        item_id += 1
+        dir_id = item_id
+        items = [(dir_id, "D-{:04d}".format(d), 1, 0, bh_id, None)]
+        chunks = []
+        for f in range(test_files_per_dir):
+            item_id += 1
+            items.append((item_id, "F-{:04d}-{:02d}".format(d, f), 0, 1024 * test_chunks_per_file, bh_id, dir_id))
+            for c in range(test_chunks_per_file):
+                chunk_id += 1
+                chunks.append((chunk_id, "WBHTF.p{:04d}".format(c), 1024, c, bh_id, item_id))
+        conn.executemany('INSERT INTO items (id, filename, is_dir, size, blackhole_id, parent_id) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', items)
+        conn.executemany('INSERT INTO chunks (id, filename, size, "index", blackhole_id, items_id) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', chunks)
+    conn.commit()
+    # Back to a database without indexes, as created by older versions
+    for index in ('items_parent_id', 'items_filename', 'chunks_items_id'):
+        conn.execute('DROP INDEX IF EXISTS {}'.format(index))
+    conn.execute('PRAGMA user_version = 0')
+    conn.commit()
+    conn.close()
+    return bh_id, item_id, chunk_id
+
+
+def benchmark_queries(db: WBHDatabase, title: str):
+    random.seed(0)
+    dir_ids = [1 + d * (test_files_per_dir + 1) for d in random.sample(range(test_dirs), test_lookups)]
+    file_ids = [dir_id + 1 + random.randrange(test_files_per_dir) for dir_id in dir_ids]
+    queries = [('get_items_by_parent_id', lambda i: db.get_items_by_parent_id(bh_id, dir_ids[i])),
+               ('get_items_by_filename ', lambda i: db.get_items_by_filename(bh_id, "F-{:04d}-00".format(i))),
+               ('get_chunks_by_item_id ', lambda i: db.get_chunks_by_item_id(bh_id, file_ids[i])),
+               ('get_item_by_id (folder)', lambda i: db.get_item_by_id(bh_id, dir_ids[i]).items)]
+    for name, query in queries:
+        start_t = time.perf_counter()
+        rows = sum(len(query(i)) for i in range(test_lookups))
+        elapsed_t = time.perf_counter() - start_t
+        print("{}  {}  rows:{}    {:06f} secs per query...".format(title, name, rows, elapsed_t / test_lookups))
+
+
+start_t = time.perf_counter()
+bh_id, items_count, chunks_count = create_catalog()
+elapsed_t = time.perf_counter() - start_t
+print("Create a catalog of {} items and {} chunks in {:06f} secs...".format(items_count, chunks_count, elapsed_t))
+
+# ======== Old: no index ========
+db = WBHDatabaseV0(test_db_filepath, logger)
+benchmark_queries(db, "No index")
+db.close()
+
+# ======== Upgrade in place ========
+start_t = time.perf_counter()
+db = WBHDatabase(test_db_filepath, logger)
+elapsed_t = time.perf_counter() - start_t
+print("Upgrade database to version {} in {:06f} secs...".format(len(db.migrations), elapsed_t))
+benchmark_queries(db, "Indexed ")
+db.close()
+
+# Remove test database
+shutil.rmtree(test_dirpath, ignore_errors=True)
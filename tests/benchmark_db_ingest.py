@@ -0,0 +1,82 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from common.helper import ChecksumType, EncryptionType
+from common.wbh_db import WBHDatabase
+from wublackhole.wbh_item import QueueState, WBHChunk, WBHItem
+
+
+# Config
+test_dirs = 100
+test_files_per_dir = 1000  # 100k files
+test_chunks = 100000
+test_sample = 2000  # Old per-item inserts are measured on a sample only, they take hours for the whole tree
+test_dirpath = tempfile.mkdtemp(prefix='wbh-benchmark-')
+logger = logging.getLogger('benchmark')
+
+
+def create_tree() -> list:
+    """ return items of a folder tree, parents before their children """
+    now = time.time()
+    root = WBHItem(filename="ROOT", full_path="/ROOT", is_dir=True, size=0, modified_at=now, created_at=now,
+                   state=QueueState.INQUEUE, total=test_dirs * test_files_per_dir)
+    items = [root]
+    for d in range(test_dirs):
+        folder = WBHItem(filename="D-{:03d}".format(d), is_dir=True, size=0, parent_qid=root.qid, modified_at=now,
+                         created_at=now, state=QueueState.INQUEUE, total=test_files_per_dir)
+        items.append(folder)
+        for f in range(test_files_per_dir):
+            items.append(WBHItem(filename="F-{:04d}".format(f), is_dir=False, size=f, parent_qid=folder.qid,
+                                 modified_at=now, created_at=now, state=QueueState.INQUEUE))
+    return items
+
+
+def create_chunks(count: int) -> list:
+    return [WBHChunk(size=1024, filename="WBHTF.p{:04d}".format(i), index=i, msg_id=i, state=QueueState.DONE,
+                     checksum='0' * 64, checksum_type=ChecksumType.SHA256, encryption=EncryptionType.NONE)
+            for i in range(count)]
+
+
+db = WBHDatabase(os.path.join(test_dirpath, 'benchmark.sqlite'), logger)
+db.add_blackhole('benchmark', 0, '0')
+bh_id = db.get_blackhole_by_name('benchmark').id
+items = create_tree()
+print("Create a tree of {} items".format(len(items)))
+
+# ======== Old: a transaction per item ========
+start_t = time.perf_counter()
+db_ids = {}
+for item in items[:test_sample]:
+    db_ids[item.qid] = db.add_item(item, bh_id, db_ids.get(item.parent_qid))
+elapsed_t = time.perf_counter() - start_t
+print("add_item       {} items  {:06f} secs... ({:06f} secs for whole tree)"
+      .format(test_sample, elapsed_t, elapsed_t * len(items) / test_sample))
+
+# ======== add_items_bulk ========
+items = create_tree()
+start_t = time.perf_counter()
+first_id = db.add_items_bulk(items, bh_id, None)
+elapsed_t = time.perf_counter() - start_t
+print("add_items_bulk {} items  {:06f} secs...".format(len(items), elapsed_t))
+
+# ======== Old: a transaction per chunk ========
+chunks = create_chunks(test_sample)
+start_t = time.perf_counter()
+for chunk in chunks:
+    db.add_chunk(chunk, bh_id, first_id + len(items) - 1)
+elapsed_t = time.perf_counter() - start_t
+print("add_chunk       {} chunks {:06f} secs... ({:06f} secs for all chunks)"
+      .format(test_sample, elapsed_t, elapsed_t * test_chunks / test_sample))
+
+# ======== add_chunks_bulk ========
+chunks = create_chunks(test_chunks)
+start_t = time.perf_counter()
+db.add_chunks_bulk(chunks, bh_id, first_id + len(items) - 1, chunks_count=len(chunks))
+elapsed_t = time.perf_counter() - start_t
+print("add_chunks_bulk {} chunks {:06f} secs...".format(len(chunks), elapsed_t))
+
+# Remove test database
+shutil.rmtree(test_dirpath, ignore_errors=True)
@@ -0,0 +1,89 @@
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from common.wbh_db import WBHDatabase
+
+
+# Config
+test_dirs = 1000
+test_subdirs_per_dir = 100
+test_files_per_subdir = 100  # 10M files
+test_runs = 10
+test_dirpath = tempfile.mkdtemp(prefix='wbh-benchmark-')
+test_db_filepath = os.path.join(test_dirpath, 'benchmark.sqlite')
+test_queue_dirpath = '/blackhole/.WBH_QUEUE'
+logger = logging.getLogger('benchmark')
+words = ['holiday', 'invoice', 'report', 'backup', 'photo', 'movie', 'draft', 'scan', 'music', 'notes']
+extensions = ['.jpg', '.pdf', '.mkv', '.txt', '.zip']
+
+
+def create_catalog():
+    """ Create a catalog of folders and files with plain inserts, search index is kept by triggers """
+    db = WBHDatabase(test_db_filepath, logger)
+    bh_id = db.add_blackhole('benchmark', 0, '0').id
+    db.close()
+    random.seed(0)
+    conn = sqlite3.connect(test_db_filepath)
+    item_id = 0
+    for d in range(test_dirs):
+        item_id += 1
+        dir_id = item_id
+        dir_name = "{}-{:04d}".format(random.choice(words), d)
+        dir_path = os.path.join(test_queue_dirpath, dir_name)
+        items = [(dir_id, dir_name, 1, dir_path, None)]
+        for sd in range(test_subdirs_per_dir):
+            item_id += 1
+            subdir_id = item_id
+            subdir_name = "{}-{:02d}".format(random.choice(words), sd)
+            subdir_path = os.path.join(dir_path, subdir_name)
+            items.append((subdir_id, subdir_name, 1, subdir_path, dir_id))
+            for f in range(test_files_per_subdir):
+                item_id += 1
+                filename = "{} {} {:08d}{}".format(random.choice(words), random.choice(words), item_id,
+                                                    random.choice(extensions))
+                items.append((item_id, filename, 0, os.path.join(subdir_path, filename), subdir_id))
+        conn.executemany('INSERT INTO items (id, filename, is_dir, full_path, parent_id, root_path, blackhole_id) '
+                         'VALUES (?, ?, ?, ?, ?, \'{}\', {})'.format(test_queue_dirpath, bh_id), items)
+        conn.commit()
+    conn.close()
+    return bh_id, item_id
+
+
+def benchmark_search(db: WBHDatabase, title: str):
+    queries = [('rare name      ', lambda: db.search_items("{:08d}".format(random.randrange(items_count)))),
+               ('common name    ', lambda: db.search_items(random.choice(words))),
+               ('two words      ', lambda: db.search_items("{} {}".format(*random.sample(words, 2)))),
+               ('page 100       ', lambda: db.search_items(random.choice(words), offset=100 * 100)),
+               ('short word     ', lambda: db.search_items(random.choice(extensions)[1:3])),
+               ('path in folder ', lambda: db.search_items("{:04d} {}".format(random.randrange(test_dirs),
+                                                                             random.choice(words)), in_path=True))]
+    random.seed(1)
+    for name, query in queries:
+        start_t = time.perf_counter()
+        rows = sum(len(query()) for _ in range(test_runs))
+        elapsed_t = time.perf_counter() - start_t
+        print("{}  {}  rows:{}    {:06f} secs per query...".format(title, name, rows, elapsed_t / test_runs))
+
+
+start_t = time.perf_counter()
+bh_id, items_count = create_catalog()
+elapsed_t = time.perf_counter() - start_t
+print("Create a catalog of {} items in {:06f} secs, database: {:.1f} MB..."
+      .format(items_count, elapsed_t, os.path.getsize(test_db_filepath) / 1024 / 1024))
+
+db = WBHDatabase(test_db_filepath, logger)
+# ======== Old: LIKE ========
+db.search_index = False
+benchmark_search(db, "LIKE   ")
+# ======== Trigram index ========
+db.search_index = True
+benchmark_search(db, "Indexed")
+db.close()
+
+# Remove test database
+shutil.rmtree(test_dirpath, ignore_errors=True)
@@ -0,0 +1,63 @@
+import gc
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from common.wbh_db import WBHDatabase
+from wublackhole.wbh_item import WBHItem
+
+
+# Config
+test_operations = 1000000
+test_write_every = 100  # One insert per this many operations, others are reads
+test_report_every = 100000
+test_dirpath = tempfile.mkdtemp(prefix='wbh-benchmark-')
+logger = logging.getLogger('benchmark')
+
+
+def get_rss() -> int:
+    """ return resident set size of this process in bytes, -1 if unknown (linux only) """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return -1
+
+
+def get_open_fds() -> int:
+    """ return number of open file descriptors of this process, -1 if unknown (linux only) """
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return -1
+
+
+db = WBHDatabase(os.path.join(test_dirpath, 'benchmark.sqlite'), logger)
+bh_id = db.add_blackhole('benchmark', 0, '0').id
+now = time.time()
+folder_id = db.add_item(WBHItem(filename="D", is_dir=True, size=0, modified_at=now, created_at=now, total=0),
+                        bh_id, None)
+file_id = db.add_item(WBHItem(filename="F", size=1, modified_at=now, created_at=now), bh_id, None)
+
+start_t = time.perf_counter()
+for op in range(1, test_operations + 1):
+    if op % test_write_every == 0:
+        db.add_item(WBHItem(filename="F-{}".format(op), size=1, modified_at=now, created_at=now), bh_id, folder_id)
+    elif op % 3 == 0:
+        db.get_item_by_id(bh_id, file_id)
+    elif op % 3 == 1:
+        db.get_items_by_parent_id(bh_id, None)
+    else:
+        db.get_blackhole_by_id(bh_id)
+    if op % test_report_every == 0:
+        gc.collect()
+        print("{:>8} ops    rss: {:>6.1f} MB    fds: {:>3}    {:06f} secs..."
+              .format(op, get_rss() / 1024 / 1024, get_open_fds(), time.perf_counter() - start_t))
+
+db.close()
+print("After close    fds: {:>3}".format(get_open_fds()))
+
+# Remove test database
+shutil.rmtree(test_dirpath, ignore_errors=True)
@@ -0,0 +1,99 @@
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy.orm import lazyload
+
+from common.wbh_db import WBHDatabase, WBHDbItems
+
+
+# Config
+test_dirs = 100
+test_subdirs_per_dir = 10
+test_files_per_subdir = 100  # 100k files
+test_chunks_per_file = 2
+test_dirpath = tempfile.mkdtemp(prefix='wbh-benchmark-')
+test_db_filepath = os.path.join(test_dirpath, 'benchmark.sqlite')
+logger = logging.getLogger('benchmark')
+
+
+def create_catalog():
+    """ Create a single folder of sub-folders, files and their chunks with plain inserts. return id of folder """
+    db = WBHDatabase(test_db_filepath, logger)
+    bh_id = db.add_blackhole('benchmark', 0, '0').id
+    db.close()
+    conn = sqlite3.connect(test_db_filepath)
+    items = [(1, "ROOT", 1, None)]
+    chunks = []
+    item_id = 1
+    for d in range(test_dirs):
+        item_id += 1
+        dir_id = item_id
+        items.append((dir_id, "D-{:03d}".format(d), 1, 1))
+        for sd in range(test_subdirs_per_dir):
+            item_id += 1
+            subdir_id = item_id
+            items.append((subdir_id, "S-{:02d}".format(sd), 1, dir_id))
+            for f in range(test_files_per_subdir):
+                item_id += 1
+                items.append((item_id, "F-{:03d}".format(f), 0, subdir_id))
+                chunks.extend((item_id, c) for c in range(test_chunks_per_file))
+    conn.executemany('INSERT INTO items (id, filename, is_dir, blackhole_id, parent_id) VALUES (?, ?, ?, {}, ?)'
+                     .format(bh_id), items)
+    conn.executemany('INSERT INTO chunks (items_id, "index", blackhole_id) VALUES (?, ?, {})'.format(bh_id), chunks)
+    conn.commit()
+    conn.close()
+    return bh_id, len(items), len(chunks)
+
+
+def walk_lazy(db: WBHDatabase, blackhole_id, item_id):
+    """ Old implementation: load children and chunks of each item on first access """
+    with db.session_scope() as session:
+        item = session.query(WBHDbItems) \
+            .filter_by(blackhole_id=blackhole_id, id=item_id) \
+            .options(lazyload(WBHDbItems.chunks)) \
+            .options(lazyload(WBHDbItems.items)) \
+            .first()
+        return count_tree(item)
+
+
+def count_tree(item: WBHDbItems):
+    """ return number of files and chunks under item """
+    files = 0
+    chunks = 0
+    itm: WBHDbItems
+    for itm in item.items:
+        if itm.is_dir:
+            sub_files, sub_chunks = count_tree(itm)
+            files += sub_files
+            chunks += sub_chunks
+        else:
+            files += 1
+            chunks += len(itm.chunks)
+    return files, chunks
+
+
+start_t = time.perf_counter()
+bh_id, items_count, chunks_count = create_catalog()
+elapsed_t = time.perf_counter() - start_t
+print("Create a folder of {} items and {} chunks in {:06f} secs...".format(items_count, chunks_count, elapsed_t))
+db = WBHDatabase(test_db_filepath, logger)
+
+# ======== Old: lazy loading ========
+start_t = time.perf_counter()
+files, chunks = walk_lazy(db, bh_id, 1)
+elapsed_t = time.perf_counter() - start_t
+print("Lazy loading     files:{} chunks:{}    {:06f} secs...".format(files, chunks, elapsed_t))
+
+# ======== get_item_tree ========
+start_t = time.perf_counter()
+files, chunks = count_tree(db.get_item_tree(bh_id, 1))
+elapsed_t = time.perf_counter() - start_t
+print("get_item_tree    files:{} chunks:{}    {:06f} secs...".format(files, chunks, elapsed_t))
+
+db.close()
+# Remove test database
+shutil.rmtree(test_dirpath, ignore_errors=True)
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from common.helper import get_path_size, get_path_stat
+from wublackhole.wbh_stat_cache import WBHStatCache
+
+
+# Config
+test_dirs = 100
+test_files_per_dir = 1000  # 100k files
+test_dirpath = tempfile.mkdtemp(prefix='wbh-benchmark-')
+
+
+def get_path_size_glob(full_path: str):
+    """ Old implementation: walk the whole tree and stat every file twice """
+    return sum(f.stat().st_size for f in Path(full_path).glob('**/*') if f.is_file())
+
+
+# Create Test tree
+start_t = time.perf_counter()
+for d in range(test_dirs):
+    dirpath = os.path.join(test_dirpath, "D-{:03d}".format(d))
+    os.makedirs(dirpath)
+    for f in range(test_files_per_dir):
+        with open(os.path.join(dirpath, "F-{:04d}".format(f)), 'wb') as tf:
+            tf.write(b'x' * (f % 64))
+elapsed_t = time.perf_counter() - start_t
+print("Create a tree of {} files in {:06f} secs...".format(test_dirs * test_files_per_dir, elapsed_t))
+# Let directory mtimes leave racy window of stat cache
+time.sleep(WBHStatCache.racy_window_ns / 1000000000)
+
+# ======== Old: Path.glob ========
+start_t = time.perf_counter()
+size = get_path_size_glob(test_dirpath)
+elapsed_t = time.perf_counter() - start_t
+print("Path.glob     size:{}    {:06f} secs...".format(size, elapsed_t))
+
+# ======== get_path_size: os.scandir ========
+start_t = time.perf_counter()
+size = get_path_size(test_dirpath)
+elapsed_t = time.perf_counter() - start_t
+print("os.scandir    size:{}    {:06f} secs...".format(size, elapsed_t))
+
+# ======== get_path_stat: os.scandir, size and newest mtime ========
+start_t = time.perf_counter()
+size, mtime_ns = get_path_stat(test_dirpath)
+elapsed_t = time.perf_counter() - start_t
+print("get_path_stat size:{}    {:06f} secs...".format(size, elapsed_t))
+
+# ======== WBHStatCache (watcher.stat_cache): lists only directories whose mtime changed ========
+stat_cache = WBHStatCache()
+start_t = time.perf_counter()
+size, changed = stat_cache.scan(test_dirpath)
+elapsed_t = time.perf_counter() - start_t
+print("Cache (cold)  size:{} changed:{}    {:06f} secs...".format(size, changed, elapsed_t))
+
+start_t = time.perf_counter()
+size, changed = stat_cache.scan(test_dirpath)
+elapsed_t = time.perf_counter() - start_t
+print("Cache (warm)  size:{} changed:{}    {:06f} secs...".format(size, changed, elapsed_t))
+
+size, mtime_ns = get_path_stat(test_dirpath)
+# Same-size rewrite is only seen by mtime
+time.sleep(0.01)
+with open(os.path.join(test_dirpath, "D-050", "F-0500"), 'r+b') as tf:
+    tf.write(b'y')
+start_t = time.perf_counter()
+new_size, new_mtime_ns = get_path_stat(test_dirpath)
+elapsed_t = time.perf_counter() - start_t
+print("get_path_stat size:{} changed:{}    {:06f} secs...".format(new_size, (new_size, new_mtime_ns) != (size, mtime_ns),
+                                                                  elapsed_t))
+start_t = time.perf_counter()
+size, changed = stat_cache.scan(test_dirpath)
+elapsed_t = time.perf_counter() - start_t
+print("Cache (warm)  size:{} changed:{}    {:06f} secs...".format(size, changed, elapsed_t))
+
+# =========================================
+
+# Remove test tree
+shutil.rmtree(test_dirpath, ignore_errors=True)
+print("remove test tree `{}`".format(test_dirpath))
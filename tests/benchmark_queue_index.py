@@ -0,0 +1,111 @@
+import random
+import tempfile
+import time
+
+from config import config
+from wublackhole.wbh_item import QueueState, WBHItem
+from wublackhole.wbh_queue import WBHQueue
+
+
+# Config
+test_dirs = 100
+test_files_per_dir = 1000  # 100k files
+test_lookups = 1000
+# Keep queue in memory only, so only lookups are measured
+config.core['queue'] = {'backend': 'json', 'fsync_interval': 1, 'compact_min_size': 1024 * 1024}
+
+
+def get_item_by_qid_list(qid: int, items: list) -> WBHItem:
+    """ Old implementation: walk the whole tree """
+    item: WBHItem
+    for item in items:
+        if item.qid == qid:
+            return item
+        elif item.is_dir:
+            sub_item = get_item_by_qid_list(qid, item.children)
+            if sub_item:
+                return sub_item
+    return None
+
+
+def remove_recursively(item: WBHItem, items: list):
+    """ Old implementation: walk the whole tree """
+    itm: WBHItem
+    for itm in items:
+        if item.qid == itm.qid:
+            items.remove(itm)
+            return True
+        elif itm.children:
+            if remove_recursively(item, itm.children):
+                return True
+    return False
+
+
+def create_queue() -> WBHQueue:
+    queue = WBHQueue(queue_file=tempfile.mktemp(prefix='wbh-benchmark-', suffix='.json'), blackhole=None)
+    for d in range(test_dirs):
+        folder = WBHItem(filename="D-{:03d}".format(d), is_dir=True, state=QueueState.INQUEUE, children=[])
+        for f in range(test_files_per_dir):
+            folder.children.append(WBHItem(filename="F-{:04d}".format(f), is_dir=False, parent_qid=folder.qid,
+                                           state=QueueState.INQUEUE))
+        queue.add(folder)
+    return queue
+
+
+start_t = time.perf_counter()
+queue = create_queue()
+elapsed_t = time.perf_counter() - start_t
+print("Create a queue of {} items in {:06f} secs...".format(len(queue.index), elapsed_t))
+random.seed(0)
+qids = random.sample(list(queue.index), test_lookups)
+
+# ======== Old: recursive walk ========
+start_t = time.perf_counter()
+found = sum(1 for qid in qids if get_item_by_qid_list(qid, queue.items))
+elapsed_t = time.perf_counter() - start_t
+print("Lookup  walk  found:{}    {:06f} secs...".format(found, elapsed_t))
+
+# ======== Index ========
+start_t = time.perf_counter()
+found = sum(1 for qid in qids if queue.get_item_by_qid(qid))
+elapsed_t = time.perf_counter() - start_t
+print("Lookup  index found:{}    {:06f} secs...".format(found, elapsed_t))
+
+start_t = time.perf_counter()
+found = sum(1 for qid in qids if queue.is_item_exist(queue.index[qid][0]))
+elapsed_t = time.perf_counter() - start_t
+print("Exist   index found:{}    {:06f} secs...".format(found, elapsed_t))
+
+# ======== Remove, in the order uploader finishes items ========
+items = [queue.index[qid][0] for qid in qids]
+start_t = time.perf_counter()
+removed = sum(1 for item in items if remove_recursively(item, queue.items))
+elapsed_t = time.perf_counter() - start_t
+print("Remove  walk  removed:{}    {:06f} secs...".format(removed, elapsed_t))
+
+queue = create_queue()
+items = [item for item, parent in random.sample(list(queue.index.values()), test_lookups)]
+start_t = time.perf_counter()
+removed = sum(1 for item in items if queue.remove(item))
+elapsed_t = time.perf_counter() - start_t
+print("Remove  index removed:{}    {:06f} secs...".format(removed, elapsed_t))
+
+# ======== Remove all siblings of a big folder, in random order (retries finish out of order) ========
+folder = WBHItem(filename="D-BIG", is_dir=True, state=QueueState.INQUEUE, children=[])
+for f in range(test_dirs * test_files_per_dir):
+    folder.children.append(WBHItem(filename="F-{:06d}".format(f), is_dir=False, parent_qid=folder.qid,
+                                   state=QueueState.INQUEUE))
+items = random.sample(folder.children, len(folder.children))
+siblings = list(folder.children)
+start_t = time.perf_counter()
+for item in items:
+    siblings.remove(item)
+elapsed_t = time.perf_counter() - start_t
+print("Remove  list  removed:{}    {:06f} secs...".format(len(items), elapsed_t))
+
+queue = WBHQueue(queue_file=tempfile.mktemp(prefix='wbh-benchmark-', suffix='.json'), blackhole=None)
+queue.add(folder)
+start_t = time.perf_counter()
+removed = sum(1 for item in items if queue.remove(item))
+elapsed_t = time.perf_counter() - start_t
+print("Remove  qid   removed:{}    {:06f} secs...".format(removed, elapsed_t))
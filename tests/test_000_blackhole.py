@@ -8,7 +8,7 @@ from PySide2.QtWidgets import QApplication
 
 from WuBlackHole import setup_app
 from common.helper import EncryptionType, create_random_content_file, json_value_escape_string, \
-    get_checksum_sha256_file, get_checksum_sha256_folder, get_path_size
+    get_checksum_sha256_file, get_checksum_sha256_merkle_folder, get_path_size
 from common.wbh_db import WBHDbItems
 from config import config
 from pyclient.client_config import client
@@ -184,8 +184,7 @@ class TestItemRetrieval(unittest.TestCase):
 
         rb_window = RestoreBackupDialog(db_code=''.join(dbb), no_gui=True, password=config.core['backup_pass'])
         # Close database file to avoid file lock on windows
-        client.Database.Session.close_all()
-        client.Database.conn.close()
+        client.Database.close()
         res = rb_window.restore_pb_clicked()
         self.assertEqual(res, True, "Problem on database restoration")
 
@@ -213,7 +212,8 @@ class TestItemRetrieval(unittest.TestCase):
                                           save_to=dir_path,
                                           ask_rewrite=False,
                                           use_msg_box=False)
-                self.assertEqual(itm.checksum, get_checksum_sha256_folder(dirpath=dir_path), "Checksum did not match")
+                self.assertEqual(itm.checksum, get_checksum_sha256_merkle_folder(dirpath=dir_path),
+                                 "Checksum did not match")
                 self.assertEqual(itm.size, get_path_size(dir_path), "Size did not match")
             else:
                 # File
@@ -245,7 +245,8 @@ class TestItemRetrieval(unittest.TestCase):
                                           blackhole_id=config.BlackHoles[1].id,
                                           save_to=dir_path,
                                           ask_rewrite=False)
-                self.assertEqual(itm.checksum, get_checksum_sha256_folder(dirpath=dir_path), "Checksum did not match")
+                self.assertEqual(itm.checksum, get_checksum_sha256_merkle_folder(dirpath=dir_path),
+                                 "Checksum did not match")
                 self.assertEqual(itm.size, get_path_size(dir_path), "Size did not match")
             else:
                 # File
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import unquote, urlparse
+
+from common.helper import EncryptionType, chacha20poly1305_decrypt_data, create_random_content_file
+from common.helper import get_checksum_sha256_file
+from common.wbh_bot import WBHTelegramBot
+from common.wbh_transport import aiohttp
+from wublackhole.wbh_item import WBHItem
+
+
+class LocalBotApiServer(ThreadingHTTPServer):
+    """ Stub of a Bot API server running with --local: files are sent and found by their path on this machine """
+    def __init__(self, files_dir: str):
+        super().__init__(('127.0.0.1', 0), LocalBotApiHandler)
+        self.files_dir = files_dir
+        self.requests = []  # (method, content type)
+        self.file_ids = {}  # file_id -> path of file kept by server
+        self.is_full = False  # Reject files as if disk of server is full
+        self.lock = threading.Lock()
+        self.base_url = 'http://127.0.0.1:{}/bot'.format(self.server_port)
+        self.base_file_url = 'http://127.0.0.1:{}/file/bot'.format(self.server_port)
+
+
+class LocalBotApiHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+    def reply(self, status: int, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        # Files of a local server are not served over HTTP
+        with self.server.lock:
+            self.server.requests.append(('GET', None))
+        self.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[1]
+        content_type = self.headers.get('Content-Type', '').split(';')[0]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.requests.append((method, content_type))
+        if content_type != 'application/json':
+            return self.reply(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: stub only reads json'})
+        data = json.loads(body)
+        if method == 'sendDocument' and self.server.is_full:
+            return self.reply(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: disk is full'})
+        if method == 'sendDocument':
+            uri = urlparse(data['document'])
+            if uri.scheme != 'file':
+                return self.reply(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: not a file uri'})
+            with self.server.lock:
+                file_id = 'F{}'.format(len(self.server.file_ids))
+                self.server.file_ids[file_id] = os.path.join(self.server.files_dir, file_id)
+            shutil.copyfile(unquote(uri.path), self.server.file_ids[file_id])
+            return self.reply(200, {'ok': True, 'result': {
+                'message_id': len(self.server.file_ids), 'date': 0,
+                'chat': {'id': int(data['chat_id']), 'type': 'channel'},
+                'document': {'file_id': file_id, 'file_unique_id': file_id,
+                             'file_name': os.path.basename(unquote(uri.path))}}})
+        if method == 'getFile':
+            if data['file_id'] not in self.server.file_ids:
+                return self.reply(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: invalid file_id'})
+            return self.reply(200, {'ok': True, 'result': {'file_id': data['file_id'], 'file_unique_id': data['file_id'],
+                                                           'file_path': self.server.file_ids[data['file_id']]}})
+        self.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+
+class TestLocalServer(unittest.TestCase):
+    transport = {'backend': 'sync'}
+    telegram_id = -1001
+
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='wbh-test-local-')
+        os.makedirs(os.path.join(self.test_dir, 'server'))
+        os.makedirs(os.path.join(self.test_dir, 'temp'))
+        self.server = LocalBotApiServer(os.path.join(self.test_dir, 'server'))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.bot = WBHTelegramBot(api='123456:ABCDEF', logger=logging.getLogger('bot'), transport=self.transport,
+                                  rate_limit={'chat_burst': 100}, local_server={'enabled': True,
+                                                'base_url': self.server.base_url,
+                                                'base_file_url': self.server.base_file_url,
+                                                'chunk_size': 1024 * 1024})
+        self.chunks = []
+        self.blackhole = SimpleNamespace(telegram_id=self.telegram_id,
+                                         queue=SimpleNamespace(add_chunk=lambda item, chunk: self.chunks.append(chunk),
+                                                               save=lambda: None))
+
+
+    def tearDown(self):
+        self.bot.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+
+    def send_and_get(self, size: int, encryption_type: EncryptionType):
+        """ Send a new file of size, download its chunks and return (original path, downloaded path) """
+        org_path = os.path.join(self.test_dir, 'org-{}'.format(size))
+        create_random_content_file(org_path, size)
+        item = WBHItem(filename=os.path.basename(org_path), full_path=org_path, parents=[self.test_dir], size=size)
+        is_sent = self.bot.send_file(item_wbhi=item, blackhole=self.blackhole,
+                                     chunk_size=self.bot.get_chunk_size(512 * 1024),
+                                     temp_dir=os.path.join(self.test_dir, 'temp'), encryption_type=encryption_type,
+                                     encryption_secret='secret')
+        self.assertTrue(is_sent)
+        dl_path = os.path.join(self.test_dir, 'dl-{}'.format(size))
+        with open(dl_path, 'wb') as dl_f:
+            for chunk in sorted(self.chunks, key=lambda c: c.index):
+                chunk_path = os.path.join(self.test_dir, chunk.filename)
+                self.assertEqual(self.bot.get_file_by_id(chunk.file_id, chunk_path, bot_id=chunk.bot_id), chunk_path)
+                with open(chunk_path, 'rb') as chunk_f:
+                    data = chunk_f.read()
+                if chunk.encryption == EncryptionType.ChaCha20Poly1305:
+                    key, nonce = chunk.encryption_data.split('O')
+                    data = chacha20poly1305_decrypt_data(data, b'secret', bytes.fromhex(key), bytes.fromhex(nonce))
+                dl_f.write(data)
+        return org_path, dl_path
+
+
+    def test_000_chunk_size(self):
+        self.assertEqual(self.bot.get_chunk_size(18874368), 1024 * 1024)
+        self.bot.local_server['chunk_size'] = 4000 * 1024 * 1024
+        self.assertEqual(self.bot.get_chunk_size(18874368), WBHTelegramBot.local_max_chunk_size)
+        self.bot.local_server = None
+        self.assertEqual(self.bot.get_chunk_size(18874368), 18874368)
+        self.assertEqual(self.bot.get_chunk_size(64 * 1024 * 1024), WBHTelegramBot.max_chunk_size)
+
+
+    def test_010_send_whole_file_by_path(self):
+        org_path, dl_path = self.send_and_get(300 * 1024, EncryptionType.NONE)
+        self.assertEqual(len(self.chunks), 1)
+        self.assertEqual(self.chunks[0].bot_id, 123456)
+        self.assertEqual(get_checksum_sha256_file(org_path), get_checksum_sha256_file(dl_path))
+        # Sent by a file:// uri of queue file, found by its path: no multipart body and no HTTP download
+        self.assertEqual(self.server.requests, [('sendDocument', 'application/json'), ('getFile', 'application/json')])
+
+
+    def test_015_send_split_and_encrypted_by_path(self):
+        # Chunks that are not the whole file as it is, are sent from a copy in temp_dir, removed once sent
+        for size, encryption_type in ((2500 * 1024, EncryptionType.NONE),
+                                      (2500 * 1024, EncryptionType.ChaCha20Poly1305),
+                                      (300 * 1024, EncryptionType.ChaCha20Poly1305)):
+            with self.subTest(size=size, encryption_type=encryption_type):
+                self.chunks.clear()
+                org_path, dl_path = self.send_and_get(size, encryption_type)
+                self.assertEqual(len(self.chunks), (size + 1024 * 1024 - 1) // (1024 * 1024))
+                self.assertEqual(get_checksum_sha256_file(org_path), get_checksum_sha256_file(dl_path))
+                self.assertEqual(os.listdir(os.path.join(self.test_dir, 'temp')), [])
+        self.assertNotIn('multipart/form-data', {content_type for _, content_type in self.server.requests})
+
+
+    def test_016_failed_chunks_are_kept(self):
+        self.server.is_full = True
+        # Whole file is copied to temp_dir, split chunks are kept as they are
+        for size in (300 * 1024, 1500 * 1024):
+            with self.subTest(size=size):
+                self.chunks.clear()
+                org_path = os.path.join(self.test_dir, 'org-{}'.format(size))
+                create_random_content_file(org_path, size)
+                item = WBHItem(filename=os.path.basename(org_path), full_path=org_path, parents=[self.test_dir],
+                               size=size)
+                self.assertFalse(self.bot.send_file(item_wbhi=item, blackhole=self.blackhole,
+                                                    chunk_size=self.bot.get_chunk_size(512 * 1024),
+                                                    temp_dir=os.path.join(self.test_dir, 'temp')))
+                self.assertEqual(len(self.chunks), (size + 1024 * 1024 - 1) // (1024 * 1024))
+                for chunk in self.chunks:
+                    self.assertEqual(os.path.getsize(chunk.org_fullpath), chunk.size)
+                    os.remove(chunk.org_fullpath)
+                self.assertTrue(os.path.exists(org_path))
+
+
+    def test_020_send_spilled_chunk_by_path(self):
+        org_path = os.path.join(self.test_dir, 'temp', 'WBHTF1.p0000')
+        create_random_content_file(org_path, 1000)
+        item = WBHItem(filename='org', full_path=os.path.join(self.test_dir, 'org'))
+        chunk = SimpleNamespace(filename='WBHTF1.p0000', org_fullpath=org_path, parent_db_id=1, index=0, size=1000,
+                                encryption=EncryptionType.NONE, bot_id=None)
+        self.blackhole.queue.update_chunk = lambda item_wbhi, c: None
+        self.bot.send_chunk_file(chunk=chunk, blackhole=self.blackhole, item_wbhi=item)
+        self.assertFalse(os.path.exists(org_path))
+        self.assertEqual(self.server.requests, [('sendDocument', 'application/json')])
+        self.assertEqual(chunk.file_id, 'F0')
+
+
+    def test_030_bad_file_id(self):
+        chunk = SimpleNamespace(file_id='nope', bot_id=None, msg_id=None, index=0, filename='WBHTF1.p0000')
+        self.assertIsNone(self.bot.get_chunk(chunk, os.path.join(self.test_dir, 'nope')))
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+class TestLocalServerAsync(TestLocalServer):
+    transport = {'backend': 'async', 'pool_size': 4}
+
+
+if __name__ == '__main__':
+    unittest.main()
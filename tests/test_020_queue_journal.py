@@ -0,0 +1,184 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from common.helper import ChecksumType
+from wublackhole.wbh_item import QueueState, WBHChunk, WBHItem, WBHItemList
+from wublackhole.wbh_queue_journal import WBHQueueJournal
+
+
+def dump(items) -> str:
+    return json.dumps([item.to_dict() for item in items], sort_keys=True)
+
+
+def make_dir(filename: str, files: int) -> WBHItem:
+    item = WBHItem(filename=filename, is_dir=True, children=WBHItemList())
+    for i in range(files):
+        item.children.append(WBHItem(filename='f{}'.format(i), size=10, parent_qid=item.qid))
+    return item
+
+
+def make_chunk(index: int, state: QueueState = QueueState.UPLOADING) -> WBHChunk:
+    return WBHChunk(size=1, filename='c{}'.format(index), index=index, state=state,
+                    checksum_type=ChecksumType.SHA256)
+
+
+class TestQueueJournal(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='wbh-test-journal-')
+        self.snapshot_file = os.path.join(self.test_dir, 'queue.json')
+        self.journal = WBHQueueJournal(self.snapshot_file, fsync_interval=0)
+        self.items = self.journal.load()
+
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+
+    def reload(self) -> WBHItemList:
+        """ return items of a fresh load of snapshot and journal, as after a restart """
+        self.journal.close()
+        self.journal = WBHQueueJournal(self.snapshot_file, fsync_interval=0)
+        return self.journal.load()
+
+
+    def test_000_empty(self):
+        self.assertEqual(len(self.items), 0)
+        self.assertTrue(os.path.exists(self.journal.journal_file))
+        self.assertEqual(len(self.reload()), 0)
+
+
+    def test_010_replay_nested(self):
+        top = make_dir('D', 3)
+        self.items.append(top)
+        self.journal.compact(self.items)
+
+        # Folder added under a child of snapshot, then its own child is changed
+        sub = make_dir('S', 2)
+        sub.parent_qid = top.qid
+        top.children.append(sub)
+        self.journal.add(sub, top)
+        nested = list(sub.children)[1]
+        for i in (1, 0, 2):
+            chunk = make_chunk(i)
+            nested.add_chunk(chunk)
+            self.journal.update_chunk(nested, chunk)
+        # Chunk updated in place and another one dropped
+        nested.chunks[1].state = QueueState.DONE
+        self.journal.update_chunk(nested, nested.chunks[1])
+        self.journal.drop_chunk(nested, nested.chunks[2])
+        nested.chunks.pop(2)
+        nested.state = QueueState.UPLOADING
+        nested.db_id = 7
+        self.journal.update_item(nested)
+        # Child of snapshot and child of added folder removed
+        removed = list(top.children)[0]
+        top.children.remove(removed)
+        self.journal.remove(removed)
+        removed = list(sub.children)[0]
+        sub.children.remove(removed)
+        self.journal.remove(removed)
+
+        items = self.reload()
+        self.assertEqual(dump(items), dump(self.items))
+        nested = list(list(list(items)[0].children)[-1].children)[0]
+        self.assertEqual([chunk.index for chunk in nested.chunks], [0, 1])
+        self.assertEqual(nested.chunks[1].state, QueueState.DONE)
+        self.assertEqual(nested.db_id, 7)
+
+
+    def test_020_unknown_item_is_skipped(self):
+        top = make_dir('D', 1)
+        self.items.append(top)
+        self.journal.add(top)
+        self.journal.remove(top)
+        self.items.remove(top)
+        # Records of an item that is already removed are skipped
+        self.journal.update_item(top)
+        self.journal.update_chunk(list(top.children)[0], make_chunk(0))
+        self.assertEqual(len(self.reload()), 0)
+
+
+    def test_030_torn_last_line(self):
+        top = make_dir('D', 2)
+        self.items.append(top)
+        self.journal.add(top)
+        self.journal.commit()
+        with open(self.journal.journal_file, 'a') as f:
+            f.write('{"op": "remove", "qid": ' + str(top.qid)[:5])
+        items = self.reload()
+        self.assertEqual(dump(items), dump(self.items))
+        # Torn line is folded away by compaction on load
+        self.assertEqual(dump(self.reload()), dump(self.items))
+
+
+    def test_040_corrupted_line_stops_replay(self):
+        first, second = make_dir('A', 1), make_dir('B', 1)
+        self.journal.add(first)
+        self.journal.commit()
+        with open(self.journal.journal_file, 'a') as f:
+            f.write('not json\n')
+        self.journal.add(second)
+        items = self.reload()
+        self.assertEqual([item.filename for item in items], ['A'])
+
+
+    def test_050_token_mismatch(self):
+        top = make_dir('D', 1)
+        self.items.append(top)
+        self.journal.add(top)
+        self.journal.commit()
+        with open(self.journal.journal_file, 'r') as f:
+            old_journal = f.read()
+        # Crash right after writing a new snapshot: journal still has token of the previous one
+        self.items.remove(top)
+        self.journal.remove(top)
+        self.journal.compact(self.items)
+        self.journal.close()
+        with open(self.journal.journal_file, 'w') as f:
+            f.write(old_journal)
+        self.assertEqual(len(self.reload()), 0)
+
+
+    def test_060_legacy_snapshot(self):
+        top = make_dir('D', 2)
+        self.journal.close()
+        os.remove(self.journal.journal_file)
+        # Older queue files are a plain list of items, without journal
+        with open(self.snapshot_file, 'w') as f:
+            json.dump([top.to_dict()], f)
+        items = self.reload()
+        self.assertEqual(dump(items), dump([top]))
+        with open(self.snapshot_file, 'r') as f:
+            self.assertIsInstance(json.load(f), dict)
+
+
+    def test_070_needs_compaction(self):
+        self.journal.compact_min_size = 1024
+        self.items.append(make_dir('D', 20))
+        self.journal.compact(self.items)
+        self.assertGreater(self.journal.snapshot_size, self.journal.compact_min_size)
+        self.assertFalse(self.journal.needs_compaction())
+        chunk = make_chunk(0)
+        item = list(list(self.items)[0].children)[0]
+        while self.journal.journal_size <= self.journal.snapshot_size:
+            self.assertFalse(self.journal.needs_compaction())
+            self.journal.update_chunk(item, chunk)
+        self.assertTrue(self.journal.needs_compaction())
+        self.journal.compact(self.items)
+        self.assertFalse(self.journal.needs_compaction())
+
+        # Small snapshot: journal may grow up to compact_min_size
+        self.items = WBHItemList()
+        self.journal.compact(self.items)
+        while self.journal.journal_size <= self.journal.compact_min_size:
+            self.assertFalse(self.journal.needs_compaction())
+            self.journal.update_chunk(item, chunk)
+        self.assertTrue(self.journal.needs_compaction())
+
+
+if __name__ == '__main__':
+    unittest.main()
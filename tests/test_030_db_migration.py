@@ -0,0 +1,132 @@
+import base64
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from common.wbh_db import WBHDatabase
+
+
+# Schema as created by the first version, before `user_version` was used
+SCHEMA_V0 = [
+    'CREATE TABLE blackholes (id INTEGER NOT NULL, name VARCHAR, size BIGINT, telegram_id VARCHAR, '
+    'created_at DATETIME, PRIMARY KEY (id))',
+    'CREATE TABLE items (id INTEGER NOT NULL, filename VARCHAR, is_dir BOOLEAN, size BIGINT, items_count BIGINT, '
+    'chunks_count BIGINT, checksum VARCHAR, checksum_type SMALLINT, root_path VARCHAR, full_path VARCHAR, '
+    'created_at DATETIME, modified_at DATETIME, uploaded_at DATETIME, blackhole_id BIGINT, parent_id BIGINT, '
+    'PRIMARY KEY (id), FOREIGN KEY(blackhole_id) REFERENCES blackholes (id), '
+    'FOREIGN KEY(parent_id) REFERENCES items (id))',
+    'CREATE TABLE chunks (id INTEGER NOT NULL, msg_id BIGINT, file_id VARCHAR, filename VARCHAR, size BIGINT, '
+    '"index" BIGINT, checksum VARCHAR, checksum_type SMALLINT, encryption SMALLINT, encryption_data VARCHAR, '
+    'uploaded_at DATETIME, blackhole_id BIGINT, items_id BIGINT, PRIMARY KEY (id), '
+    'FOREIGN KEY(blackhole_id) REFERENCES blackholes (id), FOREIGN KEY(items_id) REFERENCES items (id))',
+]
+
+ROOT_PATH = '/home/user/blackhole'
+CHECKSUM = 'a3' * 32
+KEY_HEX = '5f' * 32
+NONCE_HEX = '0c' * 12
+FILE_ID = base64.urlsafe_b64encode(bytes(range(60))).decode('ascii').rstrip('=')
+
+
+class TestDatabaseMigration(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='wbh-test-db-')
+        self.db_path = os.path.join(self.test_dir, 'wbh.db')
+        conn = sqlite3.connect(self.db_path)
+        for statement in SCHEMA_V0:
+            conn.execute(statement)
+        conn.execute("INSERT INTO blackholes (id, name, size, telegram_id) VALUES (1, 'bh', 300, '-1001')")
+        items = [
+            # id, filename, is_dir, size, checksum, full_path, parent_id
+            (1, 'Photos', 1, 300, None, ROOT_PATH + '/Photos', None),
+            (2, '2020', 1, 300, None, ROOT_PATH + '/Photos/2020', 1),
+            (3, 'beach.jpg', 0, 200, CHECKSUM, ROOT_PATH + '/Photos/2020/beach.jpg', 2),
+            (4, 'notes.txt', 0, 100, 'not-a-hex-checksum', ROOT_PATH + '/Photos/2020/notes.txt', 2),
+        ]
+        conn.executemany("INSERT INTO items (id, filename, is_dir, size, checksum, full_path, parent_id, root_path, "
+                         "blackhole_id, checksum_type) VALUES (?, ?, ?, ?, ?, ?, ?, '{}', 1, 1)".format(ROOT_PATH),
+                         items)
+        chunks = [
+            # id, items_id, index, file_id, encryption_data
+            (1, 3, 1, FILE_ID, '{}O{}'.format(KEY_HEX, NONCE_HEX)),
+            (2, 3, 0, FILE_ID[::-1], '{}O{}'.format(KEY_HEX, NONCE_HEX)),
+            (3, 4, 0, 'not*base64', None),
+        ]
+        conn.executemany("INSERT INTO chunks (id, items_id, \"index\", file_id, encryption_data, filename, size, "
+                         "checksum, blackhole_id, checksum_type, encryption) VALUES (?, ?, ?, ?, ?, 'c', 100, ?, 1, "
+                         "1, 1)", [chunk + (CHECKSUM,) for chunk in chunks])
+        conn.commit()
+        conn.close()
+        self.db = WBHDatabase(self.db_path, logging.getLogger('core'))
+
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+
+    def query(self, sql: str) -> list:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+
+    def test_000_user_version(self):
+        self.assertEqual(self.query('PRAGMA user_version'), [(len(WBHDatabase.migrations),)])
+        self.assertIn('bot_id', [row[1] for row in self.query('PRAGMA table_info(chunks)')])
+        indexes = [row[0] for row in self.query("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        for index in ('items_parent_id', 'items_filename', 'chunks_items_id'):
+            self.assertIn(index, indexes)
+        # Opening again does not upgrade anything
+        self.db.close()
+        self.db = WBHDatabase(self.db_path, logging.getLogger('core'))
+        self.assertEqual(self.query('PRAGMA user_version'), [(len(WBHDatabase.migrations),)])
+
+
+    def test_010_values_converted_to_blobs(self):
+        self.assertEqual(self.query('SELECT typeof(checksum) FROM items ORDER BY id'),
+                         [('null',), ('null',), ('blob',), ('text',)])
+        self.assertEqual(self.query('SELECT checksum FROM items WHERE id = 3'), [(bytes.fromhex(CHECKSUM),)])
+        self.assertEqual(self.query('SELECT typeof(checksum), typeof(encryption_data), typeof(file_id) FROM chunks '
+                                    'ORDER BY id'),
+                         [('blob', 'blob', 'blob'), ('blob', 'blob', 'blob'), ('blob', 'null', 'text')])
+        self.assertEqual(self.query('SELECT encryption_data FROM chunks WHERE id = 1'),
+                         [(bytes([32]) + bytes.fromhex(KEY_HEX + NONCE_HEX),)])
+
+
+    def test_020_get_item_tree(self):
+        root = self.db.get_item_tree(1, 1)
+        self.assertEqual(root.filename, 'Photos')
+        folder = root.items[0]
+        self.assertEqual([item.filename for item in folder.items], ['beach.jpg', 'notes.txt'])
+        beach, notes = folder.items
+        # Values read back as they were written by the first version
+        self.assertEqual(beach.checksum, CHECKSUM)
+        self.assertEqual(notes.checksum, 'not-a-hex-checksum')
+        self.assertEqual([chunk.index for chunk in beach.chunks], [0, 1])
+        self.assertEqual([chunk.file_id for chunk in beach.chunks], [FILE_ID[::-1], FILE_ID])
+        self.assertEqual(beach.chunks[0].encryption_data, '{}O{}'.format(KEY_HEX, NONCE_HEX))
+        self.assertEqual(beach.chunks[0].checksum, CHECKSUM)
+        self.assertIsNone(beach.chunks[0].bot_id)
+        self.assertEqual(notes.chunks[0].file_id, 'not*base64')
+        self.assertIsNone(notes.chunks[0].encryption_data)
+
+
+    def test_030_search_items(self):
+        self.assertEqual([item.id for item in self.db.search_items('beach')], [3])
+        self.assertEqual([item.id for item in self.db.search_items('EACH', blackhole_id=1)], [3])
+        self.assertEqual(self.db.search_items('beach', blackhole_id=2), [])
+        # Path inside blackhole, root path is not matched
+        self.assertEqual([item.id for item in self.db.search_items('photos/2020', in_path=True)], [2, 3, 4])
+        self.assertEqual(self.db.search_items('blackhole', in_path=True), [])
+        self.assertEqual([item.id for item in self.db.search_items('20 txt')], [])
+        self.assertEqual([item.id for item in self.db.search_items('20 txt', in_path=True)], [4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import threading
+import time
+import unittest
+
+import telegram
+
+from common.wbh_scheduler import WBHRequestScheduler, WBHTokenBucket
+
+
+class FlakyCall:
+    """ Callable that raises given errors in order, then returns its number of calls """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.calls
+
+
+    async def call_async(self):
+        return self()
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_000_burst_then_rate(self):
+        bucket = WBHTokenBucket(rate=2, capacity=3)
+        now = bucket.updated
+        self.assertEqual([bucket.reserve(now) for _ in range(3)], [0.0, 0.0, 0.0])
+        # Waiting callers take tokens ahead, each one a token later
+        self.assertAlmostEqual(bucket.reserve(now), 0.5)
+        self.assertAlmostEqual(bucket.reserve(now), 1.0)
+        self.assertAlmostEqual(bucket.reserve(now + 1.0), 0.5)
+
+
+    def test_010_refill_up_to_capacity(self):
+        bucket = WBHTokenBucket(rate=10, capacity=2)
+        now = bucket.updated
+        bucket.reserve(now)
+        bucket.reserve(now)
+        self.assertEqual(bucket.reserve(now + 60), 0.0)
+        self.assertEqual(bucket.reserve(now + 60), 0.0)
+        self.assertAlmostEqual(bucket.reserve(now + 60), 0.1)
+
+
+    def test_020_capacity_at_least_one(self):
+        bucket = WBHTokenBucket(rate=1, capacity=0)
+        self.assertEqual(bucket.capacity, 1)
+        self.assertEqual(bucket.reserve(bucket.updated), 0.0)
+
+
+class TestRequestScheduler(unittest.TestCase):
+    limits = {'global_per_second': 1000, 'global_burst': 1000, 'chat_per_minute': 60000, 'chat_burst': 1000,
+              'max_retries': 3, 'backoff_base': 0.01, 'backoff_max': 0.02}
+
+
+    def setUp(self):
+        self.stop_event = threading.Event()
+        self.new_scheduler()
+
+
+    def new_scheduler(self, **limits):
+        self.scheduler = WBHRequestScheduler(logger=logging.getLogger('bot'), limits=dict(self.limits, **limits),
+                                             stop_event=self.stop_event)
+
+
+    def call(self, chat, func):
+        return self.scheduler.call(chat, func)
+
+
+    def test_000_chat_is_paced(self):
+        self.new_scheduler(chat_per_minute=600, chat_burst=2)
+        start_t = time.monotonic()
+        for _ in range(4):
+            self.call('a', FlakyCall())
+        # Two calls of the burst, then one every 0.1 secs
+        self.assertGreaterEqual(time.monotonic() - start_t, 0.19)
+        # Other chats have their own bucket
+        start_t = time.monotonic()
+        self.call('b', FlakyCall())
+        self.assertLess(time.monotonic() - start_t, 0.05)
+        self.assertEqual(self.scheduler.stats()['calls'], 5)
+
+
+    def test_010_retry_after_blocks_chat(self):
+        func = FlakyCall(telegram.error.RetryAfter(0.3))
+        start_t = time.monotonic()
+        self.assertEqual(self.call('a', func), 2)
+        self.assertGreaterEqual(time.monotonic() - start_t, 0.29)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['throttled'], stats['retries'], stats['failed']), (1, 1, 0))
+        self.assertAlmostEqual(stats['throttled_time'], 0.3)
+
+
+    def test_015_retry_after_does_not_block_other_chats(self):
+        self.new_scheduler(max_retries=0)
+        with self.assertRaises(IOError):
+            self.call('a', FlakyCall(telegram.error.RetryAfter(30)))
+        start_t = time.monotonic()
+        self.assertEqual(self.call('b', FlakyCall()), 1)
+        self.assertLess(time.monotonic() - start_t, 0.05)
+        # Chat a waits until its flood control ends, or until stopped
+        threading.Timer(0.1, self.stop_event.set).start()
+        with self.assertRaises(InterruptedError):
+            self.call('a', FlakyCall())
+        self.assertLess(time.monotonic() - start_t, 5)
+
+
+    def test_020_network_error_backoff(self):
+        func = FlakyCall(telegram.error.TimedOut(), telegram.error.NetworkError('reset'))
+        self.assertEqual(self.call('a', func), 3)
+        self.assertEqual(self.scheduler.stats()['retries'], 2)
+        # Backoff doubles with each try, up to backoff_max
+        for attempt in range(1, 4):
+            limit = min(self.limits['backoff_max'], self.limits['backoff_base'] * 2 ** (attempt - 1))
+            for _ in range(20):
+                delay = self.scheduler._retry_delay('a', telegram.error.TimedOut(), attempt)
+                self.assertLessEqual(delay, limit)
+
+
+    def test_030_max_retries(self):
+        func = FlakyCall(*[telegram.error.TimedOut() for _ in range(10)])
+        with self.assertRaises(IOError):
+            self.call('a', func)
+        self.assertEqual(func.calls, self.limits['max_retries'] + 1)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['retries'], stats['failed']), (self.limits['max_retries'], 1))
+
+
+    def test_040_other_errors_are_raised(self):
+        for error in (telegram.error.BadRequest('Bad Request: chat not found'), telegram.error.Unauthorized('no')):
+            func = FlakyCall(error)
+            with self.assertRaises(type(error)):
+                self.call('a', func)
+            self.assertEqual(func.calls, 1)
+        self.assertEqual(self.scheduler.stats()['retries'], 0)
+
+
+    def test_050_stop_event_interrupts_backoff(self):
+        self.new_scheduler(backoff_base=30, backoff_max=30)
+        func = FlakyCall(*[telegram.error.TimedOut() for _ in range(10)])
+        threading.Timer(0.1, self.stop_event.set).start()
+        start_t = time.monotonic()
+        with self.assertRaises(InterruptedError):
+            self.call('a', func)
+        self.assertLess(time.monotonic() - start_t, 5)
+        self.assertEqual(func.calls, 1)
+
+
+    def test_060_send_rate(self):
+        for _ in range(6):
+            self.call(None, FlakyCall())
+        self.assertAlmostEqual(self.scheduler.send_rate(), 6 / self.scheduler.rate_window)
+
+
+class TestRequestSchedulerAsync(TestRequestScheduler):
+    """ Same tests on call_async """
+
+
+    def new_scheduler(self, **limits):
+        super().new_scheduler(**limits)
+        self.scheduler.stop_check_secs = 0.05
+
+
+    def call(self, chat, func):
+        return asyncio.run(self.scheduler.call_async(chat, func.call_async))
+
+
+    def test_070_stop_event_interrupts_wait(self):
+        self.scheduler._block('a', 30)
+        threading.Timer(0.1, self.stop_event.set).start()
+        start_t = time.monotonic()
+        with self.assertRaises(InterruptedError):
+            self.call('a', FlakyCall())
+        self.assertLess(time.monotonic() - start_t, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import logging
+import threading
+import time
+import unittest
+
+from common.wbh_pipeline import WBHPipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = WBHPipeline(name='test', logger=logging.getLogger('core'))
+        self.done = []
+
+
+    def pipeline_threads(self) -> list:
+        return [thread for thread in threading.enumerate() if thread.name.startswith('test-')]
+
+
+    def test_000_jobs_pass_all_stages_in_order(self):
+        self.pipeline.add_stage('double', lambda job: job.append(job[0] * 2))
+        self.pipeline.add_stage('done', self.done.append)
+        self.assertTrue(self.pipeline.run([i] for i in range(50)))
+        self.assertEqual(self.done, [[i, i * 2] for i in range(50)])
+        stats = self.pipeline.stats()
+        self.assertEqual([st['name'] for st in stats], ['read', 'double', 'done'])
+        self.assertEqual([st['processed'] for st in stats], [50, 50, 50])
+        self.assertEqual(self.pipeline_threads(), [])
+
+
+    def test_010_parallel_workers(self):
+        lock = threading.Lock()
+        self.pipeline.add_stage('sleep', lambda job: time.sleep(0.05), workers=4, queue_size=4)
+
+        def done(job):
+            with lock:
+                self.done.append(job)
+        self.pipeline.add_stage('done', done)
+        start_t = time.perf_counter()
+        self.assertTrue(self.pipeline.run(range(8)))
+        self.assertLess(time.perf_counter() - start_t, 0.3)
+        self.assertEqual(sorted(self.done), list(range(8)))
+
+
+    def test_020_queues_are_bounded(self):
+        read = []
+
+        def source():
+            for i in range(10):
+                read.append(i)
+                yield i
+
+        def slow(job):
+            time.sleep(0.02)
+            # Source can only be ahead by the jobs held in queues and workers between them
+            self.assertLessEqual(len(read) - job, 5)
+            self.done.append(job)
+        self.pipeline.add_stage('pass', lambda job: None, queue_size=1)
+        self.pipeline.add_stage('slow', slow, queue_size=1)
+        self.assertTrue(self.pipeline.run(source()))
+        self.assertEqual(self.done, list(range(10)))
+        for st in self.pipeline.stats()[1:]:
+            self.assertLessEqual(st['max_queue_depth'], 1)
+        self.assertGreater(self.pipeline.stats()[1]['blocked_time'], 0)
+
+
+    def test_030_stage_error_drops_job(self):
+        def check(job):
+            if job % 3 == 0:
+                raise ValueError('bad job {}'.format(job))
+        self.pipeline.add_stage('check', check, workers=2, queue_size=2)
+        self.pipeline.add_stage('done', self.done.append)
+        self.assertFalse(self.pipeline.run(range(9)))
+        self.assertEqual(sorted(self.done), [1, 2, 4, 5, 7, 8])
+        check_stats = self.pipeline.stats()[1]
+        self.assertEqual((check_stats['processed'], check_stats['failed']), (6, 3))
+        self.assertEqual(self.pipeline_threads(), [])
+
+
+    def test_040_source_error(self):
+        def source():
+            yield 1
+            raise IOError('can not read')
+        self.pipeline.add_stage('done', self.done.append)
+        self.assertFalse(self.pipeline.run(source()))
+        # Jobs read before the error still finish
+        self.assertEqual(self.done, [1])
+        self.assertEqual(self.pipeline_threads(), [])
+
+
+    def test_050_stop_event(self):
+        stop_event = threading.Event()
+
+        def stop_at_3(job):
+            if job == 3:
+                stop_event.set()
+            self.done.append(job)
+        self.pipeline.add_stage('done', stop_at_3)
+        self.assertFalse(self.pipeline.run(range(1000), stop_event=stop_event))
+        # Source stops soon after, and jobs already read are not lost
+        self.assertLess(len(self.done), 10)
+        self.assertEqual(self.done, list(range(len(self.done))))
+        self.assertEqual(self.pipeline.stats()[0]['processed'], len(self.done))
+        self.assertEqual(self.pipeline_threads(), [])
+
+
+    def test_060_no_stages(self):
+        self.assertTrue(self.pipeline.run(range(3)))
+        self.assertEqual(self.pipeline.stats()[0]['processed'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
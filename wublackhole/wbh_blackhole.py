@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 import json
 import os
+import threading
 
 from common.helper import EncryptionType
 from config import config
@@ -10,22 +11,35 @@ from wublackhole.wbh_queue import WBHQueue
 
 class WBHBlackHole:
     def __init__(self, dirpath: str, name: str, telegram_id: int = None, _id: int = None,
-                 encryption_type: EncryptionType = EncryptionType.NONE, encryption_pass: str = None):
+                 encryption_type: EncryptionType = EncryptionType.NONE, encryption_pass: str = None,
+                 parallel_chunks: int = 1):
         self.dirpath: str = dirpath
         self.name = name
         self.telegram_id = telegram_id
         self.encryption_type = encryption_type
         self.encryption_pass = encryption_pass
+        # Number of chunks of a file uploaded at the same time
+        self.parallel_chunks = parallel_chunks
         # Create/Load Queue from disk
         self.queue = WBHQueue(os.path.join(self.dirpath, config.core['blackhole_queue_dirname'], 'queue.json'), self)
         self.id: int = _id
+        # Filesystem watcher backend, created on first watch
+        self.watcher = None
+        # Pending top level entries of blackhole directory, created on first watch
+        self.watch_table = None
+        # Stat cache of blackhole directory if `watcher.stat_cache` is enabled, created on first watch
+        self.stat_cache = None
+        # Set by watcher when new items moved to queue
+        self.queue_event = threading.Event()
+        # Pipeline of the current/last file sent to blackhole, to check its per-stage stats
+        self.pipeline = None
 
 
     def init_id(self):
         # Get/Create BlackHole from/in database
         bh_id = config.Database.get_blackhole_by_name(self.name)
         if not bh_id:
-            bh_id = config.Database.add_blackhole(self.name, -1, self.telegram_id)
+            bh_id = config.Database.add_blackhole(self.name, 0, self.telegram_id)
         self.id: int = bh_id.id
 
 
@@ -35,7 +49,8 @@ class WBHBlackHole:
                 'name': self.name,
                 'telegram_id': self.telegram_id,
                 'encryption_type': self.encryption_type.name,
-                'encryption_pass': self.encryption_pass}
+                'encryption_pass': self.encryption_pass,
+                'parallel_chunks': self.parallel_chunks}
 
 
     @staticmethod
@@ -45,7 +60,8 @@ class WBHBlackHole:
                             name=_dict['name'],
                             telegram_id=_dict['telegram_id'],
                             encryption_type=EncryptionType[_dict['encryption_type']],
-                            encryption_pass=_dict['encryption_pass'])
+                            encryption_pass=_dict['encryption_pass'],
+                            parallel_chunks=_dict.get('parallel_chunks', 1))
 
 
     # def save(self):
@@ -19,7 +19,8 @@ class WBHChunk:
     def __init__(self, size, filename, index=-1, org_filename=None, org_fullpath=None, org_size=None,
                  msg_id: int = None, file_id: str = None, state: QueueState = QueueState.INQUEUE, checksum: str = None,
                  checksum_type: ChecksumType = None, encryption: EncryptionType = EncryptionType.NONE,
-                 encryption_data: str = None, parent_qid: int = None, parent_db_id=None, db_id=None):
+                 encryption_data: str = None, parent_qid: int = None, parent_db_id=None, db_id=None,
+                 bot_id: int = None):
         self.size = size
         self.index = index
         self.filename = filename
@@ -36,6 +37,8 @@ class WBHChunk:
         self.parent_qid: int = parent_qid
         self.parent_db_id = parent_db_id
         self.db_id = db_id
+        # Bot that sent chunk, file_id is only valid for this bot
+        self.bot_id: int = bot_id
 
 
     def to_dict(self):
@@ -54,7 +57,8 @@ class WBHChunk:
                 'encryption_data': self.encryption_data,
                 'parent_qid': self.parent_qid,
                 'parent_db_id': self.parent_db_id,
-                'db_id': self.db_id}
+                'db_id': self.db_id,
+                'bot_id': self.bot_id}
 
 
     @staticmethod
@@ -74,7 +78,8 @@ class WBHChunk:
                         encryption_data=_dict['encryption_data'],
                         parent_qid=_dict['parent_qid'],
                         parent_db_id=_dict['parent_db_id'],
-                        db_id=_dict['db_id'])
+                        db_id=_dict['db_id'],
+                        bot_id=_dict.get('bot_id'))
 
 
 class WBHItem:
@@ -106,6 +111,16 @@ class WBHItem:
         self.checksum_type: ChecksumType = checksum_type
 
 
+    def add_chunk(self, chunk: WBHChunk):
+        """ Insert chunk to chunks list, keeping the list sorted by chunk index """
+        if self.chunks is None:
+            self.chunks = []
+        i = len(self.chunks)
+        while i > 0 and self.chunks[i - 1].index > chunk.index:
+            i -= 1
+        self.chunks.insert(i, chunk)
+
+
     def to_dict(self):
         children = None
         if self.children is not None:
@@ -159,3 +174,52 @@ class WBHItem:
                        created_at=_dict['created_at'],
                        checksum=_dict['checksum'],
                        checksum_type=ChecksumType[_dict['checksum_type']])
+
+
+def index_items(items: list, parent: WBHItem = None, index: dict = None) -> dict:
+    """ return dict of qid -> (item, parent) for items and their children, Recursively """
+    if index is None:
+        index = {}
+    item: WBHItem
+    for item in items:
+        index[item.qid] = (item, parent)
+        if item.children:
+            index_items(item.children, item, index)
+    return index
+
+
+class WBHItemList:
+    """
+    Sibling items of queue in order they were added, keyed by qid. Items finish (and are removed) in any order, so
+    removal is constant time instead of a scan of siblings. Iterates and appends like a list
+    """
+    def __init__(self, items=None):
+        self._items: dict = {}
+        item: WBHItem
+        for item in items or []:
+            if item.children is not None:
+                item.children = WBHItemList(item.children)
+            self._items[item.qid] = item
+
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def __contains__(self, item: WBHItem):
+        return item.qid in self._items
+
+
+    def append(self, item: WBHItem):
+        """ Add item (and its children, Recursively) at the end """
+        if item.children is not None and not isinstance(item.children, WBHItemList):
+            item.children = WBHItemList(item.children)
+        self._items[item.qid] = item
+
+
+    def remove(self, item: WBHItem):
+        del self._items[item.qid]
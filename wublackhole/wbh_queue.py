@@ -3,140 +3,273 @@
 import json
 import os
 import shutil
+import threading
 from datetime import datetime
-import time
+from itertools import chain
 
 from common.helper import ChecksumType, EncryptionType, chacha20poly1305_encrypt_data, compress_bytes_to_string_b64zlib, \
-    get_checksum_sha256_file, get_checksum_sha256_folder
+    get_checksum_sha256_merkle
 from config import config
-from wublackhole.wbh_item import QueueState, WBHChunk, WBHItem
+from wublackhole.wbh_item import QueueState, WBHChunk, WBHItem, WBHItemList, index_items
+from wublackhole.wbh_queue_journal import WBHQueueJournal
+from wublackhole.wbh_queue_sqlite import WBHQueueSqlite, migrate_json_queue
 
 
 class WBHQueue:
     def __init__(self, queue_file, blackhole):
         self.blackhole = blackhole
         self.queue_file = os.path.abspath(queue_file)
-        self.items: list = []
-        if os.path.exists(self.queue_file):
+        self.items: WBHItemList = WBHItemList()
+        # qid -> (item, parent) of every item in items, Recursively
+        self.index: dict = {}
+        # Watcher and uploader workers share the queue
+        self.lock = threading.RLock()
+        # Changes are appended to a journal instead of rewriting whole queue file on each save
+        self.journal: WBHQueueJournal = None
+        # Or items are kept as rows of a sqlite file instead of in memory
+        self.store: WBHQueueSqlite = None
+        if config.core['queue']['backend'] == 'journal':
+            self.journal = WBHQueueJournal(self.queue_file,
+                                           fsync_interval=config.core['queue']['fsync_interval'],
+                                           compact_min_size=config.core['queue']['compact_min_size'])
+        elif config.core['queue']['backend'] == 'sqlite':
+            self.store = WBHQueueSqlite(os.path.splitext(self.queue_file)[0] + '.sqlite', lock=self.lock)
+        if os.path.exists(self.queue_file) or (self.journal and os.path.exists(self.journal.journal_file)) or \
+                (self.store and os.path.exists(self.store.db_file)):
             self.load()
 
 
-    def is_item_exist_list(self, item: WBHItem, items: list) -> WBHItem:
-        """ return true if item exist in given list, Recursively """
-        if item in items:
-            return True
-        else:
-            itm2: WBHItem
-            for itm2 in items:
-                if itm2.is_dir:
-                    if self.is_item_exist_list(item, itm2.children):
-                        return True
-        return False
+    def _journal(self) -> WBHQueueJournal:
+        """ return journal to record a change in, None if queue is not journaled """
+        if self.journal and not self.journal.is_open():
+            # Start journal on first change, queue directory may not exist before setup
+            self.journal.compact(self.items)
+        return self.journal
+
+
+    def _store(self) -> WBHQueueSqlite:
+        """ return sqlite store, None if queue is kept in memory """
+        if self.store and not self.store.is_open():
+            # Open on first use, queue directory may not exist before setup
+            self.store.open()
+            migrate_json_queue(self.queue_file, self.store)
+        return self.store
+
+
+    def iter_items(self, parent: WBHItem = None):
+        """ return children of parent (or top level items) to iterate over, while queue may change meanwhile """
+        with self.lock:
+            if self._store():
+                return self.store.iter_children(parent.qid if parent else None)
+            return list(parent.children or []) if parent else list(self.items)
+
+
+    def iter_subtree(self, parent: WBHItem):
+        """ Yield every item under parent (Recursively), parents before their children """
+        item: WBHItem
+        for item in self.iter_items(parent):
+            yield item
+            if item.is_dir:
+                yield from self.iter_subtree(item)
+
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            if self._store():
+                return not self.store.has_children()
+            return len(self.items) == 0
+
+
+    def count(self) -> int:
+        """ return number of top level items """
+        with self.lock:
+            if self._store():
+                return self.store.count_children()
+            return len(self.items)
 
 
     def is_item_exist(self, item: WBHItem) -> bool:
-        """ return true if item exist in queue list, Recursively """
-        return self.is_item_exist_list(item, self.items)
+        """ return true if an item with qid of item exist in queue list """
+        with self.lock:
+            if self._store():
+                return self.store.get_item(item.qid) is not None
+            return item.qid in self.index
 
 
-    def get_item_by_qid_list(self, qid: int, items: list) -> WBHItem:
-        """ return WBHItem if item exist with qid in given list, Recursively """
+    def get_spilled_chunk_paths_list(self, items: list) -> set:
+        """ return set of chunk files on disk that are waiting to be sent in given list, Recursively """
+        paths = set()
         item: WBHItem
         for item in items:
-            if item.qid == qid:
-                return item
-            elif item.is_dir:
-                sub_item = self.get_item_by_qid_list(qid, item.children)
-                if sub_item:
-                    return sub_item
-        return None
+            if item.is_dir:
+                paths |= self.get_spilled_chunk_paths_list(item.children)
+            elif item.chunks:
+                paths |= {os.path.abspath(chunk.org_fullpath) for chunk in item.chunks
+                          if chunk.state == QueueState.UPLOADING and chunk.org_fullpath}
+        return paths
+
+
+    def get_spilled_chunk_paths(self) -> set:
+        """ return set of chunk files on disk that are waiting to be sent, Recursively """
+        with self.lock:
+            if self._store():
+                return self.store.get_spilled_chunk_paths()
+            return self.get_spilled_chunk_paths_list(self.items)
 
 
     def get_item_by_qid(self, qid: int) -> WBHItem:
-        """ return WBHItem if item exist with qid in queue list, Recursively """
-        return self.get_item_by_qid_list(qid, self.items)
+        """ return WBHItem if item exist with qid in queue list """
+        with self.lock:
+            if self._store():
+                return self.store.get_item(qid)
+            return self.index.get(qid, (None, None))[0]
 
 
     def add(self, item: WBHItem):
         """ return true if added item successfully"""
         item.state = QueueState.INQUEUE
-        self.items.append(item)
+        with self.lock:
+            if self._store():
+                self.store.add(item)
+                return
+            self.items.append(item)
+            index_items([item], None, self.index)
+            if self._journal():
+                self.journal.add(item)
 
 
-    def _remove_recursively(self, item: WBHItem, items: list):
-        """ return true if removed item successfully"""
-        itm: WBHItem
-        for itm in items:
-            if item.qid == itm.qid:  # Found
+    def update_item(self, item: WBHItem):
+        """ Record changes of item's state, db_id or checksum, to be written on next save """
+        with self.lock:
+            if self._store():
+                self.store.update_item(item)
+            elif self._journal():
+                self.journal.update_item(item)
 
-                items.remove(itm)
-                return True
-            elif itm.children:  # Try children
-                if self._remove_recursively(item, itm.children):
-                    # found in children
-                    return True
-        return False
+
+    def add_chunk(self, item: WBHItem, chunk: WBHChunk):
+        """ Register chunk in item at its index, to be written on next save """
+        with self.lock:
+            item.add_chunk(chunk)
+            if self._store():
+                self.store.put_chunk(item, chunk)
+            elif self._journal():
+                self.journal.update_chunk(item, chunk)
+
+
+    def update_chunk(self, item: WBHItem, chunk: WBHChunk):
+        """ Record changes of chunk (e.g. its state), to be written on next save """
+        with self.lock:
+            if self._store():
+                self.store.put_chunk(item, chunk)
+            elif self._journal():
+                self.journal.update_chunk(item, chunk)
+
+
+    def remove_chunk(self, item: WBHItem, chunk: WBHChunk):
+        """ Unregister chunk of item, to be written on next save """
+        with self.lock:
+            item.chunks.remove(chunk)
+            if self._store():
+                self.store.delete_chunk(item, chunk)
+            elif self._journal():
+                self.journal.drop_chunk(item, chunk)
 
 
     def remove(self, item: WBHItem):
         """ return true if removed item successfully (Recursive)"""
-        return self._remove_recursively(item, self.items)
+        with self.lock:
+            if self._store():
+                self.store.remove(item)
+                return True
+            if item.qid not in self.index:
+                return False
+            if self._journal():
+                self.journal.remove(item)
+            item, parent = self.index[item.qid]
+            for qid in index_items([item]):
+                del self.index[qid]
+            (parent.children if parent else self.items).remove(item)
+            return True
 
 
     def save(self):
         """ return true if saved queue successfully to disk"""
         config.logger_core.debug("Saving queue to `{}`".format(self.queue_file))
         try:
-            with open(self.queue_file, 'w') as f:
-                json.dump([o.to_dict() for o in self.items], f, sort_keys=False)
+            with self.lock:
+                if self._store():
+                    self.store.commit()
+                elif self._journal():
+                    self.journal.commit()
+                    if self.journal.needs_compaction():
+                        self.journal.compact(self.items)
+                else:
+                    with open(self.queue_file, 'w') as f:
+                        json.dump([o.to_dict() for o in self.items], f, sort_keys=False)
+            config.logger_core.debug("  Queue saved with {} items".format(self.count()))
         except Exception as e:
             config.logger_core.error("  ERROR: Can not save queue to `{}`:\n {}".format(self.queue_file, str(e)))
-        config.logger_core.debug("  Queue saved with {} items".format(len(self.items)))
 
 
     def load(self):
         """ return true if loaded queue successfully from disk"""
         config.logger_core.debug("Loading queue from `{}`".format(self.queue_file))
         try:
-            with open(self.queue_file, 'r') as f:
-                data_j = json.load(f)
-                for itm in data_j:
-                    self.items.append(WBHItem.from_dict(itm))
+            if self.store:
+                self._store()
+            elif self.journal:
+                self.items = self.journal.load()
+            else:
+                with open(self.queue_file, 'r') as f:
+                    data_j = json.load(f)
+                    # Queue files written with journal backend keep items next to journal token
+                    if isinstance(data_j, dict):
+                        data_j = data_j['items']
+                    self.items = WBHItemList(WBHItem.from_dict(itm) for itm in data_j)
+            self.index = index_items(self.items)
+            config.logger_core.debug("  Queue loaded with {} items".format(self.count()))
         except Exception as e:
             config.logger_core.error("  ERROR: Can not load queue from `{}`:\n {}".format(self.queue_file, str(e)))
-        config.logger_core.debug("  Queue loaded with {} items".format(len(self.items)))
+            self.index = index_items(self.items)
 
 
     @staticmethod
     def backup_database(blackhole):
         config.logger_core.debug("Sending database backup to blackhole...")
+        db_root_path, db_filename = os.path.split(config.Database.get_db_filepath())
+        # Database is written by other blackholes meanwhile and its latest changes may be in its WAL file, so send a
+        # consistent single file copy of it
+        snapshot_filepath = os.path.join(config.core['temp_dir'],
+                                         "WBHDB{}.db".format(datetime.today().strftime('%Y%m%d%H%M%S%f')))
+        db_wbhi: WBHItem = None
         try:
-            db_root_path, db_filename = os.path.split(config.Database.get_db_filepath())
+            if not config.Database.backup_to(snapshot_filepath):
+                return None
             # Create a new WBHItem for database backup
-            db_wbhi: WBHItem = WBHItem(size=os.stat(config.Database.get_db_filepath()).st_size,
-                                       full_path=config.Database.get_db_filepath(),
+            db_wbhi = WBHItem(size=os.stat(snapshot_filepath).st_size,
+                                       full_path=snapshot_filepath,
                                        root_path=db_root_path,
                                        filename=db_filename,
                                        is_dir=False,
                                        state=QueueState.UPLOADING,
                                        modified_at=os.path.getmtime(config.Database.get_db_filepath()),
-                                       created_at=os.path.getctime(config.Database.get_db_filepath()),
-                                       checksum=get_checksum_sha256_file(config.Database.get_db_filepath()),
-                                       checksum_type=ChecksumType.SHA256)
+                                       created_at=os.path.getctime(config.Database.get_db_filepath()))
             # Send Database backup to blackhole
             if config.TelegramBot.send_file(item_wbhi=db_wbhi,
                                             blackhole=blackhole,
-                                            chunk_size=config.core['chunk_size'],
+                                            chunk_size=config.TelegramBot.get_chunk_size(config.core['chunk_size']),
                                             temp_dir=config.core['temp_dir'],
                                             encryption_type=EncryptionType.ChaCha20Poly1305,
-                                            encryption_secret=config.core['backup_pass']):
-                # combine all chunks checksum,encryption and file_id to string
+                                            encryption_secret=config.core['backup_pass'],
+                                            queued=False):
+                # combine all chunks checksum,encryption, file_id and where to find it to string
                 db_chunks = []
                 db_c: WBHChunk
                 for db_c in db_wbhi.chunks:
                     db_chunks.append(';'.join(
                         [db_c.encryption.name, db_c.encryption_data, db_c.checksum_type.name, db_c.checksum,
-                         db_c.file_id]))
+                         db_c.file_id, str(db_c.bot_id), str(db_c.msg_id), str(blackhole.telegram_id)]))
                 raw_db_backup_data = '^'.join(db_chunks).encode()
                 # Encrypt raw_db_backup_data with backup_pass in blackhole section of config
                 encrypted_data, key, nonce = chacha20poly1305_encrypt_data(data=raw_db_backup_data,
@@ -156,14 +289,39 @@ class WBHQueue:
         except Exception as e:
             config.logger_core.error(
                 "ERROR: Could send encrypted database backup  to BlackHole: ", str(e))
+        finally:
+            if os.path.exists(snapshot_filepath):
+                os.remove(snapshot_filepath)
+            # Backup is not queued, a chunk that failed is sent again with next backup, not from its spilled file
+            for db_c in (db_wbhi.chunks if db_wbhi else None) or []:
+                if db_c.org_fullpath and os.path.exists(db_c.org_fullpath):
+                    os.remove(db_c.org_fullpath)
         return None
 
 
-    def process_queue_list(self, telegram_id: str, items: list, parent: WBHItem = None):
-        """ Empty queue by sending items to BlackHole. Return True if there was nothing to do """
+    def update_folder_checksum(self, item: WBHItem):
+        """ Set SHA256_MERKLE checksum of a folder whose children are all sent, on queue item and database """
+        # Children sent by older versions may have a whole-content checksum, keep folder checksum as it is then
+        checksum = get_checksum_sha256_merkle(
+            (child.filename, child.is_dir,
+             child.checksum if not child.is_dir or child.checksum_type == ChecksumType.SHA256_MERKLE else None)
+            for child in self.iter_items(item))
+        if checksum is None:
+            config.logger_core.warning("Can not calculate checksum of `{}` from its children".format(item.filename))
+            return
+        item.checksum = checksum
+        item.checksum_type = ChecksumType.SHA256_MERKLE
+        if item.db_id:
+            config.Database.update_item_checksum(item_wbhi=item)
+
+
+    def process_queue_list(self, telegram_id: str, parent: WBHItem = None):
+        """ Empty queue by sending children of parent (or top level items) to BlackHole. Return True if there was
+        nothing to do """
         everything_is_done = True
         item: WBHItem
-        for item in items:
+        # Finished items are removed from queue and watcher may add new ones meanwhile
+        for item in self.iter_items(parent):
             config.need_backup = True
             # Check if item is file or directory
             if item.is_dir:
@@ -173,15 +331,19 @@ class WBHQueue:
                         everything_is_done = False
                         # Update item state
                         item.state = QueueState.UPLOADING
-                        # get item checksum
-                        item.checksum = get_checksum_sha256_folder(item.full_path, logger=config.logger_core)
-                        item.checksum_type = ChecksumType.SHA256
-                        # Add to Database and Update db_id on queue item
-                        item.db_id = config.Database.add_item(item_wbhi=item, blackhole_id=self.blackhole.id,
-                                                              parent_id=parent.db_id if parent else None)
-                        if item.db_id:  # If item added to database
-                            # Update item state
-                            item.state = QueueState.DONE
+                        # Add folder with all of its content to Database in one transaction, streamed from queue
+                        # so a huge tree is not held in memory. Checksums are filled in once items are sent
+                        first_id = config.Database.add_items_bulk(items=chain([item], self.iter_subtree(item)),
+                                                                  blackhole_id=self.blackhole.id,
+                                                                  parent_id=parent.db_id if parent else None)
+                        if first_id is not None:
+                            # Update db_id and state of items, files are ready to be sent. Items got consecutive ids
+                            # in order of subtree, which only this thread changes
+                            sub_item: WBHItem
+                            for i, sub_item in enumerate(chain([item], self.iter_subtree(item))):
+                                sub_item.db_id = first_id + i
+                                sub_item.state = QueueState.DONE if sub_item.is_dir else QueueState.UPLOADING
+                                self.update_item(sub_item)
                             # Save Queue to disk
                             self.save()
                     # else:
@@ -190,15 +352,16 @@ class WBHQueue:
                     #                                                                                item.state.name))
                     if item.state == QueueState.DONE:
                         # Check children
-                        if item.children:
-                            if self.process_queue_list(telegram_id, item.children, item):
-                                # All children of a root item are in DONE state
-                                # Remove folder
-                                shutil.rmtree(item.full_path, ignore_errors=True)
-                                config.logger_core.debug("`{}` removed from disk.".format(item.filename))
-                                item.state = QueueState.DELETED
-                                # Save Queue to disk
-                                self.save()
+                        if self.process_queue_list(telegram_id, item):
+                            # All children of a root item are in DELETED state (or folder is empty)
+                            self.update_folder_checksum(item)
+                            # Remove folder
+                            shutil.rmtree(item.full_path, ignore_errors=True)
+                            config.logger_core.debug("`{}` removed from disk.".format(item.filename))
+                            item.state = QueueState.DELETED
+                            self.update_item(item)
+                            # Save Queue to disk
+                            self.save()
 
                     if item.state == QueueState.DELETED and parent is None:
                         # Remove top level item with DELETED state, that means all chunks are sent
@@ -207,6 +370,9 @@ class WBHQueue:
                         config.logger_core.info("`{}` has been sent to blackhole.".format(item.filename))
                         # Save Queue to disk
                         self.save()
+                    elif item.state != QueueState.DELETED:
+                        # Sub-folder is not sent completely yet, so its parent should not be removed
+                        everything_is_done = False
                 except Exception as e:
                     config.logger_core.error("ERROR: Could add item `{}` to BlackHole: {}"
                                              .format(item.filename, str(e)))
@@ -217,12 +383,10 @@ class WBHQueue:
                         everything_is_done = False
                         # Update item state
                         item.state = QueueState.UPLOADING
-                        # get item checksum
-                        item.checksum = get_checksum_sha256_file(item.full_path, logger=config.logger_core)
-                        item.checksum_type = ChecksumType.SHA256
-                        # Add to Database and update db_id on queue
+                        # Add to Database and update db_id on queue, checksum is computed while sending file
                         item.db_id = config.Database.add_item(item_wbhi=item, blackhole_id=self.blackhole.id,
                                                               parent_id=parent.db_id if parent else None)
+                        self.update_item(item)
                         # Save Queue to disk
                         self.save()
                     except Exception as e:
@@ -233,17 +397,22 @@ class WBHQueue:
                         everything_is_done = False
                         # Send File to blackhole
                         if config.TelegramBot.send_file(item_wbhi=item, blackhole=self.blackhole,
-                                                        chunk_size=config.core['chunk_size'],
+                                                        chunk_size=config.TelegramBot.get_chunk_size(config.core['chunk_size']),
                                                         temp_dir=config.core['temp_dir'],
                                                         encryption_type=self.blackhole.encryption_type,
                                                         encryption_secret=self.blackhole.encryption_pass,
-                                                        delay_between_chunks=config.core['path_check_interval']):
+                                                        stop_event=config.shutdown_event,
+                                                        parallel_chunks=self.blackhole.parallel_chunks):
                             config.logger_core.debug("Sent `{}` to BlackHole.".format(item.filename))
                             # Update item state and db_id
                             item.state = QueueState.DONE
                         else:
                             config.logger_core.error(
                                 "ERROR: Could not send `{}` to BlackHole????".format(item.filename))
+                        if item.checksum is not None and item.db_id:
+                            # Whole file is read, fill in checksum of item in database
+                            config.Database.update_item_checksum(item_wbhi=item)
+                        self.update_item(item)
                         # Save Queue to disk
                         self.save()
                     except Exception as e:
@@ -255,31 +424,37 @@ class WBHQueue:
                         # Check if all chunks are sent
                         all_chunks_done = True
                         chunk: WBHChunk
-                        for chunk in item.chunks:
+                        for chunk in list(item.chunks):
                             if chunk.state == QueueState.UPLOADING:
                                 all_chunks_done = False
-                                config.TelegramBot.send_chunk_file(chunk=chunk, blackhole=self.blackhole)
-                                # Save Queue to disk
-                                self.save()
-                                self.logger.debug(f"Rest for {config.core['path_check_interval']} secs...")
-                                time.sleep(config.core['path_check_interval'])
+                                if not chunk.org_fullpath or not os.path.exists(chunk.org_fullpath):
+                                    # Chunk file is lost, read it again from original file
+                                    self.remove_chunk(item, chunk)
+                                    item.state = QueueState.UPLOADING
+                                    self.update_item(item)
+                                    self.save()
+                                    continue
+                                config.TelegramBot.send_chunk_file(chunk=chunk, blackhole=self.blackhole,
+                                                                   item_wbhi=item)
                         if all_chunks_done:  # If all there is no chunk with UPLOADING state
-                            # Add all chunks to Database
+                            # Add all chunks to Database and Update chunks_count in one transaction
+                            chunks = [chunk for chunk in item.chunks if chunk.state == QueueState.DONE]
+                            if not config.Database.add_chunks_bulk(chunks=chunks, blackhole_id=self.blackhole.id,
+                                                                   parent_id=item.db_id,
+                                                                   chunks_count=len(item.chunks)):
+                                raise IOError("chunks are not added to database, will try again")
                             chunk: WBHChunk
-                            for chunk in item.chunks:
-                                if chunk.state == QueueState.DONE:
-                                    chunk.db_id = config.Database.add_chunk(chunk=chunk, blackhole_id=self.blackhole.id,
-                                                                            parent_id=item.db_id)
-                                    chunk.state = QueueState.DELETED
+                            for chunk in chunks:
+                                chunk.state = QueueState.DELETED
+                                self.update_chunk(item, chunk)
                             # Remove file
                             os.remove(item.full_path)
                             item.state = QueueState.DELETED
+                            self.update_item(item)
                             config.logger_core.debug("`{}` removed from disk.".format(item.filename))
                             config.logger_core.info("`{}` has been sent to blackhole.".format(item.filename))
                             # Save Queue to disk
                             self.save()
-                            # Update chunks_count
-                            config.Database.update_item_chunk_count(item_wbhi=item, chunk_count=len(item.chunks))
                     except Exception as e:
                         config.logger_core.error(
                             "ERROR: Could add item `{}` to BlackHole: ".format(item.filename, str(e)))
@@ -291,7 +466,7 @@ class WBHQueue:
                     self.save()
 
         # Backup Database to blackhole
-        if len(items) == 0 and config.need_backup:
+        if parent is None and self.is_empty() and config.need_backup:
             config.need_backup = WBHQueue.backup_database(blackhole=self.blackhole) is None
             config.logger_core.info("Queue is empty. Backup database is done.")
 
@@ -300,4 +475,4 @@ class WBHQueue:
 
     def process_queue(self, telegram_id: str):
         """ Empty queue by sending items to BlackHole """
-        return self.process_queue_list(telegram_id, self.items)
+        return self.process_queue_list(telegram_id)
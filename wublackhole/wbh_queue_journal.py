@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+import uuid
+
+from common.helper import ChecksumType
+from config import config
+from wublackhole.wbh_item import QueueState, WBHChunk, WBHItem, WBHItemList, index_items
+
+
+class WBHQueueJournal:
+    """
+    Append-only journal of queue changes (item added/updated/removed, chunk added/updated/dropped), one JSON record
+    per line, replayed on top of the queue snapshot on load. Snapshot and journal are tied by a token written in both,
+    so a journal that is older than its snapshot (crash during compaction) is ignored.
+    """
+
+
+    def __init__(self, snapshot_file: str, fsync_interval: float = 1, compact_min_size: int = 1024 * 1024):
+        self.snapshot_file = os.path.abspath(snapshot_file)
+        self.journal_file = os.path.splitext(self.snapshot_file)[0] + '.journal'
+        self.fsync_interval = fsync_interval
+        self.compact_min_size = compact_min_size
+        self.snapshot_size = 0
+        self.journal_size = 0
+        self._file = None
+        self._last_fsync = 0.0
+        self._need_fsync = False
+
+
+    def load(self) -> WBHItemList:
+        """ return queue items from snapshot and replayed journal, then start a fresh journal """
+        items = WBHItemList()
+        snapshot_token = None
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r') as f:
+                data_j = json.load(f)
+            # Older queue files are a plain list of items
+            if isinstance(data_j, dict):
+                snapshot_token = data_j['journal']
+                data_j = data_j['items']
+            items = WBHItemList(WBHItem.from_dict(itm) for itm in data_j)
+        if os.path.exists(self.journal_file):
+            replayed = self._replay(items, snapshot_token)
+            config.logger_core.debug("  {} records replayed from `{}`".format(replayed, self.journal_file))
+        # Fold replayed records (and a possibly torn last line) into a new snapshot
+        self.compact(items)
+        return items
+
+
+    def _replay(self, items: list, snapshot_token: str) -> int:
+        """ Apply journal records to items. return number of applied records """
+        index = index_items(items)
+        replayed = 0
+        with open(self.journal_file, 'r') as f:
+            lines = f.readlines()
+        for line_i, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if line_i < len(lines) - 1:
+                    config.logger_core.error("  ERROR: Journal `{}` is corrupted at line {}, ignoring the rest"
+                                             .format(self.journal_file, line_i + 1))
+                # Otherwise last record is torn by a crash while writing it
+                break
+            if line_i == 0:
+                if record.get('op') != 'begin' or record.get('journal') != snapshot_token:
+                    config.logger_core.warning("  Journal `{}` does not belong to queue snapshot, ignored"
+                                               .format(self.journal_file))
+                    break
+                continue
+            if self._apply(record, items, index):
+                replayed += 1
+        return replayed
+
+
+    @staticmethod
+    def _apply(record: dict, items: list, index: dict) -> bool:
+        """ Apply a journal record to items. return False if its item is unknown """
+        op = record['op']
+        if op == 'add':
+            if record['item']['qid'] in index:
+                # Already in snapshot
+                return False
+            item = WBHItem.from_dict(record['item'])
+            parent = index.get(record['parent_qid'], (None, None))[0]
+            if record['parent_qid'] is not None:
+                if parent is None:
+                    return False
+                if parent.children is None:
+                    parent.children = WBHItemList()
+                parent.children.append(item)
+            else:
+                items.append(item)
+            index_items([item], parent, index)
+            return True
+
+        item, parent = index.get(record['qid'], (None, None))
+        if item is None:
+            return False
+        if op == 'item':
+            item.state = QueueState[record['state']]
+            item.db_id = record['db_id']
+            item.checksum = record['checksum']
+            item.checksum_type = ChecksumType[record['checksum_type']]
+        elif op == 'chunk':
+            chunk = WBHChunk.from_dict(record['chunk'])
+            WBHQueueJournal._drop_chunk(item, chunk.index)
+            item.add_chunk(chunk)
+        elif op == 'drop_chunk':
+            WBHQueueJournal._drop_chunk(item, record['index'])
+        elif op == 'remove':
+            siblings = parent.children if parent else items
+            if item in siblings:
+                siblings.remove(item)
+            for qid in index_items([item]):
+                index.pop(qid, None)
+        else:
+            return False
+        return True
+
+
+    @staticmethod
+    def _drop_chunk(item: WBHItem, index: int):
+        if item.chunks:
+            item.chunks[:] = [chunk for chunk in item.chunks if chunk.index != index]
+
+
+    def is_open(self) -> bool:
+        return self._file is not None
+
+
+    def _append(self, record: dict):
+        line = json.dumps(record) + '\n'
+        self._file.write(line)
+        self.journal_size += len(line)
+        self._need_fsync = True
+
+
+    def add(self, item: WBHItem, parent: WBHItem = None):
+        self._append({'op': 'add', 'parent_qid': parent.qid if parent else None, 'item': item.to_dict()})
+
+
+    def update_item(self, item: WBHItem):
+        self._append({'op': 'item', 'qid': item.qid, 'state': item.state.name, 'db_id': item.db_id,
+                      'checksum': item.checksum, 'checksum_type': item.checksum_type.name})
+
+
+    def update_chunk(self, item: WBHItem, chunk: WBHChunk):
+        self._append({'op': 'chunk', 'qid': item.qid, 'chunk': chunk.to_dict()})
+
+
+    def drop_chunk(self, item: WBHItem, chunk: WBHChunk):
+        self._append({'op': 'drop_chunk', 'qid': item.qid, 'index': chunk.index})
+
+
+    def remove(self, item: WBHItem):
+        self._append({'op': 'remove', 'qid': item.qid})
+
+
+    def commit(self):
+        """ Hand appended records to OS, fsync them at most once per fsync_interval """
+        self._file.flush()
+        if self._need_fsync and time.monotonic() - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+            self._need_fsync = False
+
+
+    def needs_compaction(self) -> bool:
+        """ Compact when journal grew larger than snapshot, so rewriting snapshot is amortized over changes """
+        return self.journal_size > max(self.compact_min_size, self.snapshot_size)
+
+
+    def compact(self, items: list):
+        """ Write items to a new snapshot and start a new, empty journal """
+        token = uuid.uuid4().hex
+        self._write_atomic(self.snapshot_file, json.dumps({'journal': token, 'items': [o.to_dict() for o in items]}))
+        self.snapshot_size = os.path.getsize(self.snapshot_file)
+        # Snapshot holds everything now, an older journal is ignored from here on because of its token
+        self.close()
+        self._write_atomic(self.journal_file, json.dumps({'op': 'begin', 'journal': token}) + '\n')
+        self._file = open(self.journal_file, 'a')
+        self.journal_size = os.path.getsize(self.journal_file)
+        self._last_fsync = time.monotonic()
+        self._need_fsync = False
+        config.logger_core.debug("  Queue snapshot `{}` written with {} items".format(self.snapshot_file, len(items)))
+
+
+    @staticmethod
+    def _write_atomic(filepath: str, data: str):
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filepath, filepath)
+        if os.name == 'posix':
+            # Make the rename itself durable
+            dir_fd = os.open(os.path.dirname(filepath), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
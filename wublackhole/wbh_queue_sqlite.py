@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import copy
+import json
+import os
+import sqlite3
+import threading
+
+from config import config
+from wublackhole.wbh_item import QueueState, WBHChunk, WBHItem
+from wublackhole.wbh_queue_journal import WBHQueueJournal
+
+
+class WBHQueueSqlite:
+    """
+    Queue store that keeps items and chunks as rows of a local SQLite file instead of an in-memory tree.
+    Items are read back page by page, so memory use does not grow with size of queue.
+    """
+    page_size = 500
+
+
+    def __init__(self, db_file: str, lock: threading.RLock = None):
+        """ lock guards the connection, which is shared by threads. Pass lock of queue that holds it on changes """
+        self.db_file = os.path.abspath(db_file)
+        self.conn: sqlite3.Connection = None
+        self.lock = lock if lock is not None else threading.RLock()
+
+
+    def open(self):
+        """ Open (and create if needed) the database. Queue directory must exist """
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                qid TEXT NOT NULL UNIQUE,
+                parent_qid TEXT,
+                is_dir INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS items_parent_qid ON items (parent_qid, id);
+            CREATE INDEX IF NOT EXISTS items_state ON items (state);
+            CREATE TABLE IF NOT EXISTS chunks (
+                qid TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                org_fullpath TEXT,
+                data TEXT NOT NULL,
+                PRIMARY KEY (qid, idx)
+            );
+            CREATE INDEX IF NOT EXISTS chunks_state ON chunks (state);
+        ''')
+        # Chunks of items that are not in queue, registered by older versions
+        self.conn.execute('DELETE FROM chunks WHERE NOT EXISTS (SELECT 1 FROM items WHERE items.qid = chunks.qid)')
+        self.conn.commit()
+
+
+    def is_open(self) -> bool:
+        return self.conn is not None
+
+
+    @staticmethod
+    def _item_data(item: WBHItem) -> str:
+        """ Item as JSON, without its children and chunks that have their own rows """
+        item_row = copy.copy(item)
+        item_row.children = None
+        item_row.chunks = None
+        return json.dumps(item_row.to_dict())
+
+
+    def _item_rows(self, item: WBHItem, parent_qid, rows: list, chunk_rows: list):
+        rows.append((str(item.qid), None if parent_qid is None else str(parent_qid), int(item.is_dir),
+                     item.state.name, self._item_data(item)))
+        chunk: WBHChunk
+        for chunk in item.chunks or []:
+            chunk_rows.append(self._chunk_row(item.qid, chunk))
+        child: WBHItem
+        for child in item.children or []:
+            self._item_rows(child, item.qid, rows, chunk_rows)
+
+
+    @staticmethod
+    def _chunk_row(qid, chunk: WBHChunk) -> tuple:
+        return str(qid), chunk.index, chunk.state.name, chunk.org_fullpath, json.dumps(chunk.to_dict())
+
+
+    def add(self, item: WBHItem, parent_qid=None):
+        """ Add item and its children/chunks (Recursively). Items that already exist are ignored """
+        rows = []
+        chunk_rows = []
+        self._item_rows(item, parent_qid, rows, chunk_rows)
+        self.conn.executemany('INSERT OR IGNORE INTO items (qid, parent_qid, is_dir, state, data) '
+                              'VALUES (?, ?, ?, ?, ?)', rows)
+        self.conn.executemany('INSERT OR IGNORE INTO chunks (qid, idx, state, org_fullpath, data) '
+                              'VALUES (?, ?, ?, ?, ?)', chunk_rows)
+
+
+    def update_item(self, item: WBHItem):
+        self.conn.execute('UPDATE items SET state = ?, data = ? WHERE qid = ?',
+                          (item.state.name, self._item_data(item), str(item.qid)))
+
+
+    def put_chunk(self, item: WBHItem, chunk: WBHChunk):
+        self.conn.execute('INSERT OR REPLACE INTO chunks (qid, idx, state, org_fullpath, data) VALUES (?, ?, ?, ?, ?)',
+                          self._chunk_row(item.qid, chunk))
+
+
+    def delete_chunk(self, item: WBHItem, chunk: WBHChunk):
+        self.conn.execute('DELETE FROM chunks WHERE qid = ? AND idx = ?', (str(item.qid), chunk.index))
+
+
+    def remove(self, item: WBHItem):
+        """ Remove item, its children and their chunks (Recursively) """
+        subtree = '''WITH RECURSIVE subtree(qid) AS (
+                         SELECT ? UNION ALL SELECT items.qid FROM items JOIN subtree ON items.parent_qid = subtree.qid)
+                     SELECT qid FROM subtree'''
+        self.conn.execute(f'DELETE FROM chunks WHERE qid IN ({subtree})', (str(item.qid),))
+        self.conn.execute(f'DELETE FROM items WHERE qid IN ({subtree})', (str(item.qid),))
+        if not self.has_children():
+            # Queue is empty, drop chunks left without an item
+            self.conn.execute('DELETE FROM chunks')
+
+
+    def _load_items(self, rows: list) -> list:
+        """ return WBHItems of rows of (qid, is_dir, data), with chunks of files """
+        items = [WBHItem.from_dict(json.loads(data)) for qid, is_dir, data in rows]
+        file_qids = [qid for qid, is_dir, data in rows if not is_dir]
+        if file_qids:
+            chunks = {}
+            for qid, data in self.conn.execute('SELECT qid, data FROM chunks WHERE qid IN ({}) ORDER BY qid, idx'
+                                               .format(','.join('?' * len(file_qids))), file_qids):
+                chunks.setdefault(qid, []).append(WBHChunk.from_dict(json.loads(data)))
+            for item in items:
+                if not item.is_dir:
+                    item.chunks = chunks.get(str(item.qid), item.chunks)
+        return items
+
+
+    def get_item(self, qid) -> WBHItem:
+        """ return WBHItem (without its children) if item exist with qid, None otherwise """
+        rows = self.conn.execute('SELECT qid, is_dir, data FROM items WHERE qid = ?', (str(qid),)).fetchall()
+        return self._load_items(rows)[0] if rows else None
+
+
+    def iter_children(self, parent_qid=None):
+        """ Yield items (without their children) whose parent is parent_qid, in order they were added """
+        parent_qid = None if parent_qid is None else str(parent_qid)
+        last_id = 0
+        while True:
+            # Keyset paging: items may be added/removed between pages. Generator runs outside of caller's lock, so
+            # each page is read under lock, not in the middle of another thread's change
+            with self.lock:
+                rows = self.conn.execute('SELECT id, qid, is_dir, data FROM items WHERE parent_qid IS ? AND id > ? '
+                                         'ORDER BY id LIMIT ?', (parent_qid, last_id, self.page_size)).fetchall()
+                if not rows:
+                    return
+                last_id = rows[-1][0]
+                items = self._load_items([row[1:] for row in rows])
+            yield from items
+
+
+    def has_children(self, parent_qid=None) -> bool:
+        parent_qid = None if parent_qid is None else str(parent_qid)
+        return self.conn.execute('SELECT 1 FROM items WHERE parent_qid IS ? LIMIT 1', (parent_qid,)).fetchone() \
+            is not None
+
+
+    def count_children(self, parent_qid=None) -> int:
+        parent_qid = None if parent_qid is None else str(parent_qid)
+        return self.conn.execute('SELECT COUNT(*) FROM items WHERE parent_qid IS ?', (parent_qid,)).fetchone()[0]
+
+
+    def get_spilled_chunk_paths(self) -> set:
+        """ return set of chunk files on disk that are waiting to be sent """
+        return {os.path.abspath(row[0]) for row in
+                self.conn.execute('SELECT org_fullpath FROM chunks WHERE state = ? AND org_fullpath IS NOT NULL',
+                                  (QueueState.UPLOADING.name,))}
+
+
+    def commit(self):
+        self.conn.commit()
+
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+
+def migrate_json_queue(queue_file: str, store: WBHQueueSqlite) -> int:
+    """
+    One-shot migration of a queue.json (and its journal) into store. Migrated files are renamed with a `.migrated`
+    suffix. return number of migrated top level items
+    """
+    journal = WBHQueueJournal(queue_file)
+    if not os.path.exists(queue_file) and not os.path.exists(journal.journal_file):
+        return 0
+    items = journal.load()
+    journal.close()
+    for item in items:
+        store.add(item)
+    store.commit()
+    # Rows are committed, a crash before renaming just migrates the same (ignored) items again
+    for filepath in (queue_file, journal.journal_file):
+        if os.path.exists(filepath):
+            os.replace(filepath, filepath + '.migrated')
+    config.logger_core.info("Queue `{}` migrated to `{}` with {} items".format(queue_file, store.db_file, len(items)))
+    return len(items)
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import stat
+import time
+
+
+class WBHStatCache:
+    """
+    Cache of file/directory stats of a blackhole, keyed by (dev, inode).
+    Directories are listed again only if their mtime changed. Files are still stat'ed on every scan because growing
+    a file does not touch its directory's mtime.
+    """
+    # Directory listings younger than this are not trusted (coarse mtime resolution on some file systems)
+    racy_window_ns = 2 * 1000000000
+
+
+    def __init__(self):
+        self._dirs: dict = {}  # (dev, inode) -> (mtime_ns, [(name, is_dir), ...])
+        self._files: dict = {}  # (dev, inode) -> (size, mtime_ns)
+        self._roots: dict = {}  # scanned path -> set of keys seen under it
+
+
+    def scan(self, full_path: str) -> tuple:
+        """ return (size in bytes, changed since last scan as bool) of file or directory """
+        keys = set()
+        try:
+            size, changed = self._scan(full_path, keys, time.time_ns())
+        except FileNotFoundError:
+            size, changed = 0, True
+        # Drop keys of removed files/directories
+        for key in self._roots.get(full_path, set()) - keys:
+            self._dirs.pop(key, None)
+            self._files.pop(key, None)
+        self._roots[full_path] = keys
+        return size, changed
+
+
+    def _scan(self, full_path: str, keys: set, now_ns: int) -> tuple:
+        st = os.stat(full_path)
+        key = (st.st_dev, st.st_ino)
+        keys.add(key)
+        if not stat.S_ISDIR(st.st_mode):
+            stat_data = (st.st_size, st.st_mtime_ns)
+            changed = self._files.get(key) != stat_data
+            self._files[key] = stat_data
+            return st.st_size, changed
+
+        cached = self._dirs.get(key)
+        if cached is not None and cached[0] == st.st_mtime_ns and now_ns - st.st_mtime_ns > self.racy_window_ns:
+            entries = cached[1]
+            changed = False
+        else:
+            with os.scandir(full_path) as it:
+                entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in it]
+            self._dirs[key] = (st.st_mtime_ns, entries)
+            changed = cached is None or cached[1] != entries
+
+        size = 0
+        files = self._files
+        dir_fd = os.open(full_path, os.O_RDONLY)
+        try:
+            for name, is_dir in entries:
+                try:
+                    if is_dir:
+                        s, c = self._scan(os.path.join(full_path, name), keys, now_ns)
+                        size += s
+                        changed = changed or c
+                    else:
+                        # stat relative to directory fd, cheaper than resolving whole path again
+                        st = os.stat(name, dir_fd=dir_fd)
+                        file_key = (st.st_dev, st.st_ino)
+                        keys.add(file_key)
+                        stat_data = (st.st_size, st.st_mtime_ns)
+                        if files.get(file_key) != stat_data:
+                            files[file_key] = stat_data
+                            changed = True
+                        size += st.st_size
+                except FileNotFoundError:
+                    # Removed since listing; list this directory again on next scan
+                    self._dirs.pop(key, None)
+                    changed = True
+        finally:
+            os.close(dir_fd)
+        return size, changed
+
+
+    def forget(self, full_path: str):
+        """ Drop everything cached under full_path (e.g. after moving it to queue) """
+        for key in self._roots.pop(full_path, set()):
+            self._dirs.pop(key, None)
+            self._files.pop(key, None)
@@ -5,9 +5,11 @@ import shutil
 import time
 from pathlib import Path
 
-from common.helper import sizeof_fmt, get_path_size
+from common.helper import get_path_stat, sizeof_fmt
 from config import config
 from wublackhole.wbh_item import QueueState, WBHItem
+from wublackhole.wbh_stat_cache import WBHStatCache
+from wublackhole.wbh_watcher_backend import create_watcher_backend
 
 
 def get_contents(path: str, parents: list = [], parent_qid=None, populate_info: bool = False) -> tuple:
@@ -35,7 +37,7 @@ def get_contents(path: str, parents: list = [], parent_qid=None, populate_info:
             # Get additional info
             if populate_info:
                 item_wbhi.state = QueueState.INQUEUE
-                item_wbhi.size = get_path_size(p)
+                item_wbhi.size = sum(child.size for child in item_wbhi.children)
                 item_wbhi.modified_at = os.path.getmtime(p)
                 item_wbhi.created_at = os.path.getctime(p)
                 item_wbhi.total_children = t
@@ -84,18 +86,93 @@ def print_contents(contents: list, parents: list = [], line_pre_txt=''):
             print(msg)
 
 
-def get_new_item_state(items: list, filename, size) -> tuple:
-    """ Return tuple(WatchCheckSizeState, index as int)  """
-    item: WBHItem  # Annotate item type before the loop
-    i = 0
-    for item in items:
-        if item.filename == filename:
-            if item.size == size:
-                return QueueState.UNCHANGED, i
-            else:
-                return QueueState.CHANGED, i
-        i += 1
-    return QueueState.NEW, -1
+class WBHWatchEntry:
+    def __init__(self, item: WBHItem, inode: int, mtime_ns: int, stable_since: float):
+        self.item = item
+        self.inode = inode
+        self.mtime_ns = mtime_ns  # Newest mtime under entry
+        self.stable_since = stable_since
+
+
+class WBHWatchTable:
+    """ Pending top level entries of a blackhole, indexed by filename """
+    def __init__(self, stable_duration: float):
+        self.stable_duration = stable_duration
+        self.entries: dict = {}  # filename -> WBHWatchEntry
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def update(self, filename: str, full_path: str, size: int, inode: int, mtime_ns: int, is_changed: bool,
+               now: float) -> QueueState:
+        """ Update entry after a scan and return its new state """
+        entry: WBHWatchEntry = self.entries.get(filename)
+        if entry is None:
+            # NEW: Just discovered
+            entry = WBHWatchEntry(item=WBHItem(size=size, root_path=os.path.dirname(full_path), full_path=full_path,
+                                               filename=filename, is_dir=os.path.isdir(full_path)),
+                                  inode=inode,
+                                  mtime_ns=mtime_ns,
+                                  stable_since=now)
+            self.entries[filename] = entry
+            config.logger_core.debug("  NEW       {: 10d}  > {}".format(size, filename))
+        elif is_changed or entry.item.size != size or entry.inode != inode or entry.mtime_ns != mtime_ns:
+            # CHANGED: Size/content is changing (or entry is replaced), restart stability window
+            entry.item.state = QueueState.CHANGED
+            entry.item.size = size
+            entry.inode = inode
+            entry.mtime_ns = mtime_ns
+            entry.stable_since = now
+            config.logger_core.debug("  CHANGING  {: 10d}  > {}".format(size, filename))
+        return self.check(entry, now)
+
+
+    def check(self, entry: WBHWatchEntry, now: float) -> QueueState:
+        """ UNCHANGED: Nothing changed during stability window """
+        if entry.item.state != QueueState.UNCHANGED and now - entry.stable_since >= self.stable_duration:
+            entry.item.state = QueueState.UNCHANGED
+            config.logger_core.debug("  UNCHANGED {: 10d}  > {}".format(entry.item.size, entry.item.filename))
+        return entry.item.state
+
+
+    def check_all(self, now: float):
+        entry: WBHWatchEntry
+        for entry in self.entries.values():
+            self.check(entry, now)
+
+
+    def discard(self, filename: str):
+        self.entries.pop(filename, None)
+
+
+    def retain(self, filenames):
+        """ Forget entries that are not in filenames anymore """
+        for filename in [fn for fn in self.entries if fn not in filenames]:
+            del self.entries[filename]
+
+
+    def get_unchanged(self) -> list:
+        """ return items with UNCHANGED state """
+        return [entry.item for entry in self.entries.values() if entry.item.state == QueueState.UNCHANGED]
+
+
+    def retry(self, filename: str, now: float):
+        """ Put entry back to CHANGED state, to be checked again after stability window """
+        entry: WBHWatchEntry = self.entries.get(filename)
+        if entry is not None:
+            entry.item.state = QueueState.CHANGED
+            entry.stable_since = now
+
+
+    def time_to_next_check(self, now: float, max_wait: float) -> float:
+        """ Seconds until the earliest pending entry might become UNCHANGED, at most max_wait """
+        wait = max_wait
+        entry: WBHWatchEntry
+        for entry in self.entries.values():
+            wait = min(wait, entry.stable_since + self.stable_duration - now)
+        return max(wait, 0.1)
 
 
 def move_to_queue(bh, item_wpi: WBHItem):
@@ -104,6 +181,7 @@ def move_to_queue(bh, item_wpi: WBHItem):
     if bh.queue.is_item_exist(item_wpi):
         config.logger_core.warning(
             f"    IGNORE moving `{item_wpi.filename}` to queue directory, Item exist is queue !!!")
+        return False
     else:
         try:
             start_t = time.process_time()
@@ -121,83 +199,139 @@ def move_to_queue(bh, item_wpi: WBHItem):
             # Add item to queue
             if item_wpi.is_dir:
                 # == Directory ==
-                # Add folder itself (as an item)
-                bh.queue.add(item_wpi)
-                # Looking for content of folder
+                # Looking for content of folder, before uploader can see the folder in queue
                 children_parents = list(item_wpi.parents)
                 children_parents.append(item_wpi.filename)
                 item_wpi.children, item_wpi.total_children = get_contents(path=item_wpi.root_path,
                                                                           parents=children_parents,
                                                                           parent_qid=item_wpi.qid,
                                                                           populate_info=True)
-            else:
-                # == File ==
+            # Uploader does not see item before it is saved to disk
+            with bh.queue.lock:
+                # Add item (a folder with its content, or a file) to queue
                 bh.queue.add(item_wpi)
-            # Saving Queue to disk
-            bh.queue.save()
+                # Saving Queue to disk
+                bh.queue.save()
             elapsed_t = time.process_time() - start_t
             config.logger_core.info(
                 "  `{}` () moved to queue directory in {:02f} secs...".format(item_wpi.filename, elapsed_t))
-        except shutil.Error as e:
-            # raise OSError(str(e))
+            return True
+        except OSError as e:
+            # shutil.Error or item is in use/removed meanwhile
             config.logger_core.error(f"  ERROR: Can not move `{item_wpi.filename}` to queue directory:\n {str(e)}")
+            return False
 
 
-def start_watch(bh):
-    # Prepare a list of file/folders to ignore
+def get_ignore_list(bh) -> list:
+    """ return list of file/folders to ignore in root of blackhole directory """
     ignore_list = [config.core['blackhole_queue_dirname'], "desktop.ini"]
     if os.path.abspath(bh.dirpath) == os.path.abspath(os.path.split(config.core['temp_dir'])[0]):
         ignore_list.append(os.path.split(config.core['temp_dir'])[1])
+    return ignore_list
 
-    items = []
-    while True:
-        start_t = time.process_time()
-        fns = os.listdir(bh.dirpath)
-        for f in fns:
-            # Ignore WBH_QUEUE_DIR_NAME
-            if f in ignore_list:
-                continue
-
-            # Prepare full_path
-            full_path = os.path.join(bh.dirpath, f)
-            # Get file/folder size
-            size = get_path_size(full_path)
-            # Get state in compare to the item in items
-            state, i = get_new_item_state(items, f, size)
-            # Update item's state
-            if state == QueueState.UNCHANGED:
-                items[i].state = state
-                config.logger_core.debug("  UNCHANGED {: 10d}  > {}".format(items[i].size, items[i].filename))
-            elif state == QueueState.NEW:
-                items.append(WBHItem(size=size, root_path=bh.dirpath, full_path=full_path, filename=f,
-                                     is_dir=os.path.isdir(full_path)))
-                config.logger_core.debug("  NEW       {: 10d}  > {}".format(size, f))
+
+def init_watch(bh):
+    """ Create watcher backend and state table of blackhole if needed. return None if everything must be scanned """
+    changed = set()
+    if bh.watcher is None:
+        bh.watcher = create_watcher_backend(bh.dirpath, get_ignore_list(bh), config.core['watcher']['backend'])
+        changed = None  # Rescan everything on first round
+    if bh.watch_table is None:
+        bh.watch_table = WBHWatchTable(stable_duration=config.core['watcher']['stable_duration'])
+    if bh.stat_cache is None and config.core['watcher']['stat_cache']:
+        bh.stat_cache = WBHStatCache()
+    return changed
+
+
+def forget_stat_cache(bh, full_path: str):
+    """ Drop stats cached under full_path, if stat cache is enabled """
+    if bh.stat_cache is not None:
+        bh.stat_cache.forget(full_path)
+
+
+def watch_tick(bh, changed) -> int:
+    """ Update state of changed entries (all entries if changed is None) and move UNCHANGED ones to queue.
+    return number of items moved to queue """
+    ignore_list = get_ignore_list(bh)
+    table: WBHWatchTable = bh.watch_table
+    start_t = time.process_time()
+    now = time.monotonic()
+    if changed is None:
+        # Full rescan
+        fns = [f for f in os.listdir(bh.dirpath) if f not in ignore_list]
+        # Forget items that are removed from blackhole directory
+        table.retain(set(fns))
+    else:
+        # Only entries that kernel reported as changed, the rest did not change during the interval
+        fns = list(changed)
+    for f in fns:
+        # Prepare full_path
+        full_path = os.path.join(bh.dirpath, f)
+        try:
+            inode = os.stat(full_path).st_ino
+            if bh.stat_cache is not None:
+                # Get file/folder size and whether anything under it changed since last scan, only directories
+                # whose mtime changed are listed again
+                size, is_changed = bh.stat_cache.scan(full_path)
+                mtime_ns = 0
             else:
-                items[i].state = state
-                items[i].size = size
-                config.logger_core.debug("  CHANGING  {: 10d}  > {}".format(items[i].size, items[i].filename))
+                # Get file/folder size and newest mtime under it, same-size rewrites change mtime
+                size, mtime_ns = get_path_stat(full_path)
+                is_changed = False
+        except FileNotFoundError:
+            forget_stat_cache(bh, full_path)
+            table.discard(f)
+            continue
+        # There was an event for it, so it is still changing even with the same size
+        table.update(filename=f, full_path=full_path, size=size, inode=inode, mtime_ns=mtime_ns,
+                     is_changed=is_changed or changed is not None, now=now)
+    # Entries without any change may have passed their stability window
+    table.check_all(now)
+
+    elapsed_t = time.process_time() - start_t
+    config.logger_core.debug(" Checked {} items in {:02f} secs: {}".format(len(fns), elapsed_t, bh.dirpath))
+
+    # Moving UNCHANGED items to BlackHole's queue and save queue
+    moved = 0
+    item: WBHItem
+    for item in table.get_unchanged():
+        if move_to_queue(bh, item):
+            forget_stat_cache(bh, item.full_path)
+            table.discard(item.filename)
+            moved += 1
+        elif os.path.lexists(os.path.join(bh.dirpath, item.filename)):
+            # No new event may come for it (e.g. with inotify backend), so try again on a later tick
+            table.retry(item.filename, time.monotonic())
+        else:
+            table.discard(item.filename)
+    return moved
+
+
+def wait_for_changes(bh):
+    """ Wait until the next pending item could be stable. return changed entries (None to rescan everything) """
+    table: WBHWatchTable = bh.watch_table
+    timeout = table.time_to_next_check(time.monotonic(), config.core['path_check_interval'])
+    config.logger_core.debug(f"Wait {timeout:.2f} seconds for changes...")
+    changed = bh.watcher.wait(timeout)
+    if changed:
+        for f in [f for f in changed if not os.path.exists(os.path.join(bh.dirpath, f))]:
+            # Forget items that are removed from blackhole directory (or moved to queue)
+            changed.discard(f)
+            table.discard(f)
+    return changed
 
-        elapsed_t = time.process_time() - start_t
-        config.logger_core.debug(" Checked {} items in {:02f} secs: {}".format(len(items), elapsed_t, bh.dirpath))
 
-        # Moving UNCHANGED items to BlackHole's queue and save queue
-        item: WBHItem
-        for item in items:
-            if item.state == QueueState.UNCHANGED:
-                move_to_queue(bh, item)
-                items.remove(item)
+def start_watch(bh):
+    """ Watch blackhole and process its queue until there is no pending item """
+    changed = init_watch(bh)
+    while True:
+        watch_tick(bh, changed)
 
         # Empty the Queue by sending to BlackHole
         bh.queue.process_queue(bh.telegram_id)
 
-        # if run_counts:
-        #     run_counts -= 1
-        #     if run_counts <= 0:
-        #         break
-        # else:
-        config.logger_core.debug(f"Sleep for {config.core['path_check_interval']} seconds...")
-        time.sleep(config.core['path_check_interval'])
+        changed = wait_for_changes(bh)
 
         # Break the loop if there is items there. Let application process blackholes
-        if len(items) <= 0:
+        if len(bh.watch_table) <= 0 and not changed:
             break
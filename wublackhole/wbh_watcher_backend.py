@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from config import config
+
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ATTRIB | \
+             IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class WBHPollingWatcher:
+    """ Fallback backend: sleep for the interval, then ask for a full rescan of the blackhole directory """
+    name = 'polling'
+
+
+    def __init__(self, dirpath: str, ignore_list: list):
+        self.dirpath = dirpath
+        self.ignore_list = ignore_list
+
+
+    def wait(self, timeout: float):
+        """ return set of changed top level entries or None if everything has to be rescanned """
+        config.shutdown_event.wait(timeout)
+        return None
+
+
+    def close(self):
+        pass
+
+
+class WBHInotifyWatcher:
+    """ Linux backend: subscribe to kernel filesystem events of the whole blackhole tree """
+    name = 'inotify'
+
+
+    def __init__(self, dirpath: str, ignore_list: list):
+        self.dirpath = os.path.abspath(dirpath)
+        self.ignore_list = ignore_list
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # wd -> path of watched directory relative to blackhole directory ('' for root)
+        self._watches: dict = {}
+        self._add_watch_recursively('')
+
+
+    def _add_watch(self, rel_path: str):
+        full_path = os.path.join(self.dirpath, rel_path) if rel_path else self.dirpath
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(full_path), WATCH_MASK)
+        if wd < 0:
+            # Directory might be removed/moved before we could watch it
+            config.logger_core.debug(f"  Can not watch `{full_path}`: {os.strerror(ctypes.get_errno())}")
+            return
+        self._watches[wd] = rel_path
+
+
+    def _add_watch_recursively(self, rel_path: str):
+        self._add_watch(rel_path)
+        full_path = os.path.join(self.dirpath, rel_path) if rel_path else self.dirpath
+        try:
+            with os.scandir(full_path) as it:
+                for entry in it:
+                    if not rel_path and entry.name in self.ignore_list:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        self._add_watch_recursively(os.path.join(rel_path, entry.name))
+        except OSError as e:
+            config.logger_core.debug(f"  Can not list `{full_path}`: {str(e)}")
+
+
+    def _remove_watches(self, top_level_name: str):
+        """ Stop watching a top level entry (and its sub-directories), e.g. after moving it to queue """
+        for wd, rel_path in list(self._watches.items()):
+            if rel_path == top_level_name or rel_path.startswith(top_level_name + os.sep):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+
+    def _read_events(self, changed: set) -> bool:
+        """ Read pending events into changed set. return False if kernel queue overflowed """
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return True
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                return False
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None or not name:
+                continue
+            rel_path = os.path.join(rel_dir, name) if rel_dir else name
+            top_level_name = rel_path.split(os.sep, 1)[0]
+            if top_level_name in self.ignore_list:
+                continue
+            if not rel_dir and mask & (IN_MOVED_FROM | IN_DELETE):
+                # Top level entry left the blackhole (deleted or moved to queue)
+                self._remove_watches(top_level_name)
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Watch new sub-directories; their content may already exist so it gets rescanned anyway
+                self._add_watch_recursively(rel_path)
+            changed.add(top_level_name)
+        return True
+
+
+    def wait(self, timeout: float):
+        """ return set of changed top level entries or None if everything has to be rescanned """
+        changed = set()
+        deadline = time.monotonic() + timeout
+        while True:
+            remained = deadline - time.monotonic()
+            if remained <= 0:
+                break
+            readable, _, _ = select.select([self._fd], [], [], remained)
+            if readable and not self._read_events(changed):
+                config.logger_core.warning(f"  inotify queue overflowed for `{self.dirpath}`, rescanning...")
+                return None
+        return changed
+
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def create_watcher_backend(dirpath: str, ignore_list: list, backend: str = 'auto'):
+    """ return a watcher backend for dirpath. `auto` prefers inotify and falls back to polling """
+    if backend in ('auto', 'inotify') and sys.platform.startswith('linux'):
+        try:
+            watcher = WBHInotifyWatcher(dirpath, ignore_list)
+            config.logger_core.debug(f"Watching `{dirpath}` using inotify")
+            return watcher
+        except Exception as e:
+            config.logger_core.warning(f"Can not use inotify for `{dirpath}`, falling back to polling: {str(e)}")
+    elif backend == 'inotify':
+        config.logger_core.warning(f"inotify is not available on {sys.platform}, falling back to polling")
+    config.logger_core.debug(f"Watching `{dirpath}` using polling")
+    return WBHPollingWatcher(dirpath, ignore_list)
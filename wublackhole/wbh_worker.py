@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+
+from config import config
+from wublackhole.wbh_watcher import init_watch, wait_for_changes, watch_tick
+
+
+def watch_worker(bh):
+    """ Watch blackhole directory and move stable items to its queue until shutdown """
+    changed = init_watch(bh)
+    while not config.shutdown_event.is_set():
+        try:
+            if watch_tick(bh, changed) > 0:
+                # Wake up uploader
+                bh.queue_event.set()
+        except Exception as e:
+            config.logger_core.error(f"ERROR: Watcher of blackhole `{bh.name}` failed: {str(e)}")
+            # Changes of failed round are lost, rescan everything on next round
+            config.shutdown_event.wait(config.core['path_check_interval'])
+            changed = None
+            continue
+        changed = wait_for_changes(bh)
+    bh.watcher.close()
+    config.logger_core.debug(f"Watcher of blackhole `{bh.name}` stopped.")
+
+
+def upload_worker(bh):
+    """ Empty blackhole's queue whenever watcher moved something to it, until shutdown """
+    while not config.shutdown_event.is_set():
+        try:
+            # Empty the Queue by sending to BlackHole
+            bh.queue.process_queue(bh.telegram_id)
+        except Exception as e:
+            config.logger_core.error(f"ERROR: Uploader of blackhole `{bh.name}` failed: {str(e)}")
+        # Wait for new items (or retry unfinished ones after an interval)
+        bh.queue_event.wait(config.core['path_check_interval'])
+        bh.queue_event.clear()
+    config.logger_core.debug(f"Uploader of blackhole `{bh.name}` stopped.")
+
+
+def start_workers(blackholes: list) -> list:
+    """ Start a watcher and an uploader thread for each blackhole. return list of threads """
+    threads = []
+    for bh in blackholes:
+        for target, role in ((watch_worker, 'watcher'), (upload_worker, 'uploader')):
+            thread = threading.Thread(target=target, args=(bh,), name=f"{role}-{bh.name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+    return threads
@@ -19,7 +19,8 @@ def setup_client():
     # Setup Database
     client.init_database()
     # Setup Bot
-    client.init_bot(client.client['bot']['api'], client.client['bot']['proxy'])
+    client.init_bot(client.client['bot']['api'], client.client['bot']['proxy'],
+                    client.client['bot']['local_server'])
 
 
 def parse_args():